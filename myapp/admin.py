@@ -1,6 +1,6 @@
 # myapp/admin.py
 from django.contrib import admin
-from .models import City, Place, Category, PlaceImage, PlaceCategory, SimilarPlace
+from .models import City, Place, Category, PlaceImage, PlaceCategory, SimilarPlace, PlaceFingerprint
 
 @admin.register(City)
 class CityAdmin(admin.ModelAdmin):
@@ -44,4 +44,11 @@ class SimilarPlaceAdmin(admin.ModelAdmin):
     list_display = ('main_place', 'similar_place', 'similarity_type', 'similarity_score')
     list_filter = ('similarity_type',)
     search_fields = ('main_place__name', 'similar_place__name')
-    raw_id_fields = ('main_place', 'similar_place')
\ No newline at end of file
+    raw_id_fields = ('main_place', 'similar_place')
+
+@admin.register(PlaceFingerprint)
+class PlaceFingerprintAdmin(admin.ModelAdmin):
+    list_display = ('place', 'job', 'digest')
+    list_filter = ('job',)
+    search_fields = ('place__name',)
+    raw_id_fields = ('place',)
\ No newline at end of file
@@ -0,0 +1,317 @@
+# myapp/color_index.py
+import os
+import tempfile
+import time
+
+import numpy as np
+from django.conf import settings
+
+from myapp.models import Place, PlaceImage
+from myapp.similarity import load_color_matrix
+
+INDEX_FILENAME = 'color_index.npz'
+
+
+def index_path():
+    """Default location of the on-disk color index"""
+    return os.path.join(settings.SIMILARITY_DATA_DIR, INDEX_FILENAME)
+
+
+def normalize(vectors):
+    """L2-normalize rows, leaving all-zero rows untouched"""
+    vectors = np.atleast_2d(np.asarray(vectors, dtype=np.float32))
+    norms = np.linalg.norm(vectors, axis=1)
+    norms[norms == 0] = 1
+    return vectors / norms[:, None]
+
+
+def spherical_kmeans(vectors, k, iterations=10, seed=0):
+    """Seeded k-means on unit vectors (cosine distance), used as the coarse quantizer"""
+    if not len(vectors):
+        return np.zeros((0, vectors.shape[1]), dtype=np.float32)
+    rng = np.random.default_rng(seed)
+    k = max(1, min(k, len(vectors)))
+    centroids = vectors[rng.choice(len(vectors), k, replace=False)].copy()
+
+    for _ in range(iterations):
+        labels = np.argmax(vectors @ centroids.T, axis=1)
+        for j in range(k):
+            members = vectors[labels == j]
+            if len(members):
+                centroids[j] = members.sum(axis=0)
+            else:
+                # Re-seed empty lists with a random point
+                centroids[j] = vectors[rng.integers(len(vectors))]
+        centroids = normalize(centroids)
+
+    return centroids
+
+
+class ColorIndex:
+    """
+    Inverted-file (IVF) approximate nearest neighbour index over L2-normalized
+    place color vectors. Vectors are kept grouped by their nearest centroid so
+    a query only scans the `nprobe` closest lists.
+    """
+
+    def __init__(self, centroids, place_ids=None, city_ids=None, vectors=None):
+        self.centroids = np.asarray(centroids, dtype=np.float32)
+        dim = self.centroids.shape[1]
+        self.place_ids = np.asarray(place_ids if place_ids is not None else [], dtype=np.int64)
+        self.city_ids = np.asarray(city_ids if city_ids is not None else [], dtype=np.int64)
+        self.vectors = np.asarray(vectors if vectors is not None else np.zeros((0, dim)), dtype=np.float32)
+        self._sort()
+
+    def __len__(self):
+        return len(self.place_ids)
+
+    @classmethod
+    def build(cls, place_ids, city_ids, vectors, nlist=None, seed=0):
+        """Train the coarse quantizer on the given vectors and index them"""
+        vectors = normalize(vectors)
+        if nlist is None:
+            nlist = int(np.sqrt(len(vectors))) or 1
+        centroids = spherical_kmeans(vectors, nlist, seed=seed)
+        return cls(centroids, place_ids, city_ids, vectors)
+
+    @classmethod
+    def load(cls, path=None):
+        with np.load(path or index_path()) as data:
+            return cls(data['centroids'], data['place_ids'], data['city_ids'], data['vectors'])
+
+    def save(self, path=None):
+        """Write the index atomically so readers never see a partial file"""
+        path = path or index_path()
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.npz')
+        with os.fdopen(fd, 'wb') as f:
+            np.savez(f, centroids=self.centroids, place_ids=self.place_ids,
+                     city_ids=self.city_ids, vectors=self.vectors)
+        os.replace(tmp_path, path)
+
+    def _sort(self):
+        """Group vectors by inverted list and compute the list offsets"""
+        dim = self.centroids.shape[1]
+        if self.vectors.shape[1] != dim:
+            self.vectors = self._fit_dim(self.vectors)
+        self.lists = self._assign(self.vectors)
+        order = np.argsort(self.lists, kind='stable')
+        self.place_ids = self.place_ids[order]
+        self.city_ids = self.city_ids[order]
+        self.vectors = self.vectors[order]
+        self.lists = self.lists[order]
+        self.offsets = np.searchsorted(self.lists, np.arange(len(self.centroids) + 1))
+        self._positions = None
+
+    @property
+    def positions(self):
+        """Row of every indexed place id, rebuilt on first use after a change"""
+        if self._positions is None:
+            self._positions = {place_id: i for i, place_id in enumerate(self.place_ids.tolist())}
+        return self._positions
+
+    def _delete(self, rows):
+        """Drop rows from their inverted lists, shifting the offsets of later lists"""
+        if not len(rows):
+            return
+        removed = np.bincount(self.lists[rows], minlength=len(self.centroids))
+        self.offsets[1:] -= np.cumsum(removed)
+        self.place_ids = np.delete(self.place_ids, rows)
+        self.city_ids = np.delete(self.city_ids, rows)
+        self.vectors = np.delete(self.vectors, rows, axis=0)
+        self.lists = np.delete(self.lists, rows)
+        self._positions = None
+
+    def _fit_dim(self, vectors):
+        """Zero-pad or crop vectors to the index dimension"""
+        dim = self.centroids.shape[1]
+        fitted = np.zeros((len(vectors), dim), dtype=np.float32)
+        width = min(dim, vectors.shape[1])
+        fitted[:, :width] = vectors[:, :width]
+        return normalize(fitted)
+
+    def _assign(self, vectors):
+        if not len(vectors):
+            return np.zeros(0, dtype=np.int64)
+        return np.argmax(vectors @ self.centroids.T, axis=1)
+
+    def add(self, place_ids, city_ids, vectors):
+        """
+        Insert or replace places without retraining the quantizer: only the
+        new vectors are assigned, then merged in at the end of their lists.
+        An empty index trains its quantizer on the first places added.
+        """
+        place_ids = np.asarray(place_ids, dtype=np.int64)
+        city_ids = np.asarray(city_ids, dtype=np.int64)
+        if not len(self.centroids):
+            fresh = ColorIndex.build(place_ids, city_ids, vectors)
+            self.__dict__.update(fresh.__dict__)
+            return
+
+        self.remove(place_ids)
+        vectors = self._fit_dim(normalize(vectors))
+        lists = self._assign(vectors)
+        order = np.argsort(lists, kind='stable')
+        lists = lists[order]
+        # np.insert places every value before the given row, so each goes after its list's current end
+        at = self.offsets[lists + 1]
+        self.place_ids = np.insert(self.place_ids, at, place_ids[order])
+        self.city_ids = np.insert(self.city_ids, at, city_ids[order])
+        self.vectors = np.insert(self.vectors, at, vectors[order], axis=0)
+        self.lists = np.insert(self.lists, at, lists)
+        self.offsets[1:] += np.cumsum(np.bincount(lists, minlength=len(self.centroids)))
+        self._positions = None
+
+    def remove(self, place_ids):
+        self._delete(np.flatnonzero(np.isin(self.place_ids, np.asarray(place_ids, dtype=np.int64))))
+
+    def vector_for(self, place_id):
+        position = self.positions.get(place_id)
+        return None if position is None else self.vectors[position]
+
+    def search(self, vector, k=3, nprobe=8, city_id=None, same_city=None, exclude=None):
+        """
+        Approximate top-k by cosine similarity. `same_city` restricts results to
+        (True) or away from (False) `city_id`. Probing widens until k results are
+        found or every list has been scanned. Returns (place_ids, scores) with
+        scores mapped to [0, 1] like the stored image similarities.
+        """
+        query = self._fit_dim(normalize(vector))[0]
+        probe_order = np.argsort(-(self.centroids @ query))
+        nprobe = max(1, nprobe)
+
+        while True:
+            probes = probe_order[:nprobe]
+            candidates = np.concatenate(
+                [np.arange(self.offsets[j], self.offsets[j + 1]) for j in probes]
+            ) if len(probes) else np.zeros(0, dtype=np.int64)
+
+            if exclude is not None:
+                candidates = candidates[self.place_ids[candidates] != exclude]
+            if same_city is not None and city_id is not None:
+                in_city = self.city_ids[candidates] == city_id
+                candidates = candidates[in_city if same_city else ~in_city]
+
+            if len(candidates) >= k or nprobe >= len(self.centroids):
+                break
+            nprobe *= 2
+
+        scores = self.vectors[candidates] @ query
+        if len(candidates) > k:
+            best = np.argpartition(-scores, k - 1)[:k]
+        else:
+            best = np.arange(len(candidates))
+        best = best[np.argsort(-scores[best])]
+
+        return self.place_ids[candidates[best]], np.round((scores[best].astype(np.float64) + 1) / 2, 3)
+
+    def exact_search(self, vector, k=3, exclude=None):
+        """Brute-force top-k over every indexed vector (benchmark reference)"""
+        query = self._fit_dim(normalize(vector))[0]
+        scores = self.vectors @ query
+        if exclude is not None:
+            scores[self.place_ids == exclude] = -np.inf
+        best = np.argpartition(-scores, min(k, len(scores)) - 1)[:k]
+        best = best[np.argsort(-scores[best])]
+        return self.place_ids[best], np.round((scores[best].astype(np.float64) + 1) / 2, 3)
+
+    def benchmark(self, queries=200, k=3, nprobe=8, seed=0):
+        """Recall@k and mean query latency of `search` against `exact_search`"""
+        rng = np.random.default_rng(seed)
+        sample = rng.choice(len(self), min(queries, len(self)), replace=False)
+
+        hits = 0
+        approx_time = 0.0
+        exact_time = 0.0
+        for position in sample:
+            place_id = self.place_ids[position]
+            vector = self.vectors[position]
+
+            start = time.perf_counter()
+            approx_ids, _ = self.search(vector, k=k, nprobe=nprobe, exclude=place_id)
+            approx_time += time.perf_counter() - start
+
+            start = time.perf_counter()
+            exact_ids, _ = self.exact_search(vector, k=k, exclude=place_id)
+            exact_time += time.perf_counter() - start
+
+            hits += len(np.intersect1d(approx_ids, exact_ids))
+
+        count = max(len(sample), 1)
+        return {
+            'queries': len(sample),
+            'recall': hits / max(count * min(k, len(self) - 1), 1),
+            'approx_ms': 1000 * approx_time / count,
+            'exact_ms': 1000 * exact_time / count,
+        }
+
+
+def build_index(nlist=None, seed=0):
+    """Build a fresh index from every place with a color vector"""
+    places = list(Place.objects.values_list('id', 'city_id'))
+    place_ids = np.array([p[0] for p in places], dtype=np.int64)
+    city_ids = np.array([p[1] for p in places], dtype=np.int64)
+    colors, has_colors = load_color_matrix(place_ids.tolist())
+    return ColorIndex.build(place_ids[has_colors], city_ids[has_colors], colors[has_colors], nlist=nlist, seed=seed)
+
+
+def add_places(index, place_ids, city_ids):
+    """Incrementally insert (or refresh) the given places; returns how many had colors"""
+    colors, has_colors = load_color_matrix(list(place_ids))
+    if colors.shape[1] == 0 or not has_colors.any():
+        return 0
+    ids = np.asarray(place_ids, dtype=np.int64)[has_colors]
+    cities = np.asarray(city_ids, dtype=np.int64)[has_colors]
+    index.add(ids, cities, colors[has_colors])
+    return int(has_colors.sum())
+
+
+def place_vector(place):
+    """
+    Normalized color vector of a place's latest colored image, or None. Read
+    with one query for that place only and cached on the instance, so the
+    lookups of one page view share it.
+    """
+    if not hasattr(place, '_color_vector'):
+        blob = (PlaceImage.objects.filter(place_id=place.id, color_dim__gt=0)
+                .order_by('-id').values_list('color_vector', flat=True).first())
+        place._color_vector = normalize(np.frombuffer(bytes(blob), dtype=np.uint8))[0] if blob else None
+    return place._color_vector
+
+
+_cached_index = None
+_cached_mtime = None
+
+
+def get_index():
+    """Load the on-disk index once per process, reloading when the file changes"""
+    global _cached_index, _cached_mtime
+    path = index_path()
+    try:
+        mtime = os.path.getmtime(path)
+    except OSError:
+        return None
+    if _cached_index is None or mtime != _cached_mtime:
+        _cached_index = ColorIndex.load(path)
+        _cached_mtime = mtime
+    return _cached_index
+
+
+def similar_by_color(place, k=3, same_city=True, nprobe=8):
+    """
+    Query the color index for a place, even one added after the index was
+    built. Returns (place_id, score) pairs, best first.
+    """
+    index = get_index()
+    if index is None or not len(index):
+        return []
+
+    vector = index.vector_for(place.id)
+    if vector is None:
+        vector = place_vector(place)
+        if vector is None:
+            return []
+
+    ids, scores = index.search(vector, k=k, nprobe=nprobe, city_id=place.city_id,
+                               same_city=same_city, exclude=place.id)
+    return list(zip(ids.tolist(), scores.tolist()))
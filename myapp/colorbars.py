@@ -0,0 +1,150 @@
+# myapp/colorbars.py
+"""
+Palette extraction and color bar rendering for place images. The batch
+functions work on file paths and plain lists, so they run unchanged in pool
+workers without Django being set up.
+
+Color bars are rendered on demand from the stored palette: `open_color_bar`
+keeps the rendered JPEGs in a bounded on-disk cache keyed by palette hash,
+evicting the least recently served files once it is full. Each process
+counts the bars it renders and only scans the cache directory when its
+count says the cache may be full, so a render costs no directory listing.
+"""
+import os
+import threading
+from multiprocessing import get_context
+
+import numpy as np
+from django.conf import settings
+from PIL import Image
+
+from myapp.imaging import atomic_save, load_analysis_pixels
+from myapp.palettes import DEFAULT_METHOD, extract_palettes
+from myapp.parallel import available_cores
+
+BAR_SIZE = (300, 50)
+# Maximum number of rendered bars kept on disk; eviction trims to 90%
+CACHE_SIZE = 10000
+
+# Per process: cache directory -> bars on disk as of the last scan plus the ones rendered since
+_cached_bars = {}
+_cached_bars_lock = threading.Lock()
+
+
+def render_color_bar(colors, output_path, size=BAR_SIZE):
+    """
+    Write the palette as vertical stripes straight from a NumPy array. When
+    the width does not divide evenly, the spare columns are spread over the
+    stripes (widths differ by at most one) rather than left black.
+    """
+    rgb_colors = np.asarray(colors, dtype=np.uint8).reshape(-1, 3)
+    width, height = size
+    stripes = np.arange(width) * len(rgb_colors) // width
+
+    bar = np.broadcast_to(rgb_colors[stripes], (height, width, 3))
+    atomic_save(Image.fromarray(np.ascontiguousarray(bar)), output_path, 'JPEG', quality=90)
+
+
+def cache_dir():
+    return getattr(settings, 'COLORBAR_CACHE_DIR', os.path.join(settings.MEDIA_ROOT, 'colorbar_cache'))
+
+
+def open_color_bar(palette_hash, colors):
+    """
+    The rendered bar for a palette as an open binary file, rendering it into
+    the cache on first use. The file is opened before any eviction runs, so
+    it stays readable even if it is evicted right after.
+    """
+    path = os.path.join(cache_dir(), f'{palette_hash}.jpg')
+    try:
+        f = open(path, 'rb')
+        # Mark as recently used
+        os.utime(path)
+        return f
+    except FileNotFoundError:
+        pass
+    render_color_bar(colors, path)
+    f = open(path, 'rb')
+    note_rendered(getattr(settings, 'COLORBAR_CACHE_SIZE', CACHE_SIZE))
+    return f
+
+
+def note_rendered(limit):
+    """
+    Count a newly rendered bar and scan for eviction only when the count
+    passes `limit` (or on this process's first render). After trimming to 90%
+    the next scan is limit / 10 renders away. Bars rendered by other processes
+    are only seen at the next scan, so the cache can briefly exceed `limit`.
+    """
+    directory = cache_dir()
+    with _cached_bars_lock:
+        count = _cached_bars.get(directory)
+        if count is not None and count < limit:
+            _cached_bars[directory] = count + 1
+            return
+        # Claim the scan; other threads keep counting from here meanwhile
+        _cached_bars[directory] = 0
+    remaining = evict_color_bars(limit)
+    with _cached_bars_lock:
+        _cached_bars[directory] += remaining
+
+
+def evict_color_bars(limit):
+    """Delete the least recently used bars once the cache holds more than `limit`; returns how many are left"""
+    entries = [entry for entry in os.scandir(cache_dir()) if entry.name.endswith('.jpg')]
+    if len(entries) <= limit:
+        return len(entries)
+
+    entries.sort(key=lambda entry: entry.stat().st_mtime)
+    removed = 0
+    for entry in entries[:len(entries) - int(limit * 0.9)]:
+        try:
+            os.remove(entry.path)
+            removed += 1
+        except FileNotFoundError:
+            pass
+    return len(entries) - removed
+
+
+def process_batch(task):
+    """
+    Worker: (media_root, local_paths, method) -> a list of
+    (local_path, colors, error). Palettes of the whole batch are extracted
+    in one call; colors is [] when none could be extracted.
+    """
+    media_root, local_paths, method = task
+    results = []
+    loaded = []
+    for local_path in local_paths:
+        image_path = os.path.join(media_root, local_path)
+        if not os.path.exists(image_path):
+            results.append((local_path, [], f"Image not found: {image_path}"))
+            continue
+        try:
+            loaded.append((local_path, load_analysis_pixels(image_path)))
+        except Exception as e:
+            results.append((local_path, [], str(e)))
+
+    try:
+        palettes = extract_palettes([pixels for _, pixels in loaded], method)
+    except Exception as e:
+        return results + [(local_path, [], str(e)) for local_path, _ in loaded]
+
+    return results + [(local_path, colors, None) for (local_path, _), colors in zip(loaded, palettes)]
+
+
+def run_palettes(local_paths, media_root, method=DEFAULT_METHOD, workers=None, batch_size=32):
+    """
+    Yield (local_path, colors, error) for every image, one batch of images
+    per task, on a process pool unless workers == 1.
+    """
+    tasks = [(media_root, local_paths[i:i + batch_size], method) for i in range(0, len(local_paths), batch_size)]
+    workers = workers or available_cores()
+    if workers == 1:
+        for task in tasks:
+            yield from process_batch(task)
+        return
+
+    with get_context().Pool(workers) as pool:
+        for results in pool.imap_unordered(process_batch, tasks):
+            yield from results
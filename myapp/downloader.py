@@ -0,0 +1,185 @@
+# myapp/downloader.py
+"""
+Concurrent HTTP download engine for place images. A thread pool shares the
+work; every thread keeps its own requests.Session, so connections to a host
+are kept alive and reused. Each host has a cap on concurrent requests and an
+optional request rate, and transient failures (connection errors, 429, 5xx)
+are retried with exponential backoff and full jitter.
+"""
+import random
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from email.utils import parsedate_to_datetime
+from itertools import islice
+from urllib.parse import urlsplit
+
+import requests
+from requests.adapters import HTTPAdapter
+
+HEADERS = {
+    "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 "
+                  "(KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36",
+    "Accept-Language": "en-US,en;q=0.9",
+    "Accept": "text/html,application/xhtml+xml,application/xml;q=0.9,image/webp,*/*;q=0.8",
+    "Referer": "https://www.google.com/",
+    "DNT": "1"
+}
+
+# Responses worth retrying; anything else is a permanent failure
+RETRY_STATUSES = {408, 425, 429, 500, 502, 503, 504}
+
+
+class DownloadError(Exception):
+    """A URL could not be fetched, after retries where they apply"""
+
+
+class HostLimiter:
+    """Caps concurrent requests to one host and spaces them to a maximum rate"""
+
+    def __init__(self, concurrency, rate=None):
+        self.semaphore = threading.BoundedSemaphore(concurrency)
+        self.interval = 1.0 / rate if rate else 0.0
+        self.lock = threading.Lock()
+        self.next_slot = 0.0
+
+    def __enter__(self):
+        self.semaphore.acquire()
+        # Also without a rate limit: pause() may have pushed the next slot back
+        with self.lock:
+            now = time.monotonic()
+            delay = self.next_slot - now
+            self.next_slot = max(now, self.next_slot) + self.interval
+        if delay > 0:
+            time.sleep(delay)
+        return self
+
+    def __exit__(self, *exc_info):
+        self.semaphore.release()
+
+    def pause(self, seconds):
+        """Push the next request slot back, e.g. after a 429 with Retry-After"""
+        with self.lock:
+            self.next_slot = max(self.next_slot, time.monotonic() + seconds)
+
+
+def retry_after_seconds(response):
+    """Parse a Retry-After header (seconds or HTTP date); None if absent or invalid"""
+    value = response.headers.get('Retry-After')
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+class Downloader:
+    """
+    Fetch many URLs concurrently.
+
+    `workers` threads share the queue, at most `per_host` of them talk to the
+    same host at once, and `rate` (requests per second per host) optionally
+    spaces requests out. Failed attempts are retried up to `retries` times,
+    sleeping a random time in [0, min(max_backoff, backoff * 2**attempt)].
+    """
+
+    def __init__(self, workers=16, per_host=4, rate=None, retries=3, backoff=0.5,
+                 max_backoff=30.0, timeout=15, headers=None):
+        self.workers = workers
+        self.per_host = per_host
+        self.rate = rate
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.timeout = timeout
+        self.headers = headers or HEADERS
+
+        self._local = threading.local()
+        self._limiters = {}
+        self._limiters_lock = threading.Lock()
+
+    def session(self):
+        """This thread's keep-alive session"""
+        session = getattr(self._local, 'session', None)
+        if session is None:
+            session = requests.Session()
+            session.headers.update(self.headers)
+            adapter = HTTPAdapter(pool_connections=16, pool_maxsize=max(self.per_host, 1))
+            session.mount('http://', adapter)
+            session.mount('https://', adapter)
+            self._local.session = session
+        return session
+
+    def limiter(self, url):
+        host = urlsplit(url).netloc
+        with self._limiters_lock:
+            if host not in self._limiters:
+                self._limiters[host] = HostLimiter(self.per_host, self.rate)
+            return self._limiters[host]
+
+    def backoff_delay(self, attempt):
+        return random.uniform(0, min(self.max_backoff, self.backoff * 2 ** attempt))
+
+    def request(self, url, headers=None):
+        """
+        GET `url` with retries and return the response (any 2xx or 304).
+        Raises DownloadError when the request keeps failing.
+        """
+        limiter = self.limiter(url)
+        last_error = None
+
+        for attempt in range(self.retries + 1):
+            if attempt:
+                time.sleep(self.backoff_delay(attempt - 1))
+            try:
+                with limiter:
+                    response = self.session().get(url, headers=headers, timeout=self.timeout)
+            except (requests.ConnectionError, requests.Timeout) as e:
+                last_error = e
+                continue
+
+            if response.status_code in RETRY_STATUSES:
+                last_error = DownloadError(f"HTTP {response.status_code} from {url}")
+                delay = retry_after_seconds(response)
+                if delay is not None:
+                    limiter.pause(min(delay, self.max_backoff))
+                continue
+            if response.status_code == 304 or response.ok:
+                return response
+            raise DownloadError(f"HTTP {response.status_code} from {url}")
+
+        raise DownloadError(f"Giving up on {url} after {self.retries + 1} attempts: {last_error}")
+
+    def fetch(self, url):
+        """Body of `url` as bytes"""
+        return self.request(url).content
+
+    def run(self, jobs, handle):
+        """
+        Call `handle(job)` for every job on the thread pool (handle typically
+        calls self.fetch) and yield (job, result, error) as each completes.
+        Exactly one of result / error is set. Only a few jobs per worker are
+        in flight at a time, so `jobs` can be a lazy iterator.
+        """
+        jobs = iter(jobs)
+        pending = {}
+        with ThreadPoolExecutor(max_workers=self.workers) as pool:
+            def submit(count):
+                for job in islice(jobs, count):
+                    pending[pool.submit(handle, job)] = job
+
+            submit(self.workers * 4)
+            while pending:
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    job = pending.pop(future)
+                    try:
+                        yield job, future.result(), None
+                    except Exception as e:
+                        yield job, None, e
+                submit(len(done))
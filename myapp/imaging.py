@@ -0,0 +1,139 @@
+# myapp/imaging.py
+"""
+Single-decode image pipeline. A downloaded original is decoded once at the
+lowest resolution that still covers the largest output (JPEG draft mode
+decodes at 1/2, 1/4 or 1/8 scale directly, then reduce() takes off any
+further whole factor), and every derivative is produced from that one bitmap:
+
+    <base>.jpg / <base>.webp              display size (the PlaceImage.local_path)
+    <base>_small.jpg / <base>_small.webp  smaller display size
+    <base>_analysis.png                   100x100 lossless buffer for color analysis
+
+All files are written to a temporary name and renamed into place, the
+display JPEG last: once it exists, every other derivative does too.
+"""
+import os
+import tempfile
+from io import BytesIO
+
+import numpy as np
+from PIL import Image
+
+DISPLAY_SIZE = (300, 300)
+# Extra display sizes, as (filename suffix, size)
+EXTRA_SIZES = [('_small', (150, 150))]
+ANALYSIS_SIZE = (100, 100)
+ANALYSIS_SUFFIX = '_analysis.png'
+WEBP_QUALITY = 75
+
+
+def open_reduced(source, size):
+    """
+    Open image bytes (or a file) decoded at no less than `size`, converted to
+    RGB. For JPEGs the decoder itself skips the full-resolution pass; any
+    format is then shrunk by the largest whole factor that keeps `size`.
+    """
+    image = Image.open(BytesIO(source) if isinstance(source, (bytes, bytearray)) else source)
+    if image.format == 'JPEG':
+        image.draft('RGB', size)
+    image = image.convert("RGB")
+    factor = min(image.width // size[0], image.height // size[1])
+    return image.reduce(factor) if factor > 1 else image
+
+
+def resize(image, size):
+    """LANCZOS resize to exactly `size`, shrinking by integer reduce() steps first when it is much larger"""
+    if image.size == size:
+        return image
+    return image.resize(size, Image.Resampling.LANCZOS, reducing_gap=3.0)
+
+
+def atomic_save(image, path, format, **params):
+    """Write an image to a temporary file in the target directory, then rename it into place"""
+    directory = os.path.dirname(path) or '.'
+    os.makedirs(directory, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=directory, suffix=os.path.splitext(path)[1])
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            image.save(f, format=format, **params)
+        os.replace(tmp_path, path)
+    except Exception:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+
+def derivative_path(jpeg_path, suffix='', extension='.jpg'):
+    """Path of a derivative next to a display JPEG (works for absolute and MEDIA_ROOT-relative paths)"""
+    return os.path.splitext(jpeg_path)[0] + suffix + extension
+
+
+def analysis_path(jpeg_path):
+    return os.path.splitext(jpeg_path)[0] + ANALYSIS_SUFFIX
+
+
+def is_derivative(filename):
+    """True for the WebP, smaller and analysis files written next to a display JPEG"""
+    stem, extension = os.path.splitext(filename)
+    if extension == '.webp' or filename.endswith(ANALYSIS_SUFFIX):
+        return True
+    return extension == '.jpg' and any(stem.endswith(suffix) for suffix, _ in EXTRA_SIZES)
+
+
+def save_derivatives(source, base_path, size=DISPLAY_SIZE, quality=75):
+    """
+    Decode `source` once and write every derivative under `base_path`
+    (a path without extension). Returns the display JPEG path and the
+    analysis buffer as a (100, 100, 3) uint8 array.
+    """
+    largest = (max([size[0]] + [s[0] for _, s in EXTRA_SIZES]), max([size[1]] + [s[1] for _, s in EXTRA_SIZES]))
+    image = open_reduced(source, largest)
+
+    # Largest first; each smaller size is resized from the display image
+    display = resize(image, size)
+    outputs = [('', display)] + [(suffix, resize(display, extra)) for suffix, extra in EXTRA_SIZES]
+
+    jpeg_path = base_path + '.jpg'
+    for suffix, derivative in outputs:
+        if suffix:
+            atomic_save(derivative, base_path + suffix + '.jpg', 'JPEG', quality=quality)
+        atomic_save(derivative, base_path + suffix + '.webp', 'WEBP', quality=WEBP_QUALITY)
+
+    analysis = resize(display, ANALYSIS_SIZE)
+    atomic_save(analysis, base_path + ANALYSIS_SUFFIX, 'PNG')
+    # Last, so an interrupted run never leaves a display JPEG without its derivatives
+    atomic_save(display, jpeg_path, 'JPEG', quality=quality)
+    return jpeg_path, np.asarray(analysis)
+
+
+def load_analysis_pixels(jpeg_path):
+    """
+    The 100x100 RGB analysis buffer of a display JPEG as an (N, 3) array,
+    read from its saved buffer when present, else resized from the JPEG.
+    """
+    path = analysis_path(jpeg_path)
+    if os.path.exists(path):
+        with Image.open(path) as image:
+            return np.asarray(image.convert("RGB")).reshape(-1, 3)
+    with Image.open(jpeg_path) as image:
+        return np.asarray(image.convert("RGB").resize(ANALYSIS_SIZE)).reshape(-1, 3)
+
+
+def derivative_paths(jpeg_path):
+    """A display JPEG and every derivative save_derivatives writes next to it"""
+    paths = [jpeg_path, derivative_path(jpeg_path, extension='.webp'), analysis_path(jpeg_path)]
+    for suffix, _ in EXTRA_SIZES:
+        paths += [derivative_path(jpeg_path, suffix), derivative_path(jpeg_path, suffix, '.webp')]
+    return paths
+
+
+def remove_derivatives(jpeg_path):
+    """Delete a display JPEG and every derivative written next to it"""
+    removed = 0
+    for path in derivative_paths(jpeg_path):
+        try:
+            os.remove(path)
+            removed += 1
+        except FileNotFoundError:
+            pass
+    return removed
@@ -0,0 +1,485 @@
+# myapp/importer.py
+"""
+Set-based importer for the tourism CSV. Rows are parsed into chunks; each
+chunk resolves the cities, categories, places, images and place/category
+links it mentions with one query per model, inserts whatever is missing with
+bulk_create and commits as a single transaction.
+
+`stream_import` reads a plain or gzip-compressed file in a single pass and
+records a checkpoint (byte offset, rows and counters) after every committed
+chunk, so an interrupted import can resume where it stopped. Re-importing a
+chunk whose commit landed but whose checkpoint did not is harmless, because
+the importer only adds what is missing.
+
+`UpsertImporter` diffs the file against the database instead of importing
+into an empty one: every place keeps a hash of its normalized row, rows whose
+hash is unchanged are skipped, changed places are updated in bulk and places
+no longer in the file are deleted. The ids it touched are recorded for the
+jobs downstream (similarities, PageRank).
+"""
+import csv
+import gzip
+import hashlib
+import json
+import os
+import tempfile
+from collections import Counter
+
+from django.db import transaction
+
+from myapp.models import City, Place, Category, PlaceImage, PlaceCategory
+
+# Keeps IN (...) lists under SQLite's bound-parameter limit
+LOOKUP_BATCH = 900
+
+
+def safe_int(value):
+    """Convert value to int safely"""
+    try:
+        return int(value) if value else None
+    except (ValueError, TypeError):
+        return None
+
+
+def safe_float(value):
+    """Convert value to float safely"""
+    try:
+        return float(value) if value else 0.0
+    except (ValueError, TypeError):
+        return 0.0
+
+
+# Place field -> CSV column, for the integer columns
+INT_COLUMNS = {
+    'page_views': 'Page Views',
+    'number_of_categories': 'Number of Categories',
+    'number_of_languages': 'Number of Languages',
+    'number_of_references': 'Number of References',
+    'number_of_sections': 'Number of Sections',
+    'number_of_links': 'Number of Links',
+    'number_of_images': 'Number of Images',
+    'number_of_external_links': 'Number of External Links',
+    'page_length': 'Page Length',
+    'linkshere': 'linkshere',
+    'total_links': 'total_links',
+    'revision_count': 'revision_count',
+    'language_links': 'language_links',
+    'category_count': 'category_count',
+}
+
+
+def place_fields(row, name):
+    """
+    Place field values of one CSV row. relevance_score is not among them:
+    calculate_pagerank owns it once a place exists, see initial_score.
+    """
+    fields = {
+        'wikipedia_link': row.get('Link', ''),
+        'title': name,
+    }
+    for field, column in INT_COLUMNS.items():
+        fields[field] = safe_int(row.get(column))
+    return fields
+
+
+def initial_score(row):
+    """relevance_score of a place created from this row, until PageRank replaces it"""
+    return safe_float(row.get('pagerank_score') or row.get('relevance_score') or 0)
+
+
+def parse_row(row):
+    """
+    (record, problem) for one CSV row. record holds the city and place
+    names, the place fields, the initial relevance score, the image URL and
+    the category names; it is None when the row has to be skipped, and
+    problem says why.
+    """
+    city_name = (row.get('City') or '').strip()
+    if not city_name:
+        return None, "Missing city name"
+    name = (row.get('Title') or '').strip()
+    if not name:
+        return None, "Missing place name"
+
+    categories = []
+    for category_name in (row.get('categories') or '').split(','):
+        category_name = category_name.strip()
+        if category_name and category_name not in categories:
+            categories.append(category_name)
+
+    return {
+        'city': city_name,
+        'name': name,
+        'fields': place_fields(row, name),
+        'relevance_score': initial_score(row),
+        'image_url': (row.get('Image link') or '').strip(),
+        'categories': categories,
+    }, None
+
+
+def in_batches(values, size=LOOKUP_BATCH):
+    values = list(values)
+    for start in range(0, len(values), size):
+        yield values[start:start + size]
+
+
+def record_hash(record):
+    """Hash of everything an update sets on a place: fields, image URL and categories"""
+    payload = json.dumps([record['fields'], record['image_url'], sorted(record['categories'])],
+                         sort_keys=True, ensure_ascii=False)
+    return hashlib.sha1(payload.encode('utf-8')).hexdigest()
+
+
+class Importer:
+    """
+    Imports parsed CSV rows chunk by chunk. Existing cities, categories,
+    places (by name and city), images (by place and URL) and place/category
+    links are reused, like the get_or_create calls this replaces, so re-running
+    an import only adds what is new.
+
+    `local_path_for(place_id, place_name)` may return a local_path for new
+    images. `warn(message)` receives skipped-row messages.
+    """
+
+    def __init__(self, chunk_size=5000, local_path_for=None, warn=None):
+        self.chunk_size = chunk_size
+        self.local_path_for = local_path_for
+        self.warn = warn or (lambda message: None)
+        self.cities = {}
+        self.categories = {}
+        self.counts = Counter()
+
+    def run(self, rows, on_chunk=None, start_row=0):
+        """
+        Import an iterable of CSV row dicts (data rows only; `start_row` is
+        the index of the first one, 0 being file line 2). `on_chunk(rows_done)`
+        is called after each commit. Returns the counters.
+        """
+        chunk = []
+        rows_done = start_row
+        for i, row in enumerate(rows, start_row):
+            record, problem = parse_row(row)
+            if record is None:
+                self.warn(f"Row {i + 2}: {problem}, skipping")
+                self.counts['skipped'] += 1
+            else:
+                chunk.append(record)
+            rows_done = i + 1
+
+            if len(chunk) >= self.chunk_size:
+                self.import_chunk(chunk)
+                chunk = []
+                if on_chunk:
+                    on_chunk(rows_done)
+
+        if chunk:
+            self.import_chunk(chunk)
+        if on_chunk:
+            on_chunk(rows_done)
+        return self.counts
+
+    def import_chunk(self, records):
+        """Resolve and insert everything one chunk of records refers to, in one transaction"""
+        with transaction.atomic():
+            self._resolve_names(City, self.cities, {r['city'] for r in records}, 'cities')
+            self._resolve_names(Category, self.categories,
+                                {name for r in records for name in r['categories']}, 'categories')
+            places = self._resolve_places(records)
+            self._add_images(records, places)
+            self._add_place_categories(records, places)
+
+    def _resolve_names(self, model, cache, names, counter):
+        """Fill `cache` (name -> id) for `names`, creating the missing rows"""
+        missing = names - cache.keys()
+        for batch in in_batches(missing):
+            for pk, name in model.objects.filter(name__in=batch).order_by('-pk').values_list('pk', 'name'):
+                cache[name] = pk  # lowest pk wins, like get_or_create's first match
+        new = [model(name=name) for name in sorted(missing - cache.keys())]
+        for obj in model.objects.bulk_create(new):
+            cache[obj.name] = obj.pk
+        self.counts[counter] += len(new)
+
+    def _resolve_places(self, records):
+        """(name, city_id) -> place id for every record, creating the missing places"""
+        keys = {(r['name'], self.cities[r['city']]) for r in records}
+        places = {}
+        for batch in in_batches({name for name, _ in keys}):
+            for pk, name, city_id in (Place.objects.filter(name__in=batch).order_by('-pk')
+                                      .values_list('pk', 'name', 'city_id')):
+                if (name, city_id) in keys:
+                    places[(name, city_id)] = pk
+
+        new = {}
+        for r in records:
+            key = (r['name'], self.cities[r['city']])
+            if key not in places and key not in new:
+                # The first row of a place supplies its fields
+                new[key] = Place(name=key[0], city_id=key[1], source_hash=record_hash(r),
+                                 relevance_score=r['relevance_score'], **r['fields'])
+        for place in Place.objects.bulk_create(list(new.values())):
+            places[(place.name, place.city_id)] = place.pk
+        self.counts['places'] += len(new)
+        return places
+
+    def _add_images(self, records, places):
+        wanted = {}
+        for r in records:
+            if r['image_url']:
+                place_id = places[(r['name'], self.cities[r['city']])]
+                wanted.setdefault((place_id, r['image_url']), r['name'])
+        if not wanted:
+            return
+
+        existing = set()
+        for batch in in_batches({place_id for place_id, _ in wanted}):
+            existing.update(PlaceImage.objects.filter(place_id__in=batch).values_list('place_id', 'image_url'))
+
+        new = []
+        for (place_id, image_url), name in wanted.items():
+            if (place_id, image_url) in existing:
+                continue
+            local_path = self.local_path_for(place_id, name) if self.local_path_for else ''
+            new.append(PlaceImage(place_id=place_id, image_url=image_url, is_primary=True,  # First image is primary
+                                  local_path=local_path or ''))
+        PlaceImage.objects.bulk_create(new)
+        self.counts['images'] += len(new)
+
+    def _add_place_categories(self, records, places):
+        links = {
+            (places[(r['name'], self.cities[r['city']])], self.categories[name])
+            for r in records for name in r['categories']
+        }
+        # unique_together makes existing links no-ops
+        PlaceCategory.objects.bulk_create(
+            [PlaceCategory(place_id=place_id, category_id=category_id) for place_id, category_id in links],
+            ignore_conflicts=True, batch_size=5000,
+        )
+
+
+# relevance_score is left out: updating a place must not undo its computed PageRank
+PLACE_UPDATE_FIELDS = ['wikipedia_link', 'title', *INT_COLUMNS, 'source_hash']
+
+
+class UpsertImporter(Importer):
+    """
+    Brings the database in line with a CSV file while leaving unchanged
+    places alone. A place is defined by the first row of its (name, city);
+    later duplicates are skipped. For a changed place the fields are
+    rewritten, its images are reduced to the row's image URL (a downloaded
+    image is kept if the URL is the same) and its category links are
+    replaced. `finish()` deletes the places the file no longer has.
+
+    `created`, `updated` and `deleted` collect the affected place ids.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.seen = set()
+        self.created = []
+        self.updated = []
+        self.deleted = []
+
+    def import_chunk(self, records):
+        with transaction.atomic():
+            self._resolve_names(City, self.cities, {r['city'] for r in records}, 'cities')
+            self._resolve_names(Category, self.categories,
+                                {name for r in records for name in r['categories']}, 'categories')
+
+            firsts = {}
+            for r in records:
+                firsts.setdefault((r['name'], self.cities[r['city']]), r)
+            self.counts['duplicates'] += len(records) - len(firsts)
+            existing = self._existing_places(firsts.keys())
+
+            new, changed = {}, {}
+            places = {}
+            for key, r in firsts.items():
+                source_hash = record_hash(r)
+                if key not in existing:
+                    new[key] = Place(name=key[0], city_id=key[1], source_hash=source_hash,
+                                     relevance_score=r['relevance_score'], **r['fields'])
+                    continue
+                pk, stored_hash = existing[key]
+                if pk in self.seen:
+                    self.counts['duplicates'] += 1
+                    continue
+                self.seen.add(pk)
+                places[key] = pk
+                if stored_hash == source_hash:
+                    self.counts['unchanged'] += 1
+                else:
+                    changed[pk] = (r, source_hash)
+
+            for place in Place.objects.bulk_create(list(new.values())):
+                places[(place.name, place.city_id)] = place.pk
+                self.seen.add(place.pk)
+                self.created.append(place.pk)
+            self.counts['places'] += len(new)
+
+            self._update_places(changed)
+
+            touched = [r for key, r in firsts.items() if key in new or places.get(key) in changed]
+            self._add_images(touched, places)
+            self._add_place_categories(touched, places)
+
+    def _existing_places(self, keys):
+        """(name, city_id) -> (place id, source_hash) for the keys already in the database"""
+        existing = {}
+        for batch in in_batches({name for name, _ in keys}):
+            for pk, name, city_id, source_hash in (Place.objects.filter(name__in=batch).order_by('-pk')
+                                                   .values_list('pk', 'name', 'city_id', 'source_hash')):
+                if (name, city_id) in keys:
+                    existing[(name, city_id)] = (pk, source_hash)  # lowest pk wins
+        return existing
+
+    def _update_places(self, changed):
+        """Rewrite the fields of changed places and drop the images and links their rows no longer have"""
+        if not changed:
+            return
+        places = [Place(pk=pk, source_hash=source_hash, **r['fields']) for pk, (r, source_hash) in changed.items()]
+        Place.objects.bulk_update(places, PLACE_UPDATE_FIELDS)
+
+        for batch in in_batches(changed):
+            stale = [pk for pk, place_id, image_url in
+                     PlaceImage.objects.filter(place_id__in=batch).values_list('pk', 'place_id', 'image_url')
+                     if image_url != changed[place_id][0]['image_url']]
+            for stale_batch in in_batches(stale):
+                PlaceImage.objects.filter(pk__in=stale_batch).delete()
+            PlaceCategory.objects.filter(place_id__in=batch).delete()
+
+        self.updated.extend(changed)
+        self.counts['updated'] += len(changed)
+
+    def finish(self):
+        """Delete the places that were not in the file; returns how many"""
+        missing = sorted(set(Place.objects.values_list('pk', flat=True)) - self.seen)
+        with transaction.atomic():
+            for batch in in_batches(missing):
+                Place.objects.filter(pk__in=batch).delete()
+        self.deleted.extend(missing)
+        self.counts['deleted'] += len(missing)
+        return len(missing)
+
+    def changed_ids(self):
+        return {'created': self.created, 'updated': self.updated, 'deleted': self.deleted}
+
+
+GZIP_MAGIC = b'\x1f\x8b'
+
+
+class CheckpointError(Exception):
+    """A checkpoint does not belong to the file being imported"""
+
+
+class CsvStream:
+    """
+    Single pass over a plain or gzip-compressed CSV file, yielding row dicts.
+    `offset` is the (uncompressed) byte offset just past the last row
+    yielded, so a later stream can start there; `progress()` is the fraction
+    of the file on disk read so far.
+    """
+
+    def __init__(self, path, delimiter=';', offset=0, fieldnames=None, encoding='utf-8'):
+        self.delimiter = delimiter
+        self.encoding = encoding
+        self.raw = open(path, 'rb')
+        self.size = os.fstat(self.raw.fileno()).st_size
+        self.compressed = self.raw.read(2) == GZIP_MAGIC
+        self.raw.seek(0)
+        self.file = gzip.GzipFile(fileobj=self.raw) if self.compressed else self.raw
+        self.offset = 0
+
+        if fieldnames is None:
+            self.fieldnames = next(csv.reader(self._lines(), delimiter=delimiter))
+        else:
+            # Forward seeks in a gzip stream decompress up to the offset without parsing
+            self.file.seek(offset)
+            self.offset = offset
+            self.fieldnames = fieldnames
+
+    def _lines(self):
+        for line in self.file:
+            self.offset += len(line)
+            yield line.decode(self.encoding)
+
+    def __iter__(self):
+        return csv.DictReader(self._lines(), fieldnames=self.fieldnames, delimiter=self.delimiter)
+
+    def progress(self):
+        return self.raw.tell() / self.size if self.size else 1.0
+
+    def close(self):
+        if self.compressed:
+            self.file.close()
+        self.raw.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def file_identity(path):
+    """What a checkpoint must match to be resumed: absolute path, size and mtime"""
+    stat = os.stat(path)
+    return {'file': os.path.abspath(path), 'size': stat.st_size, 'mtime': stat.st_mtime}
+
+
+def read_checkpoint(path):
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def write_json(path, state):
+    """Write a checkpoint (or any JSON state) durably: temp file, fsync, rename"""
+    directory = os.path.dirname(os.path.abspath(path))
+    os.makedirs(directory, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=directory, suffix='.json')
+    with os.fdopen(fd, 'w') as f:
+        json.dump(state, f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+
+def stream_import(importer, csv_path, checkpoint_path, resume=False, on_progress=None):
+    """
+    Import `csv_path` in one pass, checkpointing after every committed chunk.
+    With `resume`, continue from the checkpoint if there is one (raises
+    CheckpointError if it was written for a different file). The checkpoint
+    is removed once the import completes; with no `checkpoint_path` none is
+    written. `on_progress(rows, fraction)` is called after each chunk.
+    Returns the counters, including resumed ones.
+    """
+    identity = file_identity(csv_path)
+    state = read_checkpoint(checkpoint_path) if resume else None
+    if state is not None:
+        if {key: state.get(key) for key in identity} != identity:
+            raise CheckpointError(f"Checkpoint {checkpoint_path} was written for {state.get('file')}, "
+                                  f"not this version of {csv_path}")
+        importer.counts.update(state['counts'])
+        stream = CsvStream(csv_path, offset=state['offset'], fieldnames=state['fieldnames'])
+        rows_before = state['rows']
+    else:
+        stream = CsvStream(csv_path)
+        rows_before = 0
+
+    def on_chunk(rows_done):
+        if checkpoint_path:
+            write_json(checkpoint_path, dict(
+                identity, offset=stream.offset, fieldnames=stream.fieldnames,
+                rows=rows_done, counts=dict(importer.counts),
+            ))
+        if on_progress:
+            on_progress(rows_done, stream.progress())
+
+    with stream:
+        counts = importer.run(stream, on_chunk=on_chunk, start_row=rows_before)
+
+    if checkpoint_path:
+        os.remove(checkpoint_path)
+    return counts
@@ -0,0 +1,58 @@
+# myapp/management/commands/build_color_index.py
+import numpy as np
+from django.core.management.base import BaseCommand
+from myapp.models import Place
+from myapp.color_index import ColorIndex, build_index, add_places, index_path
+
+class Command(BaseCommand):
+    help = 'Build or update the approximate nearest neighbour index over place color vectors'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--nlist', type=int, default=None,
+                           help='Number of inverted lists (default: sqrt of the number of places)')
+        parser.add_argument('--add-missing', action='store_true',
+                           help='Insert places that are not in the existing index instead of rebuilding it')
+        parser.add_argument('--benchmark', action='store_true',
+                           help='Report recall and query latency against exact search')
+        parser.add_argument('--queries', type=int, default=200,
+                           help='Number of benchmark queries (default: 200)')
+        parser.add_argument('--k', type=int, default=3,
+                           help='Neighbours per benchmark query (default: 3)')
+        parser.add_argument('--nprobe', type=int, default=8,
+                           help='Inverted lists scanned per query (default: 8)')
+
+    def handle(self, *args, **options):
+        path = index_path()
+
+        if options['add_missing']:
+            try:
+                index = ColorIndex.load(path)
+            except OSError:
+                self.stdout.write(self.style.ERROR(f"No index found at {path}, build it first"))
+                return
+            
+            # Diffed in NumPy: an exclude(id__in=...) would bind one parameter per indexed place
+            places = np.array(Place.objects.order_by('id').values_list('id', 'city_id'), dtype=np.int64).reshape(-1, 2)
+            missing = np.setdiff1d(places[:, 0], index.place_ids)
+            cities = places[np.searchsorted(places[:, 0], missing), 1]
+            added = add_places(index, missing, cities)
+            self.stdout.write(f"Added {added} places to the index")
+        else:
+            self.stdout.write("Building color index...")
+            index = build_index(nlist=options['nlist'])
+            if not len(index):
+                self.stdout.write(self.style.WARNING(
+                    "No places have color vectors yet; saving an empty index, --add-missing trains it later"
+                ))
+            self.stdout.write(f"Indexed {len(index)} places in {len(index.centroids)} lists")
+        
+        index.save(path)
+        self.stdout.write(self.style.SUCCESS(f"Saved color index to {path}"))
+        
+        if options['benchmark'] and len(index) > 1:
+            result = index.benchmark(queries=options['queries'], k=options['k'], nprobe=options['nprobe'])
+            self.stdout.write(
+                f"Benchmark ({result['queries']} queries, k={options['k']}, nprobe={options['nprobe']}): "
+                f"recall={result['recall']:.3f}, "
+                f"approx={result['approx_ms']:.3f} ms/query, exact={result['exact_ms']:.3f} ms/query"
+            )
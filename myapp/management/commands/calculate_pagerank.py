@@ -1,27 +1,48 @@
-# myapp/management/commands/calculate_enhanced_pagerank.py
-import numpy as np
+# myapp/management/commands/calculate_pagerank.py
+import json
+import time
 from django.core.management.base import BaseCommand
-from django.db.models import Max
-from myapp.models import Place, Category, PlaceCategory
+from django.db import transaction
+from myapp.models import Place
+import numpy as np
+from myapp.pagerank import (
+    load_graph, popularity_counts, popularity_vectors, category_signatures, solve, local_update, solution_state,
+    update_parameters, scale_scores, save_vector, load_start_vector, load_state,
+    PersonalizedPageRank, DAMPING, PAGEVIEW_WEIGHT, LANGUAGE_WEIGHT, SOLVERS,
+)
 
 class Command(BaseCommand):
     help = 'Calculate enhanced PageRank scores incorporating popularity metrics'
 
     def add_arguments(self, parser):
-        parser.add_argument('--damping', type=float, default=0.85,
+        parser.add_argument('--damping', type=float, default=DAMPING,
                             help='Damping factor (default: 0.85)')
         parser.add_argument('--iterations', type=int, default=100,
                             help='Maximum number of iterations (default: 100)')
         parser.add_argument('--tolerance', type=float, default=0.0001,
                             help='Convergence tolerance (default: 0.0001)')
-        parser.add_argument('--pageview-weight', type=float, default=0.3,
+        parser.add_argument('--pageview-weight', type=float, default=PAGEVIEW_WEIGHT,
                             help='Weight for page view influence (default: 0.3)')
-        parser.add_argument('--language-weight', type=float, default=0.2,
+        parser.add_argument('--language-weight', type=float, default=LANGUAGE_WEIGHT,
                             help='Weight for language count influence (default: 0.2)')
         parser.add_argument('--min-score', type=float, default=0.1,
-                            help='Minimum final score (default: 0.1)')
+                            help='Score of the lowest ranked place (default: 0.1); scores are scaled linearly '
+                                 'between the lowest and highest ranked places, so when either of them moves '
+                                 'relative to the rest, every score changes and every row is written')
         parser.add_argument('--max-score', type=float, default=5.0,
-                            help='Maximum final score (default: 5.0)')
+                            help='Score of the highest ranked place (default: 5.0)')
+        parser.add_argument('--solver', choices=SOLVERS, default='power',
+                            help='power iteration (default), power iteration with quadratic extrapolation, or a GMRES linear solve')
+        parser.add_argument('--cold-start', action='store_true',
+                            help='Start from a uniform vector instead of the last converged one')
+        parser.add_argument('--benchmark', action='store_true',
+                            help='Compare iterations and time of every solver from cold and warm starts, without saving scores')
+        parser.add_argument('--incremental', action='store_true',
+                            help='Update the last converged solution by local residual pushes around new or changed '
+                                 'places; the global 1/n and popularity rescaling is applied exactly, not pushed')
+        parser.add_argument('--verify', action='store_true',
+                            help='With --incremental, compare against a full recompute; the run only counts as '
+                                 'converged if the L1 error is within the tolerance, otherwise the recompute is kept')
 
     def handle(self, *args, **options):
         damping = options['damping']
@@ -42,8 +63,11 @@ class Command(BaseCommand):
         self.stdout.write("Building enhanced PageRank model...")
         self.stdout.write(f"Weights: Connections={connection_weight:.2f}, PageViews={pageview_weight:.2f}, Languages={language_weight:.2f}")
         
-        # Get all places
-        places = list(Place.objects.all())
+        timings = {}
+        started = time.perf_counter()
+        
+        # Get all places (only the fields the model needs)
+        places = list(Place.objects.only('id', 'city_id', 'page_views', 'number_of_languages', 'relevance_score'))
         if not places:
             self.stdout.write(self.style.ERROR("No places found in database"))
             return
@@ -51,117 +75,180 @@ class Command(BaseCommand):
         n = len(places)
         self.stdout.write(f"Found {n} places")
         
-        # Create a mapping of place ID to index
-        place_indices = {place.id: i for i, place in enumerate(places)}
-        
-        # Get category data
-        place_categories = {}
-        for pc in PlaceCategory.objects.all():
-            if pc.place_id not in place_indices:
-                continue
-                
-            if pc.place_id not in place_categories:
-                place_categories[pc.place_id] = set()
-            place_categories[pc.place_id].add(pc.category_id)
-        
-        # Create adjacency matrix with weighted connections
-        M = np.zeros((n, n))
-        
-        # Populate the matrix
-        for i, place1 in enumerate(places):
-            for j, place2 in enumerate(places):
-                if i == j:  # No self-links
-                    continue
-                
-                weight = 0
-                
-                # Places in same city have a connection
-                if place1.city_id == place2.city_id:
-                    weight += 0.5
-                
-                # Category similarity
-                cats1 = place_categories.get(place1.id, set())
-                cats2 = place_categories.get(place2.id, set())
-                
-                if cats1 and cats2:
-                    # Jaccard similarity for categories
-                    similarity = len(cats1.intersection(cats2)) / len(cats1.union(cats2))
-                    weight += similarity * 0.5
-                
-                if weight > 0:
-                    M[i, j] = weight
-        
-        # Normalize the matrix so each row sums to 1
-        row_sums = M.sum(axis=1)
-        for i in range(n):
-            if row_sums[i] > 0:
-                M[i] = M[i] / row_sums[i]
-        
-        # Get popularity metrics
-        max_page_views = max(place.page_views or 0 for place in places)
-        max_languages = max(place.number_of_languages or 0 for place in places)
-        
-        if max_page_views == 0:
-            max_page_views = 1  # Avoid division by zero
-        if max_languages == 0:
-            max_languages = 1  # Avoid division by zero
+        timings['load'] = time.perf_counter() - started
+        
+        # Sparse place graph: same-city links plus category Jaccard links
+        started = time.perf_counter()
+        graph = load_graph(places)
+        timings['graph'] = time.perf_counter() - started
+        self.stdout.write(f"Graph has {graph.jaccard.nnz} category links across {len(graph.city_sizes)} cities")
         
         # Create popularity vectors (normalized)
-        page_view_vector = np.array([(place.page_views or 0) / max_page_views for place in places])
-        language_vector = np.array([(place.number_of_languages or 0) / max_languages for place in places])
-        
-        # Make sure vectors sum to 1 for proper weighting
-        if page_view_vector.sum() > 0:
-            page_view_vector = page_view_vector / page_view_vector.sum()
-        if language_vector.sum() > 0:
-            language_vector = language_vector / language_vector.sum()
-        
-        # Initialize PageRank vector
-        pagerank = np.ones(n) / n
-        
-        # Power iteration method with added popularity influence
-        for iteration in range(max_iterations):
-            # Standard PageRank calculation (weighted by connection_weight)
-            connection_influence = M.T.dot(pagerank)
-            
-            # Combined calculation with popularity metrics
-            new_pagerank = (1 - damping) / n + damping * (
-                connection_weight * connection_influence +
-                pageview_weight * page_view_vector + 
-                language_weight * language_vector
-            )
-            
-            # Normalize to ensure sum=1
-            new_pagerank = new_pagerank / new_pagerank.sum()
-            
-            # Check convergence
-            diff = np.linalg.norm(new_pagerank - pagerank)
-            pagerank = new_pagerank
-            
+        page_view_vector, language_vector = popularity_vectors(places)
+        bias = pageview_weight * page_view_vector + language_weight * language_vector
+        page_views, languages = popularity_counts(places)
+        
+        def report(iteration, diff):
             if iteration % 10 == 0 or diff < tolerance:
                 self.stdout.write(f"Iteration {iteration}: change = {diff:.6f}")
-            
-            if diff < tolerance:
-                self.stdout.write(self.style.SUCCESS(f"Converged after {iteration+1} iterations"))
-                break
-        else:
-            self.stdout.write(self.style.WARNING(f"Reached maximum iterations ({max_iterations}) without convergence"))
         
-        # Scale scores to desired range
-        min_raw = pagerank.min()
-        max_raw = pagerank.max()
+        solver_options = {
+            'damping': damping,
+            'connection_weight': connection_weight,
+            'max_iterations': max_iterations,
+            'tolerance': tolerance,
+        }
         
-        # Avoid division by zero if all scores are identical
-        if max_raw == min_raw:
-            scaled_scores = np.ones(n) * ((min_score + max_score) / 2)
-        else:
-            scaled_scores = min_score + (pagerank - min_raw) * (max_score - min_score) / (max_raw - min_raw)
+        # Start from the last converged vector when there is one
+        place_ids = [place.id for place in places]
+        start = None if options['cold_start'] else load_start_vector(place_ids)
         
-        # Update database with PageRank scores
-        for i, place in enumerate(places):
-            place.relevance_score = round(float(scaled_scores[i]), 2)
-            place.save()
-            
-            self.stdout.write(f"Updated {place.name}: {place.relevance_score}")
+        if options['benchmark']:
+            self.benchmark(graph, bias, start, solver_options)
+            return
         
-        self.stdout.write(self.style.SUCCESS(f"Successfully updated enhanced PageRank scores for {n} places"))
\ No newline at end of file
+        # Category sets are compared by hash to find the places an update has to revisit
+        signatures = category_signatures(place_ids)
+        model = {'damping': damping, 'pageview_weight': pageview_weight, 'language_weight': language_weight}
+        state = None
+        if options['incremental'] and not options['cold_start']:
+            state = load_state(update_parameters(graph, damping, pageview_weight, language_weight))
+        incremental = state is not None
+        if options['incremental'] and not incremental:
+            self.stdout.write(self.style.WARNING(
+                "No saved PageRank solution for these settings to update, running a full computation"
+            ))
+        
+        started = time.perf_counter()
+        push_stats = None
+        new_state = None
+        if incremental:
+            self.stdout.write("Solver: local push from the last saved solution")
+            pagerank, new_state, push_stats = local_update(
+                graph, page_views, languages, signatures, state, tolerance=tolerance, **model
+            )
+            iterations = push_stats['rounds']
+            diff = push_stats['error_bound']
+            converged = push_stats['converged']
+            self.stdout.write(
+                f"Residuals recomputed for {push_stats['rows']} places; {push_stats['rounds']} push rounds "
+                f"({push_stats['pushes']} pushes) touched {push_stats['touched']} of {n} places, "
+                f"L1 error bound {push_stats['error_bound']:.2e}"
+            )
+            if not converged:
+                # Never save a vector the push gave up on as the next warm start
+                self.stdout.write(self.style.WARNING("Local push hit its round limit, finishing with power iteration"))
+                pagerank, more, diff, converged = solve(
+                    graph, bias, 'power', start=pagerank, on_iteration=report, **solver_options
+                )
+                iterations += more
+                new_state = None
+        else:
+            self.stdout.write(f"Solver: {options['solver']} ({'warm' if start is not None else 'cold'} start)")
+            pagerank, iterations, diff, converged = solve(
+                graph, bias, options['solver'], start=start, on_iteration=report, **solver_options
+            )
+            if converged:
+                self.stdout.write(self.style.SUCCESS(f"Converged after {iterations} iterations"))
+            else:
+                self.stdout.write(self.style.WARNING(f"Reached maximum iterations ({max_iterations}) without convergence"))
+        timings['iterate'] = time.perf_counter() - started
+        
+        verified_error = None
+        if incremental and options['verify']:
+            reference, verified_error = self.verify(graph, bias, pagerank, solver_options, min_score, max_score)
+            converged = verified_error <= tolerance
+            if not converged:
+                self.stdout.write(self.style.WARNING(
+                    f"Incremental result is {verified_error:.2e} (L1) from the recompute, above the "
+                    f"tolerance; keeping the recompute"
+                ))
+                pagerank = reference
+                new_state = None
+        if new_state is None:
+            # Split the solution by base part so the next --incremental run can rescale it
+            pagerank, new_state = solution_state(graph, page_views, languages, signatures, pagerank,
+                                                 tolerance=tolerance, **model)
+        save_vector(place_ids, pagerank, state=new_state)
+        
+        # Web processes load the personalized ranker from disk instead of building it in a request
+        started = time.perf_counter()
+        PersonalizedPageRank.from_places(
+            places, graph=graph, global_vector=pagerank, damping=damping,
+            pageview_weight=pageview_weight, language_weight=language_weight
+        ).save()
+        timings['ranker'] = time.perf_counter() - started
+        
+        # Scale scores to desired range
+        scaled_scores = scale_scores(pagerank, min_score, max_score)
+        
+        # Update database with PageRank scores in one transaction, skipping places whose rounded
+        # score is unchanged. That only saves writes while the min-max scaling keeps its anchors:
+        # a new top or bottom place changes every score and rewrites every row
+        started = time.perf_counter()
+        changed = []
+        for place, score in zip(places, scaled_scores.tolist()):
+            score = round(score, 2)
+            if place.relevance_score != score:
+                place.relevance_score = score
+                changed.append(place)
+        
+        with transaction.atomic():
+            Place.objects.bulk_update(changed, ['relevance_score'], batch_size=1000)
+        timings['write'] = time.perf_counter() - started
+        
+        # One machine-readable line for logs and monitoring
+        summary = {
+            'places': n,
+            'category_links': int(graph.jaccard.nnz),
+            'solver': 'local-push' if incremental else options['solver'],
+            'warm_start': start is not None,
+            'iterations': iterations,
+            'residual': float(diff),
+            'converged': converged,
+            'verified_error': verified_error,
+            'rows_written': len(changed),
+            'incremental': incremental,
+            'touched': push_stats['touched'] if push_stats else n,
+            'seconds': {phase: round(seconds, 4) for phase, seconds in timings.items()},
+        }
+        self.stdout.write(json.dumps(summary))
+        
+        self.stdout.write(self.style.SUCCESS(f"Successfully updated enhanced PageRank scores for {n} places"))
+    
+    def verify(self, graph, bias, pagerank, solver_options, min_score, max_score):
+        """
+        Report how far the incremental vector is from a tightly converged full
+        recompute; returns (reference vector, L1 error)
+        """
+        full_options = dict(solver_options, tolerance=1e-12, max_iterations=max(solver_options['max_iterations'], 1000))
+        reference, *_ = solve(graph, bias, 'power', **full_options)
+        
+        error = float(np.abs(pagerank - reference).sum())
+        scores = np.round(scale_scores(pagerank, min_score, max_score), 2)
+        reference_scores = np.round(scale_scores(reference, min_score, max_score), 2)
+        self.stdout.write(
+            f"Verify: L1 error {error:.2e}, "
+            f"max score difference {np.abs(scores - reference_scores).max():.2f}, "
+            f"{int((scores != reference_scores).sum())} of {len(scores)} rounded scores differ"
+        )
+        return reference, error
+    
+    def benchmark(self, graph, bias, start, solver_options):
+        """Print iterations, wall time and distance to the power-iteration result for each solver"""
+        reference = None
+        starts = [('cold', None)] + ([('warm', start)] if start is not None else [])
+        
+        self.stdout.write(f"{'solver':<14}{'start':<6}{'iterations':>11}{'ms':>10}{'L1 vs power':>14}")
+        for label, start_vector in starts:
+            for solver in SOLVERS:
+                started = time.perf_counter()
+                vector, iterations, _, converged = solve(graph, bias, solver, start=start_vector, **solver_options)
+                elapsed = 1000 * (time.perf_counter() - started)
+                if reference is None:
+                    reference = vector
+                distance = np.abs(vector - reference).sum()
+                flag = '' if converged else ' (not converged)'
+                self.stdout.write(
+                    f"{solver:<14}{label:<6}{iterations:>11}{elapsed:>10.1f}{distance:>14.2e}{flag}"
+                )
\ No newline at end of file
@@ -1,11 +1,77 @@
 # myapp/management/commands/calculate_similarities.py
 import os
+from itertools import repeat
 import numpy as np
-import json
 from django.core.management.base import BaseCommand
 from django.db import transaction
-from myapp.models import Place, PlaceImage, PlaceCategory, SimilarPlace
-from mpi4py import MPI
+from myapp.models import PlaceFingerprint, SimilarPlace
+from myapp.similarity import (
+    load_catalog, make_families, plan_tiles, score_tile, reduce_top_k,
+    block_size_for, tile_side_for, changed_places, save_fingerprints, shortened_lists,
+    delete_similarities, stored_top_k_thresholds, SIMILARITY_TYPES, RESULT_DTYPE,
+)
+from myapp.parallel import run_tiles, run_matrix_rows, available_cores
+from myapp.score_matrix import MatrixWriter, fill_rows, MATRIX_DTYPES
+from myapp.writers import SimilarPlaceWriter
+
+try:
+    from mpi4py import MPI
+except ImportError:  # Fall back to the process-pool backend
+    MPI = None
+
+
+def bcast_array(comm, array, root=0):
+    """Broadcast a NumPy array as a raw buffer (only its dtype and shape are pickled)"""
+    if comm.Get_rank() == root:
+        array = np.ascontiguousarray(array)
+        meta = comm.bcast((array.dtype.str, array.shape), root=root)
+    else:
+        meta = comm.bcast(None, root=root)
+        array = np.empty(meta[1], dtype=meta[0])
+    comm.Bcast([array, MPI.BYTE], root=root)
+    return array
+
+
+# Records gathered per Gatherv round, across all processes: keeps the receive
+# buffer bounded and every count and displacement well inside the C int range
+GATHER_ROUND_RECORDS = 1 << 24
+
+
+def gather_records(comm, records, root=0):
+    """
+    Gather result records from every process with buffer-based Gatherv calls.
+    Counts are in records (a contiguous datatype of one record's size), and
+    large results are gathered in rounds of at most GATHER_ROUND_RECORDS.
+    """
+    records = np.ascontiguousarray(records, dtype=RESULT_DTYPE)
+    counts = comm.allgather(len(records))
+    is_root = comm.Get_rank() == root
+
+    per_process = max(1, GATHER_ROUND_RECORDS // comm.Get_size())
+    rounds = -(-max(counts) // per_process)
+    starts = np.concatenate([[0], np.cumsum(counts)])
+    gathered = np.empty(sum(counts), dtype=RESULT_DTYPE) if is_root else None
+
+    record_type = MPI.BYTE.Create_contiguous(RESULT_DTYPE.itemsize).Commit()
+    try:
+        for r in range(rounds):
+            offset = r * per_process
+            sizes = [min(max(count - offset, 0), per_process) for count in counts]
+            chunk = records[offset:offset + sizes[comm.Get_rank()]]
+            if not is_root:
+                comm.Gatherv([chunk, record_type], None, root=root)
+                continue
+
+            displacements = np.concatenate([[0], np.cumsum(sizes)[:-1]]).tolist()
+            received = np.empty(sum(sizes), dtype=RESULT_DTYPE)
+            comm.Gatherv([chunk, record_type], [received, sizes, displacements, record_type], root=root)
+            for i, size in enumerate(sizes):
+                start = starts[i] + offset
+                gathered[start:start + size] = received[displacements[i]:displacements[i] + size]
+    finally:
+        record_type.Free()
+    return gathered
+
 
 class Command(BaseCommand):
     help = 'Calculate similarities between places using parallel processing'
@@ -17,240 +83,300 @@ class Command(BaseCommand):
                            help='Calculate only structural similarities')
         parser.add_argument('--image-only', action='store_true',
                            help='Calculate only image-based similarities')
+        parser.add_argument('--top-k', type=int, default=None,
+                           help='Keep only the K best neighbours per place and similarity type (default: keep all pairs)')
+        parser.add_argument('--tile-memory-mb', type=int, default=256,
+                           help='Memory budget for one tile of the similarity matrix in MB (default: 256)')
+        parser.add_argument('--incremental', action='store_true',
+                           help='Recompute only places whose categories, colors or city changed since the last run')
+        parser.add_argument('--backend', choices=['mpi', 'processes'], default='mpi',
+                           help='Run under mpirun (default) or on a local process pool with shared memory')
+        parser.add_argument('--workers', type=int, default=None,
+                           help='Worker processes for the processes backend (default: available cores)')
+        parser.add_argument('--storage', choices=['database', 'matrix'], default='database',
+                           help='Store image similarities as SimilarPlace rows (default) or as a memory-mapped score matrix')
+        parser.add_argument('--matrix-dtype', choices=MATRIX_DTYPES, default='float16',
+                           help='Score encoding of the matrix storage (default: float16, lossless at 3 decimals)')
+
+    def _affected_rows(self, family, changed, place_index, top_k, tile_rows):
+        """
+        Rows whose top-K lists can change: the changed places themselves, lists
+        that contain one of them, lists a changed place now scores high enough
+        to enter, and lists that lost entries when a place was deleted. Lists
+        that are not full have a -inf threshold, so they are only recomputed
+        when a changed place becomes one of their candidates.
+        """
+        thresholds, counts, neighbours = stored_top_k_thresholds(family['types'], place_index, top_k)
+
+        affected = np.zeros(len(place_index), dtype=bool)
+        affected[changed] = True
+        # Deleting a place cascades to the rows listing it, leaving those lists short
+        affected[shortened_lists(family['job'], sum(counts.values()), place_index)] = True
+
+        changed_set = set(changed.tolist())
+        for row, columns in neighbours.items():
+            if not columns.isdisjoint(changed_set):
+                affected[row] = True
+
+        # Scores are symmetric, so the column maximum over the changed rows is
+        # the best score any changed place reaches in each other place's list
+        for start in range(0, len(changed), tile_rows):
+            tile = changed[start:start + tile_rows]
+            for similarity_type, scores, keep in family['score_tile'](tile):
+                best = np.where(keep, scores, -np.inf).max(axis=0)
+                affected |= best > thresholds[similarity_type]
+
+        return np.nonzero(affected)[0]
+
+    def _write_score_matrix(self, catalog, comm, rank, size, backend, workers, tile_rows, dtype):
+        """Score every place against every other by color and publish the matrix"""
+        if rank == 0:
+            writer = MatrixWriter.create(catalog['place_ids'], catalog['city_ids'], catalog['has_colors'], dtype=dtype)
+        else:
+            writer = None
+        if comm is not None:
+            writer = comm.bcast(writer, root=0)
+
+        n = len(catalog['place_ids'])
+        row_blocks = [np.arange(start, min(start + tile_rows, n)) for start in range(0, n, tile_rows)]
+
+        if backend == 'mpi':
+            # Every process fills its own row blocks of the shared file
+            writer.open()
+            for rows in row_blocks[rank::size]:
+                fill_rows(writer, catalog, rows)
+            writer.close()
+            comm.Barrier()
+        else:
+            arrays = {key: catalog[key] for key in ('place_ids', 'city_ids', 'colors', 'has_colors')}
+            for _ in run_matrix_rows(arrays, writer, row_blocks, workers=workers):
+                pass
+
+        if rank == 0:
+            manifest = writer.publish()
+            megabytes = os.path.getsize(writer.scores_path) / (1024 * 1024)
+            self.stdout.write(
+                f"Saved {manifest['places']}x{manifest['places']} {dtype} image score matrix "
+                f"({megabytes:.1f} MB) to {writer.scores_path}"
+            )
 
     def handle(self, *args, **options):
-        # Initialize MPI
-        comm = MPI.COMM_WORLD
-        rank = comm.Get_rank()
-        size = comm.Get_size()
-        
+        backend = options['backend']
+        if backend == 'mpi' and MPI is None:
+            self.stdout.write(self.style.WARNING("mpi4py is not available, using the processes backend"))
+            backend = 'processes'
+
+        # Initialize MPI (the processes backend runs everything from one parent)
+        if backend == 'mpi':
+            comm = MPI.COMM_WORLD
+            rank = comm.Get_rank()
+            size = comm.Get_size()
+        else:
+            comm = None
+            rank = 0
+            size = 1
+        workers = options['workers'] or available_cores()
+
         if rank == 0:
-            self.stdout.write(f"Starting similarity calculation with {size} processes")
-        
+            processes = size if backend == 'mpi' else workers
+            self.stdout.write(f"Starting similarity calculation with {processes} processes ({backend} backend)")
+
         clear_existing = options['clear']
         structural_only = options['structural_only']
         image_only = options['image_only']
-        
+        top_k = options['top_k']
+        tile_memory_mb = options['tile_memory_mb']
+        incremental = options['incremental']
+        storage = options['storage']
+
         # If no specific type is selected, do both
         if not structural_only and not image_only:
             structural_only = True
             image_only = True
-            
+
         # Clear existing similarities if requested (only on rank 0)
         if rank == 0 and clear_existing:
             types_to_clear = []
+            jobs_to_clear = []
             if structural_only:
                 types_to_clear.append('structural')
+                jobs_to_clear.append('structural')
             if image_only:
                 types_to_clear.extend(['image_same_city', 'image_diff_city'])
-                
+                jobs_to_clear.append('image')
+
             if types_to_clear:
                 count = SimilarPlace.objects.filter(similarity_type__in=types_to_clear).count()
                 SimilarPlace.objects.filter(similarity_type__in=types_to_clear).delete()
+                # Forget the fingerprints too, so an incremental run recomputes everything
+                PlaceFingerprint.objects.filter(job__in=jobs_to_clear).delete()
                 self.stdout.write(f"Cleared {count} existing similarities")
-        
-        # Wait for all processes to sync
-        comm.Barrier()
-        
-        # Get all places
-        if rank == 0:
-            places = list(Place.objects.all())
-            # Partition places for parallel processing
-            chunks = [[] for _ in range(size)]
-            for i, place in enumerate(places):
-                chunks[i % size].append(place)
-        else:
-            chunks = None
-            places = None
-            
-        # Distribute data to all processes
-        my_places = comm.scatter(chunks, root=0)
-        
-        if rank == 0:
-            self.stdout.write(f"Distributed {len(places)} places across {size} processes")
-            self.stdout.write(f"Process 0 received {len(my_places)} places")
-        
-        # Calculate similarities for my chunk of places
-        structural_results = []
-        image_same_city_results = []
-        image_diff_city_results = []
-        
-        # Get all places for comparison (each process needs all places)
-        all_places = list(Place.objects.all())
-        
-        # Get category data for structural similarity
+
+        # Rank 0 reads the catalog once; the other processes receive plain arrays
+        keys = ['place_ids', 'city_ids']
         if structural_only:
-            # Each place needs its categories for structural comparison
-            place_categories = {}
-            for pc in PlaceCategory.objects.all():
-                if pc.place_id not in place_categories:
-                    place_categories[pc.place_id] = set()
-                place_categories[pc.place_id].add(pc.category_id)
-        
-        # Get image data for image similarity
+            keys += ['category_indptr', 'category_indices']
         if image_only:
-            # Get color vectors for image similarity
-            place_colors = {}
-            for img in PlaceImage.objects.filter(color_vector__isnull=False).exclude(color_vector=''):
-                try:
-                    colors = json.loads(img.color_vector)
-                    if colors:  # Only store if we have valid colors
-                        place_colors[img.place_id] = np.array(colors)
-                except:
-                    continue
-        
-        # Process each place in my chunk
-        for i, place in enumerate(my_places):
-            if i % 10 == 0 and rank == 0:
-                self.stdout.write(f"Process {rank} processing place {i+1}/{len(my_places)}")
-            
-            # Calculate structural similarities
-            if structural_only:
-                place_cats = place_categories.get(place.id, set())
-                
-                for other_place in all_places:
-                    if place.id == other_place.id:
-                        continue  # Skip self-comparison
-                    
-                    # Get categories for other place
-                    other_cats = place_categories.get(other_place.id, set())
-                    
-                    # Calculate Jaccard similarity if both have categories
-                    if place_cats and other_cats:
-                        intersection = len(place_cats.intersection(other_cats))
-                        union = len(place_cats.union(other_cats))
-                        similarity = intersection / union if union > 0 else 0
-                        
-                        # Same city gives bonus
-                        if place.city_id == other_place.city_id:
-                            similarity = similarity * 0.7 + 0.3  # 30% boost for same city
-                        
-                        # Store if significant similarity
-                        if similarity > 0.1:  # Threshold to avoid noise
-                            structural_results.append({
-                                'main_place_id': place.id,
-                                'similar_place_id': other_place.id,
-                                'similarity_score': round(similarity, 3),
-                                'similarity_type': 'structural'
-                            })
-            
-            # Calculate image similarities
-            if image_only:
-                # Only proceed if this place has color data
-                if place.id not in place_colors:
-                    continue
-                
-                place_color_vector = place_colors[place.id]
-                
-                for other_place in all_places:
-                    if place.id == other_place.id or other_place.id not in place_colors:
-                        continue  # Skip self or places without colors
-                    
-                    other_color_vector = place_colors[other_place.id]
-                    
-                    # Calculate cosine similarity between color vectors
-                    try:
-                        # Normalize vectors
-                        norm1 = np.linalg.norm(place_color_vector)
-                        norm2 = np.linalg.norm(other_color_vector)
-                        
-                        if norm1 == 0 or norm2 == 0:
-                            continue
-                            
-                        # Make sure vectors are same length (crop if needed)
-                        min_length = min(len(place_color_vector), len(other_color_vector))
-                        v1 = place_color_vector[:min_length]
-                        v2 = other_color_vector[:min_length]
-                        
-                        # Calculate cosine similarity
-                        similarity = np.dot(v1, v2) / (norm1 * norm2)
-                        similarity = (similarity + 1) / 2  # Convert from [-1,1] to [0,1]
-                        
-                        # Determine similarity type based on city
-                        if place.city_id == other_place.city_id:
-                            # Same city
-                            image_same_city_results.append({
-                                'main_place_id': place.id,
-                                'similar_place_id': other_place.id,
-                                'similarity_score': round(similarity, 3),
-                                'similarity_type': 'image_same_city'
-                            })
-                        else:
-                            # Different city
-                            image_diff_city_results.append({
-                                'main_place_id': place.id,
-                                'similar_place_id': other_place.id,
-                                'similarity_score': round(similarity, 3),
-                                'similarity_type': 'image_diff_city'
-                            })
-                    except Exception as e:
-                        if rank == 0:
-                            self.stdout.write(self.style.WARNING(f"Error calculating image similarity: {e}"))
-        
+            keys += ['colors', 'has_colors']
+
+        catalog = load_catalog(structural_only, image_only) if rank == 0 else {}
+        if comm is not None:
+            for key in keys:
+                catalog[key] = bcast_array(comm, catalog.get(key))
+
+        place_ids = catalog['place_ids']
+        n = len(place_ids)
+        if rank == 0 and comm is not None:
+            self.stdout.write(f"Broadcast {n} places to {size} processes")
+
+        tile_rows = block_size_for(n, budget_mb=tile_memory_mb)
+        tile_side = tile_side_for(budget_mb=tile_memory_mb)
+
+        # The matrix storage always holds every pair, so it is rewritten in full
+        if image_only and storage == 'matrix':
+            if rank == 0 and incremental:
+                self.stdout.write(self.style.WARNING("--incremental does not apply to the matrix storage, rewriting it"))
+            self._write_score_matrix(catalog, comm, rank, size, backend, workers, tile_rows, options['matrix_dtype'])
+
+        # Only the similarity types stored as rows go through the tile pipeline
+        families = make_families(catalog, structural_only, image_only and storage == 'database')
+
+        for family in families:
+            if incremental:
+                # Rank 0 works out which rows to recompute and shares them
+                if rank == 0:
+                    family['digests'] = family['fingerprints']()
+                    place_index = {place_id: i for i, place_id in enumerate(place_ids.tolist())}
+                    changed = np.array(
+                        [place_index[place_id] for place_id in changed_places(family['job'], family['digests'])],
+                        dtype=np.int64
+                    )
+                    if top_k:
+                        # A changed place can enter or leave any top-K list, so recompute those rows in full
+                        replace = self._affected_rows(family, changed, place_index, top_k, tile_rows)
+                    else:
+                        replace = changed
+                    self.stdout.write(
+                        f"{family['job']}: {len(changed)} changed places, recomputing {len(replace)} rows"
+                    )
+                else:
+                    changed = replace = None
+
+                if comm is not None:
+                    changed = bcast_array(comm, changed)
+                    replace = bcast_array(comm, replace)
+                family['changed'] = changed
+                family['replace'] = replace
+                family['tiles'] = plan_tiles(n, tile_side, tile_rows, rows=replace)
+
+                # Scores are symmetric: without top-K, row c also yields column c of unchanged places
+                family['mirror'] = None
+                if not top_k:
+                    family['mirror'] = np.ones(n, dtype=bool)
+                    family['mirror'][changed] = False
+            else:
+                # Every unordered pair is scored once, in balanced triangular tiles
+                family['tiles'] = plan_tiles(n, tile_side, tile_rows)
+                family['mirror'] = True
+
+        # Calculate similarities for my share of the tiles
+        if backend == 'mpi':
+            results = (
+                score_tile(family, n, rows, cols, diagonal, top_k=top_k, mirror=family['mirror'])
+                for family in families
+                for rows, cols, diagonal in family['tiles'][rank::size]
+            )
+        else:
+            # Feature arrays go to shared memory once; tiles are fanned out to the pool
+            shared = {key: catalog[key] for key in keys}
+            tasks = []
+            for family in families:
+                mirror = family['mirror']
+                if isinstance(mirror, np.ndarray):
+                    shared[f"{family['job']}_mirror"] = mirror
+                    mirror = 'mask'
+                tasks.extend(
+                    (family['job'], rows, cols, diagonal, top_k, mirror)
+                    for rows, cols, diagonal in family['tiles']
+                )
+            results = run_tiles(shared, structural_only, image_only, tasks, workers=workers)
+
+        total_tiles = sum(len(family['tiles'][rank::size]) for family in families)
+        records = []
+        buffered = 0
+        for t, tile_result in enumerate(results):
+            if rank == 0 and (t % 10 == 0 or t + 1 == total_tiles):
+                self.stdout.write(f"Process {rank} finished tile {t + 1}/{total_tiles}")
+            records.append(tile_result)
+            buffered += len(tile_result)
+
+            # Keep the candidate buffer bounded in top-K mode
+            if top_k and buffered > 4 * top_k * n:
+                records = [reduce_top_k(np.concatenate(records), top_k)]
+                buffered = len(records[0])
+
+        records = np.concatenate(records) if records else np.empty(0, dtype=RESULT_DTYPE)
+        if top_k:
+            records = reduce_top_k(records, top_k)
+
         # Gather results from all processes
-        all_structural = comm.gather(structural_results, root=0)
-        all_image_same_city = comm.gather(image_same_city_results, root=0)
-        all_image_diff_city = comm.gather(image_diff_city_results, root=0)
-        
+        all_records = gather_records(comm, records) if comm is not None else records
         # Process 0 saves the results to database
-         
         if rank == 0:
-            # Flatten gathered results
-            flat_structural = [item for sublist in all_structural for item in sublist]
-            flat_image_same_city = [item for sublist in all_image_same_city for item in sublist]
-            flat_image_diff_city = [item for sublist in all_image_diff_city for item in sublist]
-            
-            total_similarities = len(flat_structural) + len(flat_image_same_city) + len(flat_image_diff_city)
-            self.stdout.write(f"Total similarities found: {total_similarities}")
-            self.stdout.write(f"- Structural: {len(flat_structural)}")
-            self.stdout.write(f"- Image (same city): {len(flat_image_same_city)}")
-            self.stdout.write(f"- Image (different city): {len(flat_image_diff_city)}")
-            
-            # Add this line here:
-            batch_size = 1000  # Define batch_size before using it
-            
-            # Save to database in chunks to avoid memory issues
+            if top_k:
+                all_records = reduce_top_k(all_records, top_k)
+
+            by_type = {
+                similarity_type: all_records[all_records['type'] == code]
+                for code, similarity_type in enumerate(SIMILARITY_TYPES)
+            }
+            labels = {
+                'structural': 'structural',
+                'image_same_city': 'image same city',
+                'image_diff_city': 'image different city',
+            }
+
+            self.stdout.write(f"Total similarities found: {len(all_records)}")
+            self.stdout.write(f"- Structural: {len(by_type['structural'])}")
+            self.stdout.write(f"- Image (same city): {len(by_type['image_same_city'])}")
+            self.stdout.write(f"- Image (different city): {len(by_type['image_diff_city'])}")
+
+            # Save to database with the bulk writer, inside one transaction
             with transaction.atomic():
-                # Save structural similarities
-                if flat_structural:
-                    for i in range(0, len(flat_structural), batch_size):
-                        batch = flat_structural[i:i+batch_size]
-                        SimilarPlace.objects.bulk_create([
-                            SimilarPlace(
-                                main_place_id=item['main_place_id'],
-                                similar_place_id=item['similar_place_id'],
-                                similarity_score=item['similarity_score'],
-                                similarity_type=item['similarity_type']
-                            ) for item in batch
-                        ], ignore_conflicts=True)
-                        self.stdout.write(f"Saved {i+len(batch)}/{len(flat_structural)} structural similarities")
-                
-                # Save image same city similarities
-                if flat_image_same_city:
-                    for i in range(0, len(flat_image_same_city), batch_size):
-                        batch = flat_image_same_city[i:i+batch_size]
-                        SimilarPlace.objects.bulk_create([
-                            SimilarPlace(
-                                main_place_id=item['main_place_id'],
-                                similar_place_id=item['similar_place_id'],
-                                similarity_score=item['similarity_score'],
-                                similarity_type=item['similarity_type']
-                            ) for item in batch
-                        ], ignore_conflicts=True)
-                        self.stdout.write(f"Saved {i+len(batch)}/{len(flat_image_same_city)} image same city similarities")
-                
-                # Save image different city similarities
-                if flat_image_diff_city:
-                    for i in range(0, len(flat_image_diff_city), batch_size):
-                        batch = flat_image_diff_city[i:i+batch_size]
-                        SimilarPlace.objects.bulk_create([
-                            SimilarPlace(
-                                main_place_id=item['main_place_id'],
-                                similar_place_id=item['similar_place_id'],
-                                similarity_score=item['similarity_score'],
-                                similarity_type=item['similarity_type']
-                            ) for item in batch
-                        ], ignore_conflicts=True)
-                        self.stdout.write(f"Saved {i+len(batch)}/{len(flat_image_diff_city)} image different city similarities")
-            
-            self.stdout.write(self.style.SUCCESS("Successfully calculated and saved all similarities"))
\ No newline at end of file
+                # Drop the rows that are being replaced by an incremental run
+                if incremental:
+                    for family in families:
+                        replaced_ids = place_ids[family['replace']].tolist()
+                        deleted = delete_similarities(family['types'], replaced_ids, both_directions=not top_k)
+                        self.stdout.write(f"Removed {deleted} outdated {family['job']} similarities")
+
+                with SimilarPlaceWriter(expected_rows=len(all_records)) as writer:
+                    for similarity_type, type_records in by_type.items():
+                        rows = zip(
+                            place_ids[type_records['main']].tolist(),
+                            place_ids[type_records['other']].tolist(),
+                            type_records['score'].tolist(),
+                            repeat(similarity_type),
+                        )
+                        saved = writer.write(rows)
+                        self.stdout.write(f"Saved {saved}/{len(type_records)} {labels[similarity_type]} similarities")
+
+                self.stdout.write(
+                    f"Wrote {writer.rows_written} rows in {writer.elapsed:.2f}s "
+                    f"({writer.rows_per_second:,.0f} rows/s)"
+                )
+
+                # Remember what the stored similarities were computed from, and how long the lists were
+                for family in families:
+                    codes = [SIMILARITY_TYPES.index(similarity_type) for similarity_type in family['types']]
+                    lengths = np.bincount(all_records['main'][np.isin(all_records['type'], codes)], minlength=n)
+                    if incremental:
+                        # Only the replaced rows were rewritten (they include the changed places)
+                        rows = family['replace']
+                        save_fingerprints(family['job'], family['digests'], place_ids[rows].tolist(),
+                                          dict(zip(place_ids[rows].tolist(), lengths[rows].tolist())))
+                    else:
+                        save_fingerprints(family['job'], family['fingerprints'](),
+                                          list_lengths=dict(zip(place_ids.tolist(), lengths.tolist())))
+
+            self.stdout.write(self.style.SUCCESS("Successfully calculated and saved all similarities"))
@@ -1,72 +1,113 @@
 import os
 from django.core.management.base import BaseCommand
 from django.conf import settings
-from PIL import Image
-import requests
-from io import BytesIO
-import re
-from django.utils.text import slugify
+import hashlib
+import threading
+import time
 
 from myapp.models import PlaceImage, Place # Make sure your models are correctly imported
-
-headers = {
-    "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 "
-                  "(KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36",
-    "Accept-Language": "en-US,en;q=0.9",
-    "Accept": "text/html,application/xhtml+xml,application/xml;q=0.9,image/webp,*/*;q=0.8",
-    "Referer": "https://www.google.com/",
-    "DNT": "1"
-}
+from myapp.downloader import Downloader, DownloadError
+from myapp.imaging import derivative_paths, save_derivatives, remove_derivatives
 
 class Command(BaseCommand):
     help = 'Manages place images: deletes specific existing local files and re-downloads them from URLs.'
 
     def add_arguments(self, parser):
         parser.add_argument('--re-download-all-existing', action='store_true',
-                            help='Delete existing local image files for all PlaceImage records with an image_url, then re-download them.')
+                            help='Re-fetch every PlaceImage with an image_url; images unchanged upstream are kept and replaced files are deleted.')
         parser.add_argument('--delete-local-only', action='store_true',
                             help='Delete only the local image files, but keep the PlaceImage records and their image_url.')
         parser.add_argument('--force-download', action='store_true',
-                            help='Force re-download of all images that have an image_url, regardless of local_path status. This will overwrite existing local files.')
+                            help='Refresh all images that have an image_url, regardless of local_path status. Images unchanged upstream are skipped.')
+        parser.add_argument('--unconditional', action='store_true',
+                            help='Fetch full bodies even when ETag/Last-Modified validators are stored (changed content is still detected by hash).')
         parser.add_argument('--download-missing-only', action='store_true', # <-- NEW ARGUMENT
                             help='Download images ONLY for PlaceImage records that have an image_url but no local_path.')
-
-
-    def _download_image(self, title, place_id, url, folder="media/images", size=(300, 300)):
+        parser.add_argument('--workers', type=int, default=16,
+                            help='Concurrent download threads (default: 16)')
+        parser.add_argument('--per-host', type=int, default=4,
+                            help='Maximum concurrent requests to one host (default: 4)')
+        parser.add_argument('--rate', type=float, default=None,
+                            help='Maximum requests per second to one host (default: unlimited)')
+        parser.add_argument('--retries', type=int, default=3,
+                            help='Retries for connection errors, 429 and 5xx responses (default: 3)')
+        parser.add_argument('--batch-size', type=int, default=500,
+                            help='PlaceImage rows updated per database write (default: 500)')
+
+
+    def _content_path(self, content_hash):
+        """Content-addressed location of a processed image, relative to MEDIA_ROOT"""
+        return os.path.join("images", content_hash[:2], f"{content_hash}.jpg")
+
+    def _save_image(self, content, rel_path, size=(300, 300)):
+        """Decodes downloaded image bytes once and writes the display JPEG at rel_path plus its derivatives."""
+        base_path = os.path.splitext(os.path.join(settings.MEDIA_ROOT, rel_path))[0]
+        save_derivatives(content, base_path, size=size, quality=75)
+
+    def _hash_lock(self, content_hash):
+        with self._locks_lock:
+            return self._hash_locks.setdefault(content_hash, threading.Lock())
+
+    def _download_image(self, img, conditional=True):
         """
-        Downloads an image from a URL, resizes it, and saves it locally.
-        Returns the relative path (e.g., 'images/filename.jpg') or None on failure.
+        Worker: revalidate or fetch one PlaceImage. Returns a dict with the
+        outcome ('unchanged', 'stored' or 'shared') and the fields to save.
         """
-        os.makedirs(folder, exist_ok=True)
-        try:
-            self.stdout.write(f"  Attempting to download: {url}")
-            response = requests.get(url, headers=headers, timeout=15) # Increased timeout
-            response.raise_for_status()  # Raise an HTTPError for bad responses (4xx or 5xx)
-
-            image = Image.open(BytesIO(response.content)).convert("RGB")
-            image = image.resize(size, Image.Resampling.LANCZOS)
-
-            # Sanitize title for filename, keep it concise and unique per place ID
-            sanitized_title = slugify(title)[:50] # Limit length for filenames
-            filename = f"{place_id}_{sanitized_title}.jpg"
-            save_path = os.path.join(folder, filename)
-
-            # Ensure the filename is unique if it already exists (though place_id helps)
-            counter = 1
-            original_save_path = save_path
-            while os.path.exists(save_path):
-                filename = f"{place_id}_{sanitized_title}_{counter}.jpg"
-                save_path = os.path.join(folder, filename)
-                counter += 1
-
-            image.save(save_path, format="JPEG", quality=75)
-            self.stdout.write(f"  Saved image: {save_path}")
-            return os.path.join("images", filename) # Return path relative to media
-        except requests.exceptions.RequestException as e:
-            self.stderr.write(self.style.ERROR(f"  Failed to download image from {url}: {e}"))
-        except Exception as e:
-            self.stderr.write(self.style.ERROR(f"  Failed to process/save image from {url}: {e}"))
-        return None
+        has_file = bool(img.local_path) and os.path.exists(os.path.join(settings.MEDIA_ROOT, img.local_path))
+
+        # Ask the server to skip the body if our copy is still current
+        headers = {}
+        if conditional and has_file:
+            if img.etag:
+                headers['If-None-Match'] = img.etag
+            if img.last_modified:
+                headers['If-Modified-Since'] = img.last_modified
+
+        response = self.downloader.request(img.image_url, headers=headers)
+        fields = {
+            'etag': response.headers.get('ETag', img.etag if response.status_code == 304 else ''),
+            'last_modified': response.headers.get('Last-Modified', img.last_modified if response.status_code == 304 else ''),
+        }
+        if response.status_code == 304:
+            return dict(fields, status='unchanged', local_path=img.local_path, content_hash=img.content_hash)
+
+        content_hash = hashlib.sha256(response.content).hexdigest()
+        if has_file and content_hash == img.content_hash:
+            return dict(fields, status='unchanged', local_path=img.local_path, content_hash=content_hash)
+
+        # Identical originals (e.g. one photo used by several places) are processed once
+        rel_path = self._content_path(content_hash)
+        with self._hash_lock(content_hash):
+            # Every derivative must be there; files left by an older interrupted run are rewritten
+            if all(os.path.exists(path) for path in derivative_paths(os.path.join(settings.MEDIA_ROOT, rel_path))):
+                status = 'shared'
+            else:
+                try:
+                    self._save_image(response.content, rel_path)
+                except Exception as e:
+                    raise DownloadError(f"Failed to process/save image from {img.image_url}: {e}") from e
+                status = 'stored'
+        return dict(fields, status=status, local_path=rel_path, content_hash=content_hash)
+
+    def _flush(self, updated):
+        """Write a batch of new paths and fetch validators in one query"""
+        if updated:
+            PlaceImage.objects.bulk_update(updated, ['local_path', 'etag', 'last_modified', 'content_hash'])
+            updated.clear()
+
+    def _remove_orphans(self, old_paths):
+        """Delete replaced files that no PlaceImage refers to any more"""
+        old_paths = set(old_paths)
+        still_used = set(PlaceImage.objects.filter(local_path__in=old_paths).values_list('local_path', flat=True))
+        removed = 0
+        for rel_path in old_paths - still_used:
+            full_path = os.path.join(settings.MEDIA_ROOT, rel_path)
+            try:
+                if remove_derivatives(full_path):
+                    removed += 1
+            except OSError as e:
+                self.stderr.write(self.style.ERROR(f"  Error deleting file {full_path}: {e}"))
+        return removed
 
     def handle(self, *args, **options):
         download_folder = os.path.join(settings.MEDIA_ROOT, 'images')
@@ -76,22 +117,22 @@ class Command(BaseCommand):
         if options['delete_local_only']:
             self.stdout.write(self.style.WARNING("Deleting local image files only (keeping database records)..."))
             deleted_files_count = 0
-            for img in PlaceImage.objects.all():
+            cleared_ids = []
+            for img in PlaceImage.objects.select_related('place'):
                 if img.local_path:
                     full_path = os.path.join(settings.MEDIA_ROOT, img.local_path)
                     if os.path.exists(full_path):
                         try:
-                            os.remove(full_path)
-                            img.local_path = '' # Clear the local_path in the DB
-                            img.save()
+                            remove_derivatives(full_path)
+                            cleared_ids.append(img.id) # Clear the local_path in the DB
                             self.stdout.write(f"Deleted local file: {full_path} and cleared DB path.")
                             deleted_files_count += 1
                         except OSError as e:
                             self.stderr.write(self.style.ERROR(f"Error deleting file {full_path}: {e}"))
                     else:
                         self.stdout.write(self.style.WARNING(f"Local file not found for {img.place.name} at {full_path}. Clearing DB path."))
-                        img.local_path = ''
-                        img.save()
+                        cleared_ids.append(img.id)
+            PlaceImage.objects.filter(id__in=cleared_ids).update(local_path='')
             self.stdout.write(self.style.SUCCESS(f"Deleted {deleted_files_count} local image files and updated DB records."))
             return # Exit after this operation, as it's a standalone task
 
@@ -101,25 +142,10 @@ class Command(BaseCommand):
         action_description = ""
 
         if options['re_download_all_existing']:
-            action_description = "Deleting existing local image files and then re-downloading for all PlaceImages..."
-            # First, delete all associated local files and clear paths
-            self.stdout.write(self.style.WARNING("Performing initial cleanup: Deleting old local image files and clearing DB paths..."))
-            deleted_count = 0
-            for img in PlaceImage.objects.all():
-                if img.local_path:
-                    full_path = os.path.join(settings.MEDIA_ROOT, img.local_path)
-                    if os.path.exists(full_path):
-                        try:
-                            os.remove(full_path)
-                            self.stdout.write(f"  Deleted old file: {full_path}")
-                            deleted_count += 1
-                        except OSError as e:
-                            self.stderr.write(self.style.ERROR(f"  Error deleting file {full_path}: {e}"))
-                img.local_path = '' # Crucially, clear the local_path for re-download logic
-                img.save()
-            self.stdout.write(self.style.SUCCESS(f"Finished deleting {deleted_count} old local image files and cleared their DB paths."))
-            images_to_process = PlaceImage.objects.exclude(image_url='') # After clearing, all are effectively "missing" local paths
-            action_description = "Starting re-download process for all PlaceImages with a URL..."
+            # Files are no longer deleted up front: unchanged images are kept, and
+            # files replaced by new content are removed once nothing refers to them
+            images_to_process = PlaceImage.objects.exclude(image_url='')
+            action_description = "Starting re-download process for all PlaceImages with a URL (unchanged images are kept)..."
 
         elif options['force_download']:
             images_to_process = PlaceImage.objects.exclude(image_url='')
@@ -146,32 +172,54 @@ class Command(BaseCommand):
 
         self.stdout.write(f"Found {total_to_process} images to process.")
 
-        for i, img in enumerate(images_to_process):
-            if not img.image_url: # Double check, though query should exclude these
+        self.downloader = Downloader(
+            workers=options['workers'], per_host=options['per_host'], rate=options['rate'], retries=options['retries']
+        )
+        self._hash_locks = {}
+        self._locks_lock = threading.Lock()
+        conditional = not options['unconditional']
+        batch_size = options['batch_size']
+        updated = []
+        replaced_paths = []
+        outcomes = {'unchanged': 0, 'stored': 0, 'shared': 0}
+        started = time.perf_counter()
+
+        # Downloads run on the thread pool; results come back here as they finish
+        jobs = images_to_process.select_related('place').iterator()
+        results = self.downloader.run(jobs, lambda img: self._download_image(img, conditional))
+        for i, (img, result, error) in enumerate(results):
+            if error is not None:
+                self.stderr.write(self.style.ERROR(f"  {error}"))
+                self.stdout.write(self.style.WARNING(f"  Failed to download image for {img.place.name} from {img.image_url}."))
                 skipped_count += 1
                 continue
 
-            self.stdout.write(f"Processing ({i+1}/{total_to_process}) for Place: {img.place.name} (ID: {img.place.id})")
-
-            # Call the download function
-            new_local_rel_path = self._download_image(img.place.name, img.place.id, img.image_url, folder=download_folder)
-
-            if new_local_rel_path:
-                # Update the local_path in the database
-                if img.local_path != new_local_rel_path: # Only save if path changed
-                    img.local_path = new_local_rel_path
-                    img.save()
-                    re_downloaded_count += 1
-                    self.stdout.write(f"  Updated DB path for {img.place.name} to: {new_local_rel_path}")
-                else:
-                    self.stdout.write(f"  Path for {img.place.name} remains unchanged: {new_local_rel_path}")
-                    re_downloaded_count += 1 # Count as processed successfully, even if path was already correct
-            else:
-                self.stdout.write(self.style.WARNING(f"  Failed to download image for {img.place.name} from {img.image_url}."))
-                skipped_count += 1
+            re_downloaded_count += 1
+            outcomes[result['status']] += 1
+            if img.local_path and img.local_path != result['local_path']:
+                replaced_paths.append(img.local_path)
+
+            fields = ('local_path', 'etag', 'last_modified', 'content_hash')
+            if any(getattr(img, field) != result[field] for field in fields): # Only save if something changed
+                for field in fields:
+                    setattr(img, field, result[field])
+                updated.append(img)
+                if len(updated) >= batch_size:
+                    self._flush(updated)
+
+            if (i + 1) % 100 == 0 or i + 1 == total_to_process:
+                elapsed = time.perf_counter() - started
+                self.stdout.write(f"Processed {i+1}/{total_to_process} images ({(i + 1) / elapsed:.1f} images/s)")
+
+        self._flush(updated)
+        removed = self._remove_orphans(replaced_paths)
 
         self.stdout.write(self.style.SUCCESS(f"""
         Image download process completed!
         Successfully downloaded/updated: {re_downloaded_count} images.
+          Unchanged upstream: {outcomes['unchanged']}
+          New files stored: {outcomes['stored']}
+          Shared with an identical image: {outcomes['shared']}
+        Replaced files removed: {removed}
         Skipped/Failed: {skipped_count} images.
         """))
\ No newline at end of file
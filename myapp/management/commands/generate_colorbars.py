@@ -1,129 +1,126 @@
 # myapp/management/commands/generate_colorbars.py
 import os
-import json
+import time
 import numpy as np
-import matplotlib.pyplot as plt
-from scipy.cluster.vq import kmeans2
-from PIL import Image
 from django.core.management.base import BaseCommand
 from django.conf import settings
 from myapp.models import PlaceImage
+from myapp.colorbars import run_palettes
+from myapp.imaging import load_analysis_pixels
+from myapp.palettes import DEFAULT_METHOD, EXTRACTORS, PALETTE_SIZE, SEED, to_color_vector, quantization_error
 
 class Command(BaseCommand):
-    help = 'Generate color bars for place images'
+    help = 'Extract the color palettes of place images (the color bars themselves are rendered on request)'
 
     def add_arguments(self, parser):
-        parser.add_argument('--regenerate', action='store_true', 
-                           help='Regenerate color bars even if they already exist')
-        
+        parser.add_argument('--regenerate', action='store_true',
+                           help='Re-extract palettes even for images that already have one')
+        parser.add_argument('--workers', type=int, default=None,
+                           help='Worker processes for palette extraction (default: all available cores, 1 = no pool)')
+        parser.add_argument('--batch-size', type=int, default=500,
+                           help='PlaceImage rows per bulk_update query (default: 500)')
+        parser.add_argument('--method', choices=sorted(EXTRACTORS), default=DEFAULT_METHOD,
+                           help=f'Palette extraction algorithm (default: {DEFAULT_METHOD})')
+        parser.add_argument('--images-per-task', type=int, default=32,
+                           help='Images whose palettes are extracted together in one worker task (default: 32)')
+        parser.add_argument('--benchmark', action='store_true',
+                           help='Compare speed and palette quality of every method on a sample, without saving anything')
+        parser.add_argument('--sample', type=int, default=200,
+                           help='With --benchmark, number of distinct image files to use (default: 200)')
+
     def handle(self, *args, **options):
         regenerate = options['regenerate']
-        
-        # Create colorbar directory if it doesn't exist
-        colorbar_dir = os.path.join(settings.MEDIA_ROOT, 'colorbars')
-        os.makedirs(colorbar_dir, exist_ok=True)
-        
+        start = time.time()
+
         # Get images to process
-        if regenerate:
-            images = PlaceImage.objects.filter(local_path__isnull=False).exclude(local_path='')
-        else:
-            images = PlaceImage.objects.filter(
-                local_path__isnull=False
-            ).exclude(
-                local_path=''
-            ).filter(
-                colorbar_path=''
-            )
-        
-        self.stdout.write(f"Found {images.count()} images to process")
-        
-        for i, img in enumerate(images):
-            if i % 10 == 0:
-                self.stdout.write(f"Processing image {i+1}/{images.count()}")
-            
-            # Skip if no local path
-            if not img.local_path:
-                continue
-            
-            # Get the full path to the image
-            image_path = os.path.join(settings.MEDIA_ROOT, img.local_path)
-            
-            # Skip if image doesn't exist
-            if not os.path.exists(image_path):
-                self.stdout.write(self.style.WARNING(f"Image not found: {image_path}"))
-                continue
-            
+        images = PlaceImage.objects.filter(local_path__isnull=False).exclude(local_path='')
+        if not regenerate:
+            images = images.filter(color_dim=0)
+        images = list(images.only('id', 'local_path'))
+
+        # Images sharing a content-addressed file only need one palette
+        by_path = {}
+        for img in images:
+            by_path.setdefault(img.local_path, []).append(img)
+        total = len(by_path)
+        self.stdout.write(f"Found {len(images)} images to process ({total} distinct files)")
+
+        if options['benchmark']:
+            self.benchmark(sorted(by_path)[:options['sample']], options['images_per_task'])
+            return
+
+        self.stdout.write(f"Palette method: {options['method']}")
+        results = run_palettes(list(by_path), settings.MEDIA_ROOT, method=options['method'],
+                               workers=options['workers'], batch_size=options['images_per_task'])
+        updated = []
+        failed = 0
+        for i, (local_path, colors, error) in enumerate(results, 1):
+            if error:
+                self.stdout.write(self.style.ERROR(f"Error processing {local_path}: {error}"))
+                failed += 1
+            elif not colors:
+                self.stdout.write(self.style.WARNING(f"Could not extract colors from {local_path}"))
+                failed += 1
+            else:
+                for img in by_path[local_path]:
+                    img.set_colors(colors)
+                    updated.append(img)
+
+            if i % 100 == 0:
+                self.stdout.write(f"Processed {i}/{total} files")
+
+        PlaceImage.objects.bulk_update(updated, ['color_vector', 'color_dim'], batch_size=options['batch_size'])
+        removed = self.remove_prerendered_colorbars()
+
+        self.stdout.write(self.style.SUCCESS(
+            f"Palette extraction complete: {len(updated)} images updated, "
+            f"{failed} files skipped, {removed} pre-rendered color bars removed, "
+            f"in {time.time() - start:.1f}s"
+        ))
+
+    def remove_prerendered_colorbars(self):
+        """
+        Pre-rendered bars are superseded by the on-demand colorbar view: delete
+        every file still referenced by colorbar_path, whether or not its image
+        was re-extracted in this run, and clear the field in one query
+        """
+        referenced = PlaceImage.objects.exclude(colorbar_path='')
+        removed = 0
+        for colorbar_path in set(referenced.values_list('colorbar_path', flat=True)):
+            try:
+                os.remove(os.path.join(settings.MEDIA_ROOT, colorbar_path))
+                removed += 1
+            except FileNotFoundError:
+                pass
+        referenced.update(colorbar_path='')
+        return removed
+
+    def benchmark(self, local_paths, batch_size):
+        """
+        Print time per image, RMS quantization error (how far pixels are from
+        their nearest palette color, 0-255) and the number of images with an
+        empty cluster (which the old code discarded) for every method.
+        """
+        batch = []
+        for local_path in local_paths:
             try:
-                # Get dominant colors
-                colors = self.get_dominant_colors(image_path)
-                
-                if not colors:
-                    self.stdout.write(self.style.WARNING(f"Could not extract colors from {img.local_path}"))
-                    continue
-                
-                # Store color vector in the database
-                img.color_vector = json.dumps(colors)
-                
-                # Create and save color bar
-                colorbar_filename = os.path.splitext(os.path.basename(img.local_path))[0] + "_colors.jpg"
-                colorbar_path = os.path.join('colorbars', colorbar_filename)
-                full_colorbar_path = os.path.join(settings.MEDIA_ROOT, colorbar_path)
-                
-                self.create_color_bar(colors, full_colorbar_path)
-                
-                # Update the database
-                img.colorbar_path = colorbar_path
-                img.save()
-                
-            except Exception as e:
-                self.stdout.write(self.style.ERROR(f"Error processing {img.local_path}: {e}"))
-        
-        self.stdout.write(self.style.SUCCESS("Color bar generation complete"))
-    
-    def get_dominant_colors(self, image_path, k=10, resize_dim=(100, 100)):
-        """Extract dominant colors using k-means clustering"""
-        try:
-            image = Image.open(image_path).convert("RGB")
-            image = image.resize(resize_dim)
-            
-            pixels = np.array(image).reshape(-1, 3).astype(np.float32)
-            
-            centroids, labels = kmeans2(pixels, k=k, minit='points')
-            counts = np.bincount(labels)
-            
-            if np.sum(counts > 0) < k:
-                return []
-                
-            sorted_indices = np.argsort(counts)[::-1]
-            dominant_colors = [tuple(map(int, centroids[i])) for i in sorted_indices]
-            
-            # Flatten the list for storage
-            return [c for color in dominant_colors for c in color]
-            
-        except Exception as e:
-            self.stdout.write(self.style.ERROR(f"Error in get_dominant_colors: {e}"))
-            return []
-    
-    def create_color_bar(self, colors, output_path):
-        """Create a visualization of the color palette"""
-        try:
-            # Reshape colors into RGB tuples
-            rgb_colors = [colors[i:i+3] for i in range(0, len(colors), 3)]
-            
-            # Create color bar
-            bar = np.zeros((50, 300, 3), dtype=np.uint8)
-            step = 300 // len(rgb_colors)
-            
-            for i, (r, g, b) in enumerate(rgb_colors):
-                bar[:, i * step:(i + 1) * step, :] = [r, g, b]
-            
-            # Save as file
-            plt.figure(figsize=(6, 1))
-            plt.axis('off')
-            plt.imshow(bar)
-            plt.savefig(output_path, format="jpg", bbox_inches='tight', pad_inches=0)
-            plt.close()
-            
-        except Exception as e:
-            self.stdout.write(self.style.ERROR(f"Error creating color bar: {e}"))
-            raise e
\ No newline at end of file
+                batch.append(load_analysis_pixels(os.path.join(settings.MEDIA_ROOT, local_path)))
+            except OSError:
+                continue
+        if not batch:
+            self.stdout.write(self.style.WARNING("No images to benchmark"))
+            return
+
+        self.stdout.write(f"Benchmarking {len(batch)} images, {batch_size} per batch")
+        self.stdout.write(f"{'method':<12}{'ms/image':>10}{'RMS error':>11}{'empty clusters':>16}")
+        for method, extractor in sorted(EXTRACTORS.items()):
+            started = time.perf_counter()
+            raw = []
+            for i in range(0, len(batch), batch_size):
+                raw += extractor(batch[i:i + batch_size], PALETTE_SIZE, SEED)
+            palettes = [to_color_vector(centroids, counts) for centroids, counts in raw]
+            elapsed = 1000 * (time.perf_counter() - started) / len(batch)
+
+            error = np.mean([quantization_error(pixels, colors) for pixels, colors in zip(batch, palettes) if colors])
+            empty = sum(int((np.asarray(counts) == 0).any() or len(counts) < PALETTE_SIZE) for _, counts in raw)
+            self.stdout.write(f"{method:<12}{elapsed:>10.2f}{error:>11.2f}{empty:>16}")
@@ -1,7 +1,9 @@
 # myapp/management/commands/enhanced_structural.py
 from django.core.management.base import BaseCommand
 from django.db import transaction
-from myapp.models import Place, SimilarPlace
+from myapp.models import Place, PlaceFingerprint, SimilarPlace
+from myapp.similarity import fingerprint, changed_places, save_fingerprints, delete_similarities
+from myapp.writers import SimilarPlaceWriter
 import numpy as np
 
 class Command(BaseCommand):
@@ -14,11 +16,14 @@ class Command(BaseCommand):
                            help='Weight for city matching (default: 0.6)')
         parser.add_argument('--views-weight', type=float, default=0.4,
                            help='Weight for page views similarity (default: 0.4)')
+        parser.add_argument('--incremental', action='store_true',
+                           help='Recompute only places whose city or page views changed since the last run')
 
     def handle(self, *args, **options):
         clear = options['clear']
         city_weight = options['city_weight']
         views_weight = options['views_weight']
+        incremental = options['incremental']
         
         if city_weight + views_weight != 1.0:
             self.stdout.write(self.style.WARNING(f"Weights sum to {city_weight + views_weight}, not 1.0. Normalizing..."))
@@ -30,6 +35,7 @@ class Command(BaseCommand):
         if clear:
             count = SimilarPlace.objects.filter(similarity_type='structural').count()
             SimilarPlace.objects.filter(similarity_type='structural').delete()
+            PlaceFingerprint.objects.filter(job='simple_structural').delete()
             self.stdout.write(f"Cleared {count} existing structural similarity records")
         
         # Get all places
@@ -44,11 +50,26 @@ class Command(BaseCommand):
         
         self.stdout.write(f"Page views range: {min_views} to {max_views}")
         
+        # The page view range is part of every fingerprint, since it rescales all scores
+        digests = {
+            place.id: fingerprint(place.city_id, place.page_views, min_views, max_views)
+            for place in places
+        }
+        
+        # Only rows and columns of changed places are recomputed in incremental mode
+        if incremental:
+            changed = set(changed_places('simple_structural', digests))
+            rows = [(i, place) for i, place in enumerate(places) if place.id in changed]
+            self.stdout.write(f"{len(changed)} places changed since the last run")
+        else:
+            changed = None
+            rows = list(enumerate(places))
+        
         # Calculate similarities
         similarities = []
-        for i, place1 in enumerate(places):
-            if i % 100 == 0:
-                self.stdout.write(f"Processing place {i+1}/{len(places)}")
+        for n, (i, place1) in enumerate(rows):
+            if n % 100 == 0:
+                self.stdout.write(f"Processing place {n+1}/{len(rows)}")
             
             # Normalize page views to [0,1] range
             views1 = (place1.page_views or 0 - min_views) / range_views
@@ -81,23 +102,36 @@ class Command(BaseCommand):
                         'similarity_score': round(combined_similarity, 3),
                         'similarity_type': 'structural'
                     })
+                    
+                    # Scores are symmetric, so also fill the column of an unchanged place
+                    if changed is not None and place2.id not in changed:
+                        similarities.append({
+                            'main_place_id': place2.id,
+                            'similar_place_id': place1.id,
+                            'similarity_score': round(combined_similarity, 3),
+                            'similarity_type': 'structural'
+                        })
         
         self.stdout.write(f"Calculated {len(similarities)} structural similarities")
         
-        # Save to database in batches
-        batch_size = 1000
+        # Save to database with the bulk writer
         with transaction.atomic():
-            for i in range(0, len(similarities), batch_size):
-                batch = similarities[i:i+batch_size]
-                SimilarPlace.objects.bulk_create([
-                    SimilarPlace(
-                        main_place_id=item['main_place_id'],
-                        similar_place_id=item['similar_place_id'],
-                        similarity_score=item['similarity_score'],
-                        similarity_type=item['similarity_type']
-                    ) for item in batch
-                ], ignore_conflicts=True)
-                self.stdout.write(f"Saved batch {i//batch_size + 1}/{(len(similarities)-1)//batch_size + 1}")
+            # Drop the rows that are being replaced
+            if changed:
+                deleted = delete_similarities(['structural'], changed)
+                self.stdout.write(f"Removed {deleted} outdated structural similarities")
+            
+            with SimilarPlaceWriter(expected_rows=len(similarities)) as writer:
+                writer.write(
+                    (item['main_place_id'], item['similar_place_id'], item['similarity_score'], item['similarity_type'])
+                    for item in similarities
+                )
+            self.stdout.write(
+                f"Wrote {writer.rows_written} rows in {writer.elapsed:.2f}s ({writer.rows_per_second:,.0f} rows/s)"
+            )
+            
+            # Remember what the stored similarities were computed from
+            save_fingerprints('simple_structural', digests, changed)
         
         # Summary
         count = SimilarPlace.objects.filter(similarity_type='structural').count()
@@ -0,0 +1,77 @@
+# myapp/media_manifest.py
+"""
+One-pass manifest of an image directory for linking files to places. The
+directory is listed once; lookups by place id, by exact name and by shared
+name tokens are then dictionary hits instead of scans over every file or
+os.path.exists calls.
+"""
+import os
+import re
+import unicodedata
+
+from django.utils.text import slugify
+
+from myapp.imaging import is_derivative
+
+
+WORD = re.compile(r'[a-z0-9]+')
+
+
+def name_tokens(name):
+    """Lowercase ASCII words of a place name or file name stem (accents dropped, as slugify does)"""
+    if not name.isascii():
+        name = unicodedata.normalize('NFKD', name).encode('ascii', 'ignore').decode('ascii')
+    return WORD.findall(name.lower())
+
+
+class MediaManifest:
+    """
+    Display images of one directory (derivatives are left out), indexed by
+    leading place id ("<id>_name.jpg"), by lowercased stem and by name
+    token. Among several candidates the file listed first wins, like the
+    scans this replaces.
+    """
+
+    def __init__(self, filenames):
+        self.filenames = list(filenames)
+        self.files = set(self.filenames)
+        self.by_id = {}
+        self.by_name = {}
+        self.by_token = {}
+        for position, filename in enumerate(self.filenames):
+            stem = os.path.splitext(filename)[0]
+            prefix, _, rest = filename.partition('_')
+            if rest and prefix.isdigit():
+                self.by_id[int(prefix)] = filename
+            self.by_name[stem.lower()] = filename
+            for token in set(name_tokens(stem)):
+                self.by_token.setdefault(token, position)
+
+    @classmethod
+    def scan(cls, directory):
+        with os.scandir(directory) as entries:
+            return cls(entry.name for entry in entries if entry.is_file() and not is_derivative(entry.name))
+
+    def __len__(self):
+        return len(self.filenames)
+
+    def __contains__(self, filename):
+        return filename in self.files
+
+    def match(self, place_id, place_name):
+        """
+        Best file for a place as (filename, how), trying the place id, then
+        the exact slug, then the earliest file sharing a name token.
+        Returns (None, None) when nothing matches.
+        """
+        if place_id in self.by_id:
+            return self.by_id[place_id], 'id'
+
+        slug = slugify(place_name).lower()
+        if slug in self.by_name:
+            return self.by_name[slug], 'exact name'
+
+        positions = [self.by_token[token] for token in name_tokens(place_name) if token in self.by_token]
+        if positions:
+            return self.filenames[min(positions)], 'fuzzy name'
+        return None, None
@@ -0,0 +1,26 @@
+# Generated by Django 5.2.18 on 2026-10-17 20:37
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('myapp', '0004_similarplace'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='PlaceFingerprint',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('job', models.CharField(max_length=50)),
+                ('digest', models.CharField(max_length=64)),
+                ('place', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='fingerprints', to='myapp.place')),
+            ],
+            options={
+                'unique_together': {('place', 'job')},
+            },
+        ),
+    ]
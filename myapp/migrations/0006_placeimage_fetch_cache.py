@@ -0,0 +1,28 @@
+# Generated by Django 5.2.18 on 2026-10-17 20:56
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('myapp', '0005_placefingerprint'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='placeimage',
+            name='content_hash',
+            field=models.CharField(blank=True, db_index=True, max_length=64),
+        ),
+        migrations.AddField(
+            model_name='placeimage',
+            name='etag',
+            field=models.CharField(blank=True, max_length=255),
+        ),
+        migrations.AddField(
+            model_name='placeimage',
+            name='last_modified',
+            field=models.CharField(blank=True, max_length=64),
+        ),
+    ]
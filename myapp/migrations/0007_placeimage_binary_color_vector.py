@@ -0,0 +1,65 @@
+# Generated by Django 5.2.18 on 2026-10-17 21:10
+
+import json
+
+from django.db import migrations, models
+
+
+def json_to_binary(apps, schema_editor):
+    """Re-encode the JSON color lists as uint8 bytes; unparsable vectors are dropped"""
+    PlaceImage = apps.get_model('myapp', 'PlaceImage')
+    batch = []
+    for image in PlaceImage.objects.exclude(color_vector='').only('id', 'color_vector').iterator(chunk_size=2000):
+        try:
+            encoded = bytes(bytearray(int(round(value)) for value in json.loads(image.color_vector)))
+        except (ValueError, TypeError):
+            continue
+        image.color_vector_bytes = encoded
+        image.color_dim = len(encoded)
+        batch.append(image)
+        if len(batch) >= 2000:
+            PlaceImage.objects.bulk_update(batch, ['color_vector_bytes', 'color_dim'])
+            batch = []
+    PlaceImage.objects.bulk_update(batch, ['color_vector_bytes', 'color_dim'])
+
+
+def binary_to_json(apps, schema_editor):
+    PlaceImage = apps.get_model('myapp', 'PlaceImage')
+    batch = []
+    for image in PlaceImage.objects.filter(color_dim__gt=0).only('id', 'color_vector_bytes').iterator(chunk_size=2000):
+        image.color_vector = json.dumps(list(bytes(image.color_vector_bytes)))
+        batch.append(image)
+        if len(batch) >= 2000:
+            PlaceImage.objects.bulk_update(batch, ['color_vector'])
+            batch = []
+    PlaceImage.objects.bulk_update(batch, ['color_vector'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('myapp', '0006_placeimage_fetch_cache'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='placeimage',
+            name='color_dim',
+            field=models.PositiveSmallIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='placeimage',
+            name='color_vector_bytes',
+            field=models.BinaryField(blank=True, default=b''),
+        ),
+        migrations.RunPython(json_to_binary, binary_to_json),
+        migrations.RemoveField(
+            model_name='placeimage',
+            name='color_vector',
+        ),
+        migrations.RenameField(
+            model_name='placeimage',
+            old_name='color_vector_bytes',
+            new_name='color_vector',
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.2.18 on 2026-10-17 21:15
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('myapp', '0007_placeimage_binary_color_vector'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='place',
+            name='source_hash',
+            field=models.CharField(blank=True, max_length=40),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.2.18 on 2026-10-17 23:40
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('myapp', '0008_place_source_hash'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='placefingerprint',
+            name='list_length',
+            field=models.PositiveIntegerField(default=0),
+        ),
+    ]
@@ -1,3 +1,5 @@
+import hashlib
+
 from django.db import models
 
 class City(models.Model):
@@ -53,6 +55,9 @@ class Place(models.Model):
     
     # We'll use this temporarily until we implement PageRank
     relevance_score = models.FloatField(default=0)
+
+    # Hash of the normalized CSV row this place was last imported from (upsert imports)
+    source_hash = models.CharField(max_length=40, blank=True)
     
     def __str__(self):
         return f"{self.name} ({self.city.name})"
@@ -66,12 +71,34 @@ class PlaceImage(models.Model):
     place = models.ForeignKey(Place, on_delete=models.CASCADE, related_name='images')
     image_url = models.URLField(verbose_name="Image link")
     local_path = models.CharField(max_length=255, blank=True)
-    color_vector = models.TextField(blank=True)  # Store color vector data
+    # Dominant colors as flat [r, g, b, ...] uint8 bytes; color_dim is the number of values
+    color_vector = models.BinaryField(blank=True, default=b'')
+    color_dim = models.PositiveSmallIntegerField(default=0)
     colorbar_path = models.CharField(max_length=255, blank=True)  # New field for color bar path
     is_primary = models.BooleanField(default=False)
     
+    # HTTP validators and hash of the last downloaded original, for conditional refreshes
+    etag = models.CharField(max_length=255, blank=True)
+    last_modified = models.CharField(max_length=64, blank=True)
+    content_hash = models.CharField(max_length=64, blank=True, db_index=True)
+    
     def __str__(self):
         return f"Image for {self.place.name}"
+    
+    @property
+    def palette_hash(self):
+        """Short digest of the stored palette; it versions the colorbar URL"""
+        return hashlib.sha1(bytes(self.color_vector)).hexdigest()[:16]
+    
+    @property
+    def colors(self):
+        """The stored palette as a flat list of ints"""
+        return list(bytes(self.color_vector))
+    
+    def set_colors(self, colors):
+        """Store a flat [r, g, b, ...] palette (values 0-255) in its binary form"""
+        self.color_vector = bytes(bytearray(colors))
+        self.color_dim = len(self.color_vector)
 
 
 class PlaceCategory(models.Model):
@@ -100,4 +127,19 @@ class SimilarPlace(models.Model):
     similarity_type = models.CharField(max_length=20, choices=SIMILARITY_TYPES)
     
     class Meta:
-        unique_together = ('main_place', 'similar_place', 'similarity_type')
\ No newline at end of file
+        unique_together = ('main_place', 'similar_place', 'similarity_type')
+
+class PlaceFingerprint(models.Model):
+    """Content hash of the inputs a similarity job last used for a place"""
+    place = models.ForeignKey(Place, on_delete=models.CASCADE, related_name='fingerprints')
+    job = models.CharField(max_length=50)
+    digest = models.CharField(max_length=64)
+    # Stored similarity rows starting at the place when the digest was saved; fewer
+    # now means rows were cascaded away with a deleted neighbour
+    list_length = models.PositiveIntegerField(default=0)
+    
+    def __str__(self):
+        return f"{self.place.name} - {self.job}"
+    
+    class Meta:
+        unique_together = ('place', 'job')
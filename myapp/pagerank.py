@@ -0,0 +1,765 @@
+# myapp/pagerank.py
+"""
+Place graph for the enhanced PageRank. Two places are linked with weight
+0.5 when they share a city plus 0.5 x the Jaccard similarity of their
+categories. The category part is a sparse matrix built from the incidence
+product; the same-city part is dense inside each city, so it is never
+materialized and is applied as a product with the place x city indicator.
+"""
+import os
+import tempfile
+import threading
+from collections import OrderedDict
+
+import numpy as np
+from django.conf import settings
+from scipy import sparse
+
+from myapp.models import PlaceCategory
+from myapp.similarity import load_category_matrix
+
+CITY_WEIGHT = 0.5
+CATEGORY_WEIGHT = 0.5
+
+# Model defaults shared by calculate_pagerank and the personalized ranking
+DAMPING = 0.85
+PAGEVIEW_WEIGHT = 0.3
+LANGUAGE_WEIGHT = 0.2
+
+
+def category_jaccard(incidence):
+    """Sparse Jaccard similarity between every pair of places sharing a category (no diagonal)"""
+    incidence = sparse.csr_matrix(incidence, dtype=np.float64)
+    sizes = np.asarray(incidence.sum(axis=1)).ravel()
+
+    shared = (incidence @ incidence.T).tocoo()
+    off_diagonal = shared.row != shared.col
+    rows = shared.row[off_diagonal]
+    cols = shared.col[off_diagonal]
+    intersection = shared.data[off_diagonal]
+
+    union = sizes[rows] + sizes[cols] - intersection
+    return sparse.csr_matrix((intersection / union, (rows, cols)), shape=shared.shape)
+
+
+class PlaceGraph:
+    """
+    Weighted, symmetric place graph and its row-normalized transition
+    operator, stored in O(n + category links) memory.
+    """
+
+    def __init__(self, place_ids, city_ids, incidence, city_weight=CITY_WEIGHT, category_weight=CATEGORY_WEIGHT,
+                 jaccard=None):
+        self.place_ids = np.asarray(place_ids, dtype=np.int64)
+        self.n = len(self.place_ids)
+        self.city_weight = city_weight
+        self.category_weight = category_weight
+
+        # Place x city indicator: (E @ E.T) is the same-city block matrix
+        self.city_ids = np.asarray(city_ids, dtype=np.int64)
+        cities, city_index = np.unique(self.city_ids, return_inverse=True)
+        self.city_index = city_index
+        self.cities = sparse.csr_matrix(
+            (np.ones(self.n), (np.arange(self.n), city_index)), shape=(self.n, len(cities))
+        )
+        self.city_sizes = np.bincount(city_index, minlength=len(cities)).astype(np.float64)
+        # Places grouped by city: city k is city_order[city_starts[k]:city_starts[k + 1]]
+        self.city_order = np.argsort(city_index, kind='stable')
+        self.city_starts = np.concatenate([[0], np.cumsum(self.city_sizes)]).astype(np.int64)
+
+        # A saved graph passes its Jaccard matrix instead of the incidence matrix
+        self.jaccard = category_jaccard(incidence) if jaccard is None else sparse.csr_matrix(jaccard)
+
+        # Total outgoing weight of every place (the row sums of the dense matrix)
+        self.out_weight = (
+            city_weight * (self.city_sizes[city_index] - 1)
+            + category_weight * np.asarray(self.jaccard.sum(axis=1)).ravel()
+        )
+        self.dangling = self.out_weight == 0
+        self.inverse_out_weight = np.zeros(self.n)
+        self.inverse_out_weight[~self.dangling] = 1 / self.out_weight[~self.dangling]
+
+    def weights(self, x):
+        """W @ x for the (never materialized) weight matrix W"""
+        same_city = self.cities @ (self.cities.T @ x) - x
+        return self.city_weight * same_city + self.category_weight * (self.jaccard @ x)
+
+    def propagate(self, x):
+        """P.T @ x, where P is W with rows normalized to sum to 1 (dangling rows stay 0); x may have columns"""
+        # W is symmetric, so P.T @ x == W @ (x / row sums)
+        inverse = self.inverse_out_weight if x.ndim == 1 else self.inverse_out_weight[:, None]
+        return self.weights(x * inverse)
+
+    def members(self, cities):
+        """Places of the given city indexes, concatenated"""
+        if not len(cities):
+            return np.zeros(0, dtype=np.int64)
+        return np.concatenate([self.city_order[self.city_starts[k]:self.city_starts[k + 1]] for k in cities])
+
+
+def load_graph(places, **weights):
+    """Build the graph for a list of Place objects (in that order)"""
+    place_ids = [place.id for place in places]
+    incidence = load_category_matrix(place_ids)
+    return PlaceGraph(place_ids, [place.city_id for place in places], incidence, **weights)
+
+
+def popularity_counts(places):
+    """Raw page views and language counts of a list of Place objects"""
+    page_views = np.array([place.page_views or 0 for place in places], dtype=np.float64)
+    languages = np.array([place.number_of_languages or 0 for place in places], dtype=np.float64)
+    return page_views, languages
+
+
+def popularity_vectors(places):
+    """Page-view and language-count vectors, each normalized to sum to 1"""
+    page_views, languages = popularity_counts(places)
+
+    vectors = []
+    for values in (page_views, languages):
+        values = values / max(values.max(initial=0), 1)
+        if values.sum() > 0:
+            values = values / values.sum()
+        vectors.append(values)
+    return vectors
+
+
+def power_iteration(graph, bias, damping=0.85, connection_weight=1.0, teleport=None,
+                    max_iterations=100, tolerance=0.0001, start=None, on_iteration=None,
+                    extrapolate_every=None):
+    """
+    Enhanced PageRank by power iteration with sparse mat-vecs:
+
+        x' = (1 - damping) * teleport + damping * (connection_weight * P.T x + bias)
+
+    normalized to sum to 1 each step. `teleport` defaults to uniform. With
+    `extrapolate_every`, quadratic extrapolation (Kamvar et al.) is applied
+    periodically to cancel the slowest-decaying error components.
+    Returns (vector, iterations, last change, converged).
+    """
+    n = graph.n
+    x = np.full(n, 1 / n) if start is None else np.asarray(start, dtype=np.float64)
+    base = (1 - damping) * (np.full(n, 1 / n) if teleport is None else teleport) + damping * bias
+
+    history = [x]
+    diff = np.inf
+    for iteration in range(max_iterations):
+        new_x = base + damping * connection_weight * graph.propagate(x)
+        new_x /= new_x.sum()
+
+        if extrapolate_every and len(history) >= 3 and (iteration + 1) % extrapolate_every == 0:
+            new_x = quadratic_extrapolation(history[-3], history[-2], history[-1], new_x)
+
+        diff = np.linalg.norm(new_x - x)
+        x = new_x
+        history = (history + [x])[-3:]
+        if on_iteration is not None:
+            on_iteration(iteration, diff)
+        if diff < tolerance:
+            return x, iteration + 1, diff, True
+
+    return x, max_iterations, diff, False
+
+
+def quadratic_extrapolation(x0, x1, x2, x3):
+    """Estimate the fixed point from four successive iterates (falls back to x3 if unstable)"""
+    y = np.column_stack([x1 - x0, x2 - x0])
+    gamma, *_ = np.linalg.lstsq(y, -(x3 - x0), rcond=None)
+    gamma1, gamma2, gamma3 = gamma[0], gamma[1], 1.0
+    extrapolated = (gamma1 + gamma2 + gamma3) * x1 + (gamma2 + gamma3) * x2 + gamma3 * x3
+
+    # Only accept a usable probability vector
+    extrapolated = np.clip(extrapolated, 0, None)
+    total = extrapolated.sum()
+    if not np.isfinite(total) or total <= 0:
+        return x3
+    return extrapolated / total
+
+
+def linear_solve(graph, bias, damping=0.85, connection_weight=1.0, teleport=None,
+                 max_iterations=100, tolerance=0.0001, start=None, on_iteration=None):
+    """
+    Solve (I - damping * connection_weight * P.T) x = base with GMRES, then
+    polish with power iteration. Without dangling places the linear system
+    has exactly the power-iteration fixed point; the polish absorbs the
+    renormalization of mass lost at dangling places. Iterations count
+    mat-vecs, like power iteration.
+    """
+    from scipy.sparse.linalg import LinearOperator, gmres
+
+    n = graph.n
+    base = (1 - damping) * (np.full(n, 1 / n) if teleport is None else teleport) + damping * bias
+    operator = LinearOperator(
+        (n, n), matvec=lambda x: x - damping * connection_weight * graph.propagate(x), dtype=np.float64
+    )
+
+    matvecs = []
+    x, _ = gmres(operator, base, x0=start, rtol=tolerance / 10, atol=0, restart=min(n, 30),
+                 maxiter=max_iterations, callback=matvecs.append, callback_type='pr_norm')
+    x = np.clip(x, 0, None)
+    x /= x.sum()
+
+    x, polish, diff, converged = power_iteration(
+        graph, bias, damping=damping, connection_weight=connection_weight, teleport=teleport,
+        max_iterations=max(max_iterations - len(matvecs), 1), tolerance=tolerance, start=x,
+        on_iteration=on_iteration
+    )
+    return x, len(matvecs) + polish, diff, converged
+
+
+BASE_PARTS = 3  # uniform teleport, page views, languages
+
+
+def base_components(page_views, languages, damping=DAMPING, pageview_weight=PAGEVIEW_WEIGHT,
+                    language_weight=LANGUAGE_WEIGHT):
+    """
+    The base vector of power_iteration split into its uniform teleport,
+    page-view and language parts, as the columns of an (n, 3) array. Each
+    column is a fixed vector over one catalog-wide total (n, or the sum of the
+    raw values), so when places come or go the entries of unchanged places
+    all scale by the same factor.
+    """
+    n = len(page_views)
+    columns = [np.full(n, (1 - damping) / n)]
+    for weight, values in ((pageview_weight, page_views), (language_weight, languages)):
+        values = np.asarray(values, dtype=np.float64)
+        total = values.sum()
+        columns.append(damping * weight * values / total if total > 0 else np.zeros(n))
+    return np.column_stack(columns)
+
+
+def _mix64(values):
+    """splitmix64 finalizer: spreads integer ids over 64 bits"""
+    z = np.asarray(values).astype(np.uint64) + np.uint64(0x9E3779B97F4A7C15)
+    z = (z ^ (z >> np.uint64(30))) * np.uint64(0xBF58476D1CE4E5B9)
+    z = (z ^ (z >> np.uint64(27))) * np.uint64(0x94D049BB133111EB)
+    return z ^ (z >> np.uint64(31))
+
+
+def hash_categories(rows, category_ids, n):
+    """Order-independent 64-bit hash of the category set of each of `n` places, from (row, category id) links"""
+    signatures = np.zeros(n, dtype=np.uint64)
+    np.add.at(signatures, np.asarray(rows, dtype=np.int64), _mix64(category_ids))
+    return signatures
+
+
+def category_signatures(place_ids):
+    """hash_categories for `place_ids`, so an update can spot changed categories without the old graph"""
+    index = {place_id: i for i, place_id in enumerate(np.asarray(place_ids).tolist())}
+    rows, category_ids = [], []
+    for place_id, category_id in PlaceCategory.objects.values_list('place_id', 'category_id'):
+        row = index.get(place_id)
+        if row is not None:
+            rows.append(row)
+            category_ids.append(category_id)
+    return hash_categories(rows, category_ids, len(index))
+
+
+def _renormalization(base_total, alpha, components, dangling):
+    """sum(base + A x) for x = the components' total scaled to sum 1: A drops the mass on dangling places"""
+    total = components.sum()
+    return base_total + alpha * (total - components[dangling].sum()) / total
+
+
+def _exact_residual(graph, base, components, c, alpha, rows):
+    """(base + A Y) / c - Y on `rows` only: city sums plus the rows' category links, no full product"""
+    weighted = components * graph.inverse_out_weight[:, None]
+    city_sums = graph.cities.T @ weighted
+    same_city = city_sums[graph.city_index[rows]] - weighted[rows]
+    flow = alpha * (graph.city_weight * same_city + graph.category_weight * (graph.jaccard[rows] @ weighted))
+    return (base[rows] + flow) / c - components[rows]
+
+
+def solution_state(graph, page_views, languages, signatures, vector, damping=DAMPING,
+                   pageview_weight=PAGEVIEW_WEIGHT, language_weight=LANGUAGE_WEIGHT, tolerance=0.0001,
+                   max_iterations=1000):
+    """
+    What local_update needs from a converged `vector`: the solution split
+    into one column per part of the base (the fixed-c linear system
+    c Y = B + A Y solved by Jacobi iteration from the proportional split of
+    `vector`), their residuals, c and the inputs they were computed for.
+    Returns (refined vector, state).
+    """
+    alpha = damping * (1.0 - (pageview_weight + language_weight))
+    base = base_components(page_views, languages, damping, pageview_weight, language_weight)
+    limit = tolerance / (2 * graph.n)
+
+    vector = np.asarray(vector, dtype=np.float64)
+    c = base.sum() + alpha * vector[~graph.dangling].sum() / vector.sum()
+    components = vector[:, None] * base / base.sum(axis=1)[:, None]
+    for _ in range(max_iterations):
+        residual = (base + alpha * graph.propagate(components)) / c - components
+        if np.abs(residual.sum(axis=1)).max() <= limit:
+            break
+        components += residual
+
+    refined = np.clip(components.sum(axis=1), 0, None)
+    return refined / refined.sum(), {
+        'city_ids': graph.city_ids,
+        'signatures': np.asarray(signatures, dtype=np.uint64),
+        'page_views': np.asarray(page_views, dtype=np.float64),
+        'languages': np.asarray(languages, dtype=np.float64),
+        'out_weight': graph.out_weight,
+        'components': components,
+        'residual': residual,
+        'renormalization': np.float64(c),
+        'parameters': update_parameters(graph, damping, pageview_weight, language_weight),
+    }
+
+
+def update_parameters(graph, damping, pageview_weight, language_weight):
+    """The model settings a saved state is only valid for"""
+    return np.array([damping, pageview_weight, language_weight, graph.city_weight, graph.category_weight])
+
+
+def local_update(graph, page_views, languages, signatures, state, damping=DAMPING, pageview_weight=PAGEVIEW_WEIGHT,
+                 language_weight=LANGUAGE_WEIGHT, tolerance=0.0001, max_rounds=1000, max_passes=20):
+    """
+    Update a saved solution_state to the current catalog, working only
+    around what changed.
+
+    Adding or removing places changes every place's teleport (1 / n) and
+    popularity share (value / catalog total), but each part of the base only
+    by one factor, so the saved solution components are rescaled exactly
+    instead of pushed. What is left to push is the residual of the rows whose
+    equation really changed: new places, places with a new city, categories
+    or popularity, and places linked to any place whose outgoing weights
+    changed (those include whole cities that gained or lost a member, and
+    the neighbours of removed places). Their residuals are recomputed
+    exactly; every other row keeps its saved, rescaled residual.
+
+    Rows whose residual (summed over the parts) exceeds tolerance / n are
+    pushed into their neighbours, and the threshold is halved for another
+    pass while the error bound is still above tolerance. Same-city pushes add one uniform amount to
+    a city, which is kept per city and only spread over its members once it matters, so a
+    push costs O(category links) rather than O(city size). After each pass
+    the renormalization constant c is re-estimated; it only moves when mass
+    shifts onto or off dangling places, and then the residual of every place
+    is rescaled exactly, since (base + A Y) = c (r + Y) for the same Y.
+    Returns (vector, new state, stats); stats['touched'] counts the places
+    whose value was pushed.
+    """
+    n = graph.n
+    alpha = damping * (1.0 - (pageview_weight + language_weight))
+    base = base_components(page_views, languages, damping, pageview_weight, language_weight)
+    base_total = base.sum()
+    page_views = np.asarray(page_views, dtype=np.float64)
+    languages = np.asarray(languages, dtype=np.float64)
+
+    # Saved row of every place, -1 for new places
+    saved_ids = state['place_ids']
+    order = np.argsort(saved_ids)
+    positions = np.clip(np.searchsorted(saved_ids[order], graph.place_ids), 0, len(saved_ids) - 1)
+    previous = np.where(saved_ids[order][positions] == graph.place_ids, order[positions], -1)
+    kept = previous >= 0
+    old = previous[kept]
+
+    # Global rescale: the saved solution of each base part scales with that part
+    def ratio(old_total, new_total):
+        return old_total / new_total if new_total > 0 else 0.0
+    scale = np.array([len(saved_ids) / n, ratio(state['page_views'].sum(), page_views.sum()),
+                      ratio(state['languages'].sum(), languages.sum())])
+    components = np.zeros((n, BASE_PARTS))
+    residual = np.zeros((n, BASE_PARTS))
+    components[kept] = state['components'][old] * scale
+    residual[kept] = state['residual'][old] * scale
+    c = float(state['renormalization'])
+    # Halved while the error bound of what is left unpushed is above tolerance
+    limit = tolerance / n
+
+    # Rows whose equation changed
+    changed = ~kept
+    changed[kept] = ((state['city_ids'][old] != graph.city_ids[kept])
+                     | (state['signatures'][old] != np.asarray(signatures, dtype=np.uint64)[kept]))
+    reweighted = changed.copy()
+    reweighted[kept] |= ~np.isclose(graph.out_weight[kept], state['out_weight'][old], rtol=1e-12, atol=0)
+    rebased = changed.copy()
+    rebased[kept] |= (state['page_views'][old] != page_views[kept]) | (state['languages'][old] != languages[kept])
+    sources = np.flatnonzero(reweighted)
+    rows = np.unique(np.concatenate([
+        sources, np.flatnonzero(rebased), graph.members(np.unique(graph.city_index[sources])),
+        graph.jaccard[sources].indices,
+    ])).astype(np.int64)
+    if len(rows):
+        residual[rows] = _exact_residual(graph, base, components, c, alpha, rows)
+
+    pending = np.zeros((len(graph.city_sizes), BASE_PARTS))
+
+    def error_bound():
+        # Per-city amounts count once for every member they have not reached yet
+        left = np.abs(residual.sum(axis=1)).sum() + (graph.city_sizes * np.abs(pending.sum(axis=1))).sum()
+        return float(left / (1 - alpha / c)) if alpha < c else float('inf')
+
+    touched = np.zeros(n, dtype=bool)
+    candidates = rows
+    rounds = 0
+    pushes = 0
+    passes = 0
+    converged = False
+    while passes < max_passes:
+        passes += 1
+        coefficient = alpha / c
+        while rounds < max_rounds:
+            active = candidates[np.abs(residual[candidates].sum(axis=1)) > limit]
+            if not len(active):
+                break
+            rounds += 1
+            pushes += len(active)
+            touched[active] = True
+
+            amounts = residual[active]
+            components[active] += amounts
+            residual[active] = 0
+            # Dangling places push nothing; that lost mass is what c accounts for
+            shares = coefficient * amounts * graph.inverse_out_weight[active][:, None]
+
+            # Same-city links: every other place of the city receives city_weight * share
+            cities = graph.city_index[active]
+            np.add.at(pending, cities, graph.city_weight * shares)
+            residual[active] -= graph.city_weight * shares
+
+            # Category links (the Jaccard matrix is symmetric)
+            neighbours = graph.jaccard[active]
+            np.add.at(residual, neighbours.indices,
+                      graph.category_weight * neighbours.data[:, None]
+                      * np.repeat(shares, np.diff(neighbours.indptr), axis=0))
+
+            # A city's uniform amount is only spread over its members once it could activate them
+            cities = np.unique(cities)
+            due = cities[np.abs(pending[cities].sum(axis=1)) > limit]
+            members = graph.members(due)
+            residual[members] += pending[graph.city_index[members]]
+            pending[due] = 0
+            candidates = np.unique(np.concatenate([active, neighbours.indices, members]))
+        else:
+            break
+
+        new_c = _renormalization(base_total, alpha, components, graph.dangling)
+        if abs(new_c - c) <= limit:
+            if error_bound() <= tolerance:
+                converged = True
+                break
+            # Many small residuals can add up: push again with a finer threshold
+            limit /= 2
+            due = np.flatnonzero(np.abs(pending.sum(axis=1)) > limit)
+            members = graph.members(due)
+            residual[members] += pending[graph.city_index[members]]
+            pending[due] = 0
+            candidates = np.flatnonzero(np.abs(residual.sum(axis=1)) > limit)
+            continue
+        # Same Y, new constant: (base + A Y) = c (r + Y), so the residual is rescaled exactly
+        residual = c * (residual + components) / new_c - components
+        pending *= c / new_c
+        c = new_c
+        candidates = np.arange(n)
+
+    # Leave no per-city amounts behind in the saved residual
+    waiting = np.flatnonzero(np.abs(pending).max(axis=1) > 0)
+    members = graph.members(waiting)
+    residual[members] += pending[graph.city_index[members]]
+    pending[waiting] = 0
+
+    vector = np.clip(components.sum(axis=1), 0, None)
+    vector /= vector.sum()
+    stats = {
+        'rows': len(rows),
+        'rounds': rounds,
+        'passes': passes,
+        'pushes': pushes,
+        'touched': int(touched.sum()),
+        'residual': float(np.abs(residual.sum(axis=1)).sum()),
+        'error_bound': error_bound(),
+        'converged': converged,
+    }
+    new_state = {
+        'city_ids': graph.city_ids,
+        'signatures': np.asarray(signatures, dtype=np.uint64),
+        'page_views': page_views,
+        'languages': languages,
+        'out_weight': graph.out_weight,
+        'components': components,
+        'residual': residual,
+        'renormalization': np.float64(c),
+        'parameters': update_parameters(graph, damping, pageview_weight, language_weight),
+    }
+    return vector, new_state, stats
+
+
+SOLVERS = ['power', 'extrapolation', 'gmres']
+
+
+def solve(graph, bias, solver='power', **options):
+    """Run one of SOLVERS; returns (vector, iterations, last change, converged)"""
+    if solver == 'gmres':
+        return linear_solve(graph, bias, **options)
+    if solver == 'extrapolation':
+        options.setdefault('extrapolate_every', 10)
+    return power_iteration(graph, bias, **options)
+
+
+VECTOR_FILENAME = 'pagerank.npz'
+
+
+def vector_path():
+    return os.path.join(settings.SIMILARITY_DATA_DIR, VECTOR_FILENAME)
+
+
+def save_vector(place_ids, vector, path=None, state=None):
+    """Persist a converged vector keyed by place id, with its solution_state if given (written atomically)"""
+    path = path or vector_path()
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.npz')
+    with os.fdopen(fd, 'wb') as f:
+        np.savez(f, place_ids=np.asarray(place_ids, dtype=np.int64), vector=vector, **(state or {}))
+    os.replace(tmp_path, path)
+
+
+def load_state(parameters, path=None):
+    """
+    The solution_state saved with the last vector, or None if there is none
+    or it was computed with other `parameters` (see update_parameters)
+    """
+    try:
+        with np.load(path or vector_path()) as data:
+            state = {key: data[key] for key in data.files}
+    except (OSError, ValueError):
+        return None
+    if 'components' not in state or not len(state['place_ids']):
+        return None
+    if not np.allclose(state['parameters'], parameters, rtol=0, atol=1e-12):
+        return None
+    return state
+
+
+def load_start_vector(place_ids, path=None):
+    """
+    Warm-start vector for `place_ids` from the last saved run: known places
+    keep their value, new places get the mean value, and the result is
+    renormalized. Returns None when there is nothing to start from.
+    """
+    try:
+        with np.load(path or vector_path()) as data:
+            saved_ids = data['place_ids']
+            saved = data['vector']
+    except (OSError, KeyError, ValueError):
+        return None
+
+    place_ids = np.asarray(place_ids, dtype=np.int64)
+    order = np.argsort(saved_ids)
+    positions = np.clip(np.searchsorted(saved_ids[order], place_ids), 0, max(len(saved_ids) - 1, 0))
+    known = saved_ids[order][positions] == place_ids if len(saved_ids) else np.zeros(len(place_ids), dtype=bool)
+    if not known.any():
+        return None
+
+    start = np.full(len(place_ids), saved[order][positions][known].mean())
+    start[known] = saved[order][positions][known]
+    return start / start.sum()
+
+
+def scale_scores(vector, min_score=0.1, max_score=5.0):
+    """Map raw PageRank values linearly onto [min_score, max_score]"""
+    low = vector.min()
+    high = vector.max()
+    # Avoid division by zero if all scores are identical
+    if high == low:
+        return np.full(len(vector), (min_score + max_score) / 2)
+    return min_score + (vector - low) * (max_score - min_score) / (high - low)
+
+
+RANKER_FILENAME = 'personalized_pagerank.npz'
+
+
+def ranker_path():
+    return os.path.join(settings.SIMILARITY_DATA_DIR, RANKER_FILENAME)
+
+
+def category_members(place_ids):
+    """Category id -> array of positions in `place_ids` of its places"""
+    index = {place_id: i for i, place_id in enumerate(np.asarray(place_ids).tolist())}
+    members = {}
+    for place_id, category_id in PlaceCategory.objects.values_list('place_id', 'category_id'):
+        position = index.get(place_id)
+        if position is not None:
+            members.setdefault(category_id, []).append(position)
+    return {category_id: np.array(positions) for category_id, positions in members.items()}
+
+
+class PersonalizedPageRank:
+    """
+    Query-time PageRank with the teleport (and popularity) mass restricted to
+    a set of places: a city, a category, a user's liked places. The graph,
+    popularity vectors and global ranking are prepared by calculate_pagerank
+    and saved to disk; web processes only load them. Every query warm-starts
+    from the global ranking and results are kept in a small LRU cache keyed
+    by the personalization, guarded by a lock for threaded servers.
+    """
+
+    def __init__(self, graph, city_ids, page_views, languages, members, global_vector=None,
+                 damping=DAMPING, pageview_weight=PAGEVIEW_WEIGHT, language_weight=LANGUAGE_WEIGHT,
+                 tolerance=1e-6, max_iterations=50, cache_size=256):
+        self.graph = graph
+        self.index = {place_id: i for i, place_id in enumerate(self.graph.place_ids.tolist())}
+        self.city_ids = np.asarray(city_ids, dtype=np.int64)
+        self.category_members = members
+
+        self.damping = damping
+        self.connection_weight = 1.0 - (pageview_weight + language_weight)
+        self.page_views = np.asarray(page_views, dtype=np.float64)
+        self.languages = np.asarray(languages, dtype=np.float64)
+        self.pageview_weight = pageview_weight
+        self.language_weight = language_weight
+        self.tolerance = tolerance
+        self.max_iterations = max_iterations
+
+        if global_vector is None:
+            global_vector, *_ = power_iteration(
+                self.graph, self._bias(np.ones(self.graph.n, dtype=bool)), damping=damping,
+                connection_weight=self.connection_weight, max_iterations=max_iterations, tolerance=tolerance
+            )
+        self.global_vector = np.asarray(global_vector, dtype=np.float64)
+        self.cache = OrderedDict()
+        self.cache_size = cache_size
+        self.lock = threading.Lock()
+
+    @classmethod
+    def from_places(cls, places, graph=None, global_vector=None, **options):
+        """Prepare a ranker for a list of Place objects, reusing an already built graph and global vector"""
+        graph = graph if graph is not None else load_graph(places)
+        page_views, languages = popularity_vectors(places)
+        return cls(graph, [place.city_id for place in places], page_views, languages,
+                   category_members(graph.place_ids), global_vector=global_vector, **options)
+
+    def save(self, path=None):
+        """Write everything a query needs to one .npz file (atomically, like save_vector)"""
+        path = path or ranker_path()
+        category_ids = np.array(sorted(self.category_members), dtype=np.int64)
+        positions = [self.category_members[category_id] for category_id in category_ids.tolist()]
+        jaccard = self.graph.jaccard
+        arrays = {
+            'place_ids': self.graph.place_ids,
+            'city_ids': self.city_ids,
+            'jaccard_data': jaccard.data,
+            'jaccard_indices': jaccard.indices,
+            'jaccard_indptr': jaccard.indptr,
+            'weights': np.array([self.graph.city_weight, self.graph.category_weight,
+                                 self.damping, self.pageview_weight, self.language_weight]),
+            'page_views': self.page_views,
+            'languages': self.languages,
+            'global_vector': self.global_vector,
+            'category_ids': category_ids,
+            'member_indptr': np.concatenate([[0], np.cumsum([len(p) for p in positions])]).astype(np.int64),
+            'member_positions': np.concatenate(positions).astype(np.int64) if positions else np.zeros(0, dtype=np.int64),
+        }
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.npz')
+        with os.fdopen(fd, 'wb') as f:
+            np.savez(f, **arrays)
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path=None, **options):
+        with np.load(path or ranker_path()) as data:
+            city_weight, category_weight, damping, pageview_weight, language_weight = data['weights'].tolist()
+            n = len(data['place_ids'])
+            jaccard = sparse.csr_matrix(
+                (data['jaccard_data'], data['jaccard_indices'], data['jaccard_indptr']), shape=(n, n)
+            )
+            graph = PlaceGraph(data['place_ids'], data['city_ids'], None, city_weight=city_weight,
+                               category_weight=category_weight, jaccard=jaccard)
+            indptr = data['member_indptr']
+            positions = data['member_positions']
+            members = {
+                category_id: positions[indptr[i]:indptr[i + 1]]
+                for i, category_id in enumerate(data['category_ids'].tolist())
+            }
+            return cls(graph, data['city_ids'], data['page_views'], data['languages'], members,
+                       global_vector=data['global_vector'], damping=damping,
+                       pageview_weight=pageview_weight, language_weight=language_weight, **options)
+
+    def _bias(self, mask):
+        """Popularity vectors restricted to `mask`, keeping their total weight"""
+        bias = np.zeros(self.graph.n)
+        for weight, vector in ((self.pageview_weight, self.page_views), (self.language_weight, self.languages)):
+            restricted = np.where(mask, vector, 0)
+            total = restricted.sum()
+            if total > 0:
+                bias += weight * restricted / total
+        return bias
+
+    def teleport_mask(self, city_id=None, category_id=None, liked=()):
+        """Places that receive teleport mass: the city/category filter, plus liked places"""
+        filtered = city_id is not None or category_id is not None
+        mask = np.full(self.graph.n, filtered)
+        if city_id is not None:
+            mask &= self.city_ids == city_id
+        if category_id is not None:
+            members = np.zeros(self.graph.n, dtype=bool)
+            members[self.category_members.get(category_id, [])] = True
+            mask &= members
+        for place_id in liked:
+            if place_id in self.index:
+                mask[self.index[place_id]] = True
+        return mask
+
+    def scores(self, city_id=None, category_id=None, liked=()):
+        """Personalized PageRank vector (sums to 1), or None if nothing matches"""
+        key = (city_id, category_id, tuple(sorted(set(liked))))
+        with self.lock:
+            if key in self.cache:
+                self.cache.move_to_end(key)
+                return self.cache[key]
+
+        mask = self.teleport_mask(city_id, category_id, liked)
+        if not mask.any():
+            return None
+
+        # Solved outside the lock; two threads may compute the same key, which is harmless
+        teleport = mask / mask.sum()
+        vector, *_ = power_iteration(
+            self.graph, self._bias(mask), damping=self.damping, connection_weight=self.connection_weight,
+            teleport=teleport, max_iterations=self.max_iterations, tolerance=self.tolerance,
+            start=self.global_vector
+        )
+
+        with self.lock:
+            self.cache[key] = vector
+            self.cache.move_to_end(key)
+            while len(self.cache) > self.cache_size:
+                self.cache.popitem(last=False)
+        return vector
+
+    def rank(self, place_ids, **personalization):
+        """
+        Sort `place_ids` by personalized score, best first; returns (place_id,
+        score) pairs. Places added since the ranker was saved are left out.
+        """
+        vector = self.scores(**personalization)
+        if vector is None:
+            return []
+        ranked = [(place_id, float(vector[self.index[place_id]])) for place_id in place_ids if place_id in self.index]
+        ranked.sort(key=lambda item: -item[1])
+        return ranked
+
+
+_ranker = None
+_ranker_mtime = None
+_ranker_lock = threading.Lock()
+
+
+def get_ranker():
+    """
+    The process-wide personalized ranker, loaded from the file calculate_pagerank
+    writes and reloaded when that file changes. Checking costs one stat call and
+    no queries; returns None until the command has run.
+    """
+    global _ranker, _ranker_mtime
+    path = ranker_path()
+    try:
+        mtime = os.path.getmtime(path)
+    except OSError:
+        return None
+    with _ranker_lock:
+        if _ranker is None or mtime != _ranker_mtime:
+            _ranker = PersonalizedPageRank.load(path)
+            _ranker_mtime = mtime
+        return _ranker
@@ -0,0 +1,151 @@
+# myapp/palettes.py
+"""
+Dominant-color extractors. Each one takes a batch of (N, 3) pixel arrays and
+returns one (centroids, counts) pair per image; `extract_palettes` turns those
+into the flat, most-common-first color lists stored in color_vector.
+
+    kmeans2      scipy k-means on every pixel (the original method, now seeded)
+    median-cut   Pillow's median-cut quantizer
+    minibatch    mini-batch k-means on a pixel subsample, vectorized over the batch
+
+All of them are deterministic for a given seed.
+"""
+import zlib
+
+import numpy as np
+from PIL import Image
+from scipy.cluster.vq import kmeans2
+
+DEFAULT_METHOD = 'minibatch'
+PALETTE_SIZE = 10
+SEED = 0
+
+# Mini-batch k-means settings
+SAMPLE_SIZE = 2048
+MINIBATCH_SIZE = 256
+MINIBATCH_ITERATIONS = 30
+
+
+def kmeans2_palettes(batch, k, seed):
+    results = []
+    for pixels in batch:
+        centroids, labels = kmeans2(pixels.astype(np.float64), k=k, minit='points', seed=seed)
+        results.append((centroids, np.bincount(labels, minlength=k)))
+    return results
+
+
+def median_cut_palettes(batch, k, seed):
+    results = []
+    for pixels in batch:
+        image = Image.fromarray(np.ascontiguousarray(pixels, dtype=np.uint8).reshape(1, -1, 3))
+        quantized = image.quantize(colors=k, method=Image.Quantize.MEDIANCUT)
+        labels = np.asarray(quantized).ravel()
+        palette = np.array(quantized.getpalette()[:3 * k], dtype=np.float64).reshape(-1, 3)
+        counts = np.bincount(labels, minlength=len(palette))[:len(palette)]
+        results.append((palette, counts))
+    return results
+
+
+def _squared_distances(points, centers):
+    """(B, M, 3) x (B, k, 3) -> (B, M, k) squared Euclidean distances"""
+    return (
+        (points * points).sum(axis=2)[:, :, None]
+        - 2 * (points @ centers.transpose(0, 2, 1))
+        + (centers * centers).sum(axis=2)[:, None, :]
+    )
+
+
+def _nearest(points, centers):
+    """Index of the nearest center for every point (the |point|^2 term doesn't change the argmin)"""
+    return ((centers * centers).sum(axis=2)[:, None, :] - 2 * (points @ centers.transpose(0, 2, 1))).argmin(axis=2)
+
+
+def minibatch_palettes(batch, k, seed):
+    """
+    Mini-batch k-means (k-means++ seeding, per-center learning rates) on a
+    fixed random subsample of each image, with all images of the batch
+    stacked into one array. Final counts come from assigning every pixel.
+    The seeding draws of each image come from its own pixels, so a palette
+    does not depend on which other images share its batch.
+    """
+    pixels = np.stack([p.astype(np.float32) for p in batch])
+    n_images, n_pixels, _ = pixels.shape
+    rng = np.random.default_rng(seed)
+    images = np.arange(n_images)
+    draws = np.stack([np.random.default_rng([seed, zlib.crc32(p.tobytes())]).random(k) for p in batch])
+
+    sample = pixels[:, rng.choice(n_pixels, min(SAMPLE_SIZE, n_pixels), replace=False)]
+    n_sample = sample.shape[1]
+
+    # k-means++ seeding, one draw per image per center
+    centers = np.empty((n_images, k, 3), dtype=np.float32)
+    centers[:, 0] = sample[images, (draws[:, 0] * n_sample).astype(int)]
+    nearest = _squared_distances(sample, centers[:, :1])[:, :, 0]
+    for j in range(1, k):
+        weights = np.maximum(nearest, 0)
+        # Images with fewer than j distinct colors draw uniformly
+        weights[weights.sum(axis=1) == 0] = 1
+        cumulative = np.cumsum(weights, axis=1)
+        targets = draws[:, j] * cumulative[:, -1]
+        picks = np.minimum((cumulative <= targets[:, None]).sum(axis=1), n_sample - 1)
+        centers[:, j] = sample[images, picks]
+        nearest = np.minimum(nearest, _squared_distances(sample, centers[:, j:j + 1])[:, :, 0])
+
+    seen = np.zeros((n_images, k), dtype=np.float32)
+    clusters = np.arange(k)
+    for _ in range(MINIBATCH_ITERATIONS):
+        points = sample[:, rng.choice(n_sample, min(MINIBATCH_SIZE, n_sample), replace=False)]
+        labels = _nearest(points, centers)
+        members = (labels[:, :, None] == clusters).astype(np.float32)
+        assigned = members.sum(axis=1)
+        sums = members.transpose(0, 2, 1) @ points
+        seen += assigned
+        # Each center moves to the running mean of every point it has been given
+        step = (sums - assigned[:, :, None] * centers) / np.maximum(seen, 1)[:, :, None]
+        centers += step
+
+    labels = _nearest(pixels, centers)
+    counts = (labels[:, :, None] == clusters).sum(axis=1)
+    return list(zip(centers.astype(np.float64), counts))
+
+
+EXTRACTORS = {
+    'kmeans2': kmeans2_palettes,
+    'median-cut': median_cut_palettes,
+    'minibatch': minibatch_palettes,
+}
+
+
+def to_color_vector(centroids, counts, k=PALETTE_SIZE):
+    """
+    Flat [r, g, b, ...] list of `k` colors, most common first (ties broken by
+    color so the order is stable). Empty clusters are dropped and the list is
+    padded with the most common color, so no image is lost to an empty
+    cluster. Returns [] only if there were no pixels at all.
+    """
+    centroids = np.clip(np.asarray(centroids, dtype=np.float64), 0, 255).astype(int)
+    counts = np.asarray(counts)
+    used = counts > 0
+    centroids, counts = centroids[used], counts[used]
+    if not len(counts):
+        return []
+
+    order = np.lexsort((centroids[:, 2], centroids[:, 1], centroids[:, 0], -counts))
+    colors = centroids[order][:k].tolist()
+    colors += [colors[0]] * (k - len(colors))
+    return [c for color in colors for c in color]
+
+
+def extract_palettes(batch, method=DEFAULT_METHOD, k=PALETTE_SIZE, seed=SEED):
+    """Color vectors for a batch of (N, 3) pixel arrays"""
+    if not batch:
+        return []
+    return [to_color_vector(centroids, counts, k) for centroids, counts in EXTRACTORS[method](batch, k, seed)]
+
+
+def quantization_error(pixels, colors):
+    """RMS distance (0-255 RGB units) from each pixel to its nearest palette color"""
+    palette = np.asarray(colors, dtype=np.float64).reshape(1, -1, 3)
+    points = np.asarray(pixels, dtype=np.float64)[None]
+    distances = _squared_distances(points, palette)[0].min(axis=1)
+    return float(np.sqrt(np.maximum(distances, 0).mean()))
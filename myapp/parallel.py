@@ -0,0 +1,131 @@
+# myapp/parallel.py
+"""
+Process-pool backend for the similarity job. The catalog arrays are placed in
+shared memory once, so workers read them without copying; only tile
+descriptors go out and compact result records come back.
+
+Nothing here imports the models at module level, so workers started with the
+'spawn' method can set Django up themselves before touching myapp code.
+"""
+import os
+from multiprocessing import get_context, shared_memory
+
+import numpy as np
+
+
+def available_cores():
+    """Cores this process may run on (respects CPU affinity where supported)"""
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:
+        return os.cpu_count() or 1
+
+
+class SharedArrays:
+    """A dict of NumPy arrays copied into named shared-memory blocks"""
+
+    def __init__(self, arrays):
+        self.blocks = []
+        self.specs = {}
+        for key, array in arrays.items():
+            array = np.ascontiguousarray(array)
+            block = shared_memory.SharedMemory(create=True, size=max(array.nbytes, 1))
+            np.ndarray(array.shape, dtype=array.dtype, buffer=block.buf)[...] = array
+            self.blocks.append(block)
+            self.specs[key] = (block.name, array.shape, array.dtype.str)
+
+    def close(self):
+        for block in self.blocks:
+            block.close()
+            block.unlink()
+        self.blocks = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def attach(specs):
+    """Map shared-memory blocks back to arrays (zero-copy); returns (arrays, blocks)"""
+    arrays = {}
+    blocks = []
+    for key, (name, shape, dtype) in specs.items():
+        block = shared_memory.SharedMemory(name=name)
+        blocks.append(block)
+        arrays[key] = np.ndarray(shape, dtype=dtype, buffer=block.buf)
+    return arrays, blocks
+
+
+# Per-worker state, set up once by the pool initializer
+_worker = {}
+
+
+def _init_worker(specs, structural, image):
+    import django
+    from django.apps import apps
+    if not apps.ready:
+        django.setup()
+    from myapp.similarity import make_families
+
+    catalog, blocks = attach(specs)
+    _worker['catalog'] = catalog
+    _worker['blocks'] = blocks  # keep the mappings alive
+    _worker['families'] = {f['job']: f for f in make_families(catalog, structural, image)}
+
+
+def _run_tile(task):
+    from myapp.similarity import score_tile
+
+    job, rows, cols, diagonal, top_k, mirror = task
+    catalog = _worker['catalog']
+    if mirror == 'mask':
+        mirror = catalog[f'{job}_mirror']
+    return score_tile(_worker['families'][job], len(catalog['place_ids']),
+                      rows, cols, diagonal, top_k=top_k, mirror=mirror)
+
+
+def _init_matrix_worker(specs, writer):
+    import django
+    from django.apps import apps
+    if not apps.ready:
+        django.setup()
+
+    catalog, blocks = attach(specs)
+    _worker['catalog'] = catalog
+    _worker['blocks'] = blocks
+    _worker['writer'] = writer.open()
+
+
+def _fill_rows(rows):
+    from myapp.score_matrix import fill_rows
+
+    written = fill_rows(_worker['writer'], _worker['catalog'], rows)
+    _worker['writer'].scores.flush()
+    return written
+
+
+def run_tiles(arrays, structural, image, tasks, workers=None):
+    """
+    Score `tasks` ((job, rows, cols, diagonal, top_k, mirror) tuples) on a
+    worker pool and yield each tile's result records as soon as it is done.
+    `mirror` is True, None, or 'mask' to use the shared '<job>_mirror' array.
+    """
+    workers = workers or available_cores()
+    with SharedArrays(arrays) as shared:
+        with get_context().Pool(workers, initializer=_init_worker,
+                                initargs=(shared.specs, structural, image)) as pool:
+            yield from pool.imap_unordered(_run_tile, tasks)
+
+
+def run_matrix_rows(arrays, writer, row_blocks, workers=None):
+    """
+    Fill the score matrix of `writer` (a MatrixWriter) on a worker pool, one
+    block of rows per task, and yield the number of rows written per block.
+    """
+    workers = workers or available_cores()
+    with SharedArrays(arrays) as shared:
+        with get_context().Pool(workers, initializer=_init_matrix_worker,
+                                initargs=(shared.specs, writer)) as pool:
+            yield from pool.imap_unordered(_fill_rows, row_blocks)
@@ -0,0 +1,181 @@
+# myapp/score_matrix.py
+"""
+Dense, memory-mapped storage for image similarities. Every pair has a color
+score, so instead of two SimilarPlace rows per pair the scores are kept as
+one quantized n x n matrix (float16 or uint8) next to the place and city id
+arrays. Same-city and different-city lists are split at lookup time.
+"""
+import json
+import os
+import tempfile
+import uuid
+
+import numpy as np
+from django.conf import settings
+
+from myapp.similarity import image_block
+
+MATRIX_NAME = 'image_scores'
+MATRIX_DTYPES = ['float16', 'uint8']
+UINT8_SCALE = 255
+
+
+def matrix_dir():
+    """Directory holding the score matrix files"""
+    return settings.SIMILARITY_DATA_DIR
+
+
+def manifest_path(directory=None):
+    return os.path.join(directory or matrix_dir(), f'{MATRIX_NAME}.json')
+
+
+def quantize(scores, dtype):
+    """Encode [0, 1] scores for storage"""
+    if dtype == 'uint8':
+        return np.round(np.clip(scores, 0, 1) * UINT8_SCALE).astype(np.uint8)
+    return scores.astype(np.float16)
+
+
+def dequantize(values, dtype):
+    """Decode stored scores back to 3-decimal floats like the SimilarPlace rows"""
+    values = values.astype(np.float64)
+    if dtype == 'uint8':
+        values /= UINT8_SCALE
+    return np.round(values, 3)
+
+
+class MatrixWriter:
+    """
+    Writes a new score matrix next to the published one. Processes fill row
+    blocks of the same file independently; `publish` then swaps the manifest
+    atomically, so readers switch over on their next lookup.
+    """
+
+    def __init__(self, version, directory=None, dtype='float16'):
+        self.directory = directory or matrix_dir()
+        self.version = version
+        self.dtype = dtype
+        self.scores_path = os.path.join(self.directory, f'{MATRIX_NAME}-{version}.npy')
+        self.index_path = os.path.join(self.directory, f'{MATRIX_NAME}-{version}.npz')
+
+    @classmethod
+    def create(cls, place_ids, city_ids, has_colors, directory=None, dtype='float16'):
+        """Allocate the matrix file and write the id arrays (run once, before any `open`)"""
+        writer = cls(uuid.uuid4().hex[:12], directory, dtype)
+        os.makedirs(writer.directory, exist_ok=True)
+        n = len(place_ids)
+        np.lib.format.open_memmap(writer.scores_path, mode='w+', dtype=dtype, shape=(n, n)).flush()
+        np.savez(writer.index_path, place_ids=place_ids, city_ids=city_ids, has_colors=has_colors)
+        return writer
+
+    def open(self):
+        """Map the matrix for writing; every process calls this once"""
+        self.scores = np.load(self.scores_path, mmap_mode='r+')
+        return self
+
+    def write_rows(self, rows, scores):
+        self.scores[rows] = quantize(scores, self.dtype)
+
+    def close(self):
+        self.scores.flush()
+        del self.scores
+
+    def publish(self):
+        """Point the manifest at this matrix and remove the previous one"""
+        previous = read_manifest(self.directory)
+        n = len(np.load(self.scores_path, mmap_mode='r'))
+        manifest = {'version': self.version, 'dtype': self.dtype, 'places': n}
+
+        fd, tmp_path = tempfile.mkstemp(dir=self.directory, suffix='.json')
+        with os.fdopen(fd, 'w') as f:
+            json.dump(manifest, f)
+        os.replace(tmp_path, manifest_path(self.directory))
+
+        # Open readers keep their mapping of the old files until they reload
+        if previous and previous['version'] != self.version:
+            old = MatrixWriter(previous['version'], self.directory)
+            for path in (old.scores_path, old.index_path):
+                if os.path.exists(path):
+                    os.remove(path)
+        return manifest
+
+
+def read_manifest(directory=None):
+    try:
+        with open(manifest_path(directory)) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+class ScoreMatrix:
+    """Read-only, memory-mapped view of a published score matrix"""
+
+    def __init__(self, manifest, directory=None):
+        files = MatrixWriter(manifest['version'], directory, manifest['dtype'])
+        self.version = manifest['version']
+        self.dtype = manifest['dtype']
+        self.scores = np.load(files.scores_path, mmap_mode='r')
+        with np.load(files.index_path) as index:
+            self.place_ids = index['place_ids']
+            self.city_ids = index['city_ids']
+            self.has_colors = index['has_colors']
+        self.rows = {place_id: i for i, place_id in enumerate(self.place_ids.tolist())}
+
+    def __contains__(self, place_id):
+        return place_id in self.rows
+
+    def top_k(self, place_id, k=3, same_city=True):
+        """
+        Best `k` places by color for one place, reading a single matrix row.
+        Returns (place_id, score) pairs, best first.
+        """
+        row = self.rows.get(place_id)
+        if row is None or not self.has_colors[row]:
+            return []
+
+        scores = dequantize(self.scores[row], self.dtype)
+        in_city = self.city_ids == self.city_ids[row]
+        valid = self.has_colors & (in_city if same_city else ~in_city)
+        valid[row] = False
+
+        candidates = np.flatnonzero(valid)
+        if len(candidates) > k:
+            candidates = candidates[np.argpartition(-scores[candidates], k - 1)[:k]]
+        # Highest score first, lower place id first on ties
+        candidates = candidates[np.lexsort((self.place_ids[candidates], -scores[candidates]))]
+        return list(zip(self.place_ids[candidates].tolist(), scores[candidates].tolist()))
+
+
+_cached_matrix = None
+_cached_mtime = None
+
+
+def get_matrix():
+    """
+    The published score matrix, mapped once per process; the manifest is
+    only read again when a publish has replaced it
+    """
+    global _cached_matrix, _cached_mtime
+    try:
+        mtime = os.path.getmtime(manifest_path())
+    except OSError:
+        return None
+    if _cached_matrix is None or mtime != _cached_mtime:
+        manifest = read_manifest()
+        if manifest is None:
+            return None
+        if _cached_matrix is None or _cached_matrix.version != manifest['version']:
+            try:
+                _cached_matrix = ScoreMatrix(manifest)
+            except OSError:
+                return None
+        _cached_mtime = mtime
+    return _cached_matrix
+
+
+def fill_rows(writer, catalog, rows):
+    """Score `rows` against every place and store them in the open matrix"""
+    scores, _, _ = image_block(catalog['colors'], catalog['has_colors'], catalog['city_ids'], rows)
+    writer.write_rows(rows, scores)
+    return len(rows)
@@ -0,0 +1,449 @@
+# myapp/similarity.py
+import hashlib
+from operator import itemgetter
+import numpy as np
+from django.db import connection
+from scipy import sparse
+
+from myapp.models import Place, PlaceCategory, PlaceImage, PlaceFingerprint, SimilarPlace
+
+# Structural similarity settings (kept identical to the original pairwise loop)
+STRUCTURAL_THRESHOLD = 0.1
+SAME_CITY_WEIGHT = 0.7
+SAME_CITY_BOOST = 0.3
+
+
+def load_category_matrix(place_ids):
+    """Build a place x category sparse incidence matrix for the given place ids"""
+    index = {place_id: i for i, place_id in enumerate(place_ids)}
+
+    rows = []
+    cols = []
+    category_index = {}
+    for place_id, category_id in PlaceCategory.objects.values_list('place_id', 'category_id'):
+        row = index.get(place_id)
+        if row is None:
+            continue
+        rows.append(row)
+        cols.append(category_index.setdefault(category_id, len(category_index)))
+
+    data = np.ones(len(rows), dtype=np.float64)
+    matrix = sparse.csr_matrix((data, (rows, cols)), shape=(len(place_ids), len(category_index)))
+    # unique_together guarantees 0/1 entries, but collapse duplicates just in case
+    matrix.data[:] = 1.0
+    return matrix
+
+
+def category_sizes(incidence):
+    """Number of categories of every place (row sums of the incidence matrix)"""
+    return np.asarray(incidence.sum(axis=1)).ravel()
+
+
+def load_color_matrix(place_ids):
+    """
+    Load every place's color vector with one query into a dense float32
+    matrix with L2-normalized rows. The uint8 blobs are concatenated and
+    decoded by a single np.frombuffer. Vectors are cropped to the shortest
+    length among them before normalizing, so the norms are those of the
+    values the dot products actually use. When a place has several colored
+    images the last one (by id) wins.
+    Returns (matrix, has_colors mask).
+    """
+    place_ids = np.asarray(place_ids, dtype=np.int64)
+
+    # Raw cursor: skipping the ORM row machinery matters at millions of rows
+    query = PlaceImage.objects.filter(color_dim__gt=0).order_by('id').values_list('place_id', 'color_vector')
+    sql, params = query.query.sql_with_params()
+    with connection.cursor() as cursor:
+        cursor.execute(sql, params)
+        records = cursor.fetchall()
+    image_places = np.fromiter(map(itemgetter(0), records), dtype=np.int64, count=len(records))
+    dims = np.fromiter((len(blob) for _, blob in records), dtype=np.int64, count=len(records))
+    values = np.frombuffer(b''.join(map(itemgetter(1), records)), dtype=np.uint8)
+
+    # Matrix row of every image, -1 for places that were not asked for
+    order = np.argsort(place_ids, kind='stable')
+    positions = np.searchsorted(place_ids[order], image_places).clip(max=max(len(place_ids) - 1, 0))
+    rows = np.where(place_ids[order][positions] == image_places, order[positions], -1) if len(place_ids) else positions - 1
+
+    # Last image of each place
+    images = np.flatnonzero(rows >= 0)
+    latest = np.zeros(len(place_ids), dtype=np.int64)
+    latest[rows[images]] = images
+    images = np.unique(latest[rows[images]])
+
+    dim = int(dims[images].min()) if len(images) else 0
+    matrix = np.zeros((len(place_ids), dim), dtype=np.float32)
+    if len(images) and (dims == dim).all():
+        matrix[rows[images]] = values.reshape(-1, dim)[images]
+    elif len(images):
+        # Mixed lengths: gather the first `dim` values of every vector
+        starts = np.cumsum(dims) - dims
+        matrix[rows[images]] = values[starts[images][:, None] + np.arange(dim)]
+
+    norms = np.linalg.norm(matrix, axis=1)
+    has_colors = norms > 0
+    matrix[has_colors] /= norms[has_colors][:, None]
+    return matrix, has_colors
+
+
+def load_catalog(structural=True, image=True):
+    """
+    Load every input of a similarity run once, as plain NumPy arrays that can
+    be broadcast to other processes: place and city ids, the category
+    incidence matrix in CSR form and the normalized color matrix.
+    """
+    places = list(Place.objects.order_by('id').values_list('id', 'city_id'))
+    place_ids = np.array([p[0] for p in places], dtype=np.int64)
+    catalog = {
+        'place_ids': place_ids,
+        'city_ids': np.array([p[1] for p in places], dtype=np.int64),
+    }
+
+    if structural:
+        incidence = load_category_matrix(place_ids.tolist())
+        catalog['category_indptr'] = incidence.indptr.astype(np.int64)
+        catalog['category_indices'] = incidence.indices.astype(np.int64)
+
+    if image:
+        catalog['colors'], catalog['has_colors'] = load_color_matrix(place_ids.tolist())
+
+    return catalog
+
+
+def catalog_incidence(catalog):
+    """Rebuild the sparse category incidence matrix from a catalog's CSR arrays"""
+    indices = catalog['category_indices']
+    shape = (len(catalog['place_ids']), int(indices.max()) + 1 if len(indices) else 0)
+    data = np.ones(len(indices), dtype=np.float64)
+    return sparse.csr_matrix((data, indices, catalog['category_indptr']), shape=shape)
+
+
+def structural_block(incidence, city_ids, rows, cols=None, sizes=None):
+    """
+    Jaccard similarity (with same-city boost) between the places at `rows`
+    and the places at `cols` (default: every place). Returns a dense score
+    block and a mask of the pairs that pass the noise threshold.
+    """
+    rows = np.asarray(rows)
+    cols = np.arange(incidence.shape[0]) if cols is None else np.asarray(cols)
+    if sizes is None:
+        sizes = category_sizes(incidence)
+
+    # Intersections from one sparse product, unions from the row sums
+    intersection = (incidence[rows] @ incidence[cols].T).toarray()
+    union = sizes[rows][:, None] + sizes[cols][None, :] - intersection
+
+    # Only pairs where both places have categories are compared
+    valid = (sizes[rows] > 0)[:, None] & (sizes[cols] > 0)[None, :]
+    scores = np.zeros_like(intersection)
+    np.divide(intersection, union, out=scores, where=valid & (union > 0))
+
+    # Same city gives bonus
+    same_city = city_ids[rows][:, None] == city_ids[cols][None, :]
+    scores = np.where(same_city, scores * SAME_CITY_WEIGHT + SAME_CITY_BOOST, scores)
+
+    # Skip self-comparison
+    valid &= rows[:, None] != cols[None, :]
+
+    return np.round(scores, 3), valid & (scores > STRUCTURAL_THRESHOLD)
+
+
+def image_block(colors, has_colors, city_ids, rows, cols=None):
+    """
+    Cosine similarity (mapped to [0, 1]) between the places at `rows` and the
+    places at `cols` (default: every place), as one matrix product. Returns
+    the score block and the masks of same-city and different-city pairs.
+    """
+    rows = np.asarray(rows)
+    cols = np.arange(len(colors)) if cols is None else np.asarray(cols)
+
+    scores = colors[rows] @ colors[cols].T
+    scores = np.round((scores.astype(np.float64) + 1) / 2, 3)  # Convert from [-1,1] to [0,1]
+
+    valid = has_colors[rows][:, None] & has_colors[cols][None, :]
+    valid &= rows[:, None] != cols[None, :]
+
+    same_city = city_ids[rows][:, None] == city_ids[cols][None, :]
+    return scores, valid & same_city, valid & ~same_city
+
+
+def top_k_per_row(scores, keep, k):
+    """
+    Partial selection of the best `k` kept entries of every row of a block.
+    Returns (row, column) index arrays; rows with fewer candidates yield fewer pairs.
+    """
+    masked = np.where(keep, scores, -np.inf)
+    if k < masked.shape[1]:
+        cols = np.argpartition(-masked, k - 1, axis=1)[:, :k]
+    else:
+        cols = np.broadcast_to(np.arange(masked.shape[1]), masked.shape)
+
+    rows = np.repeat(np.arange(masked.shape[0]), cols.shape[1])
+    cols = cols.ravel()
+    hit = np.isfinite(masked[rows, cols])
+    return rows[hit], cols[hit]
+
+
+def block_size_for(n, budget_mb=256, itemsize=8, copies=4):
+    """Number of rows per block so that a few (rows x n) float buffers fit the budget"""
+    per_row = max(n, 1) * itemsize * copies
+    return max(1, int(budget_mb * 1024 * 1024 // per_row))
+
+
+def tile_side_for(budget_mb=256, itemsize=8, copies=4):
+    """Side of a square tile so that a few (side x side) float buffers fit the budget"""
+    return max(1, int(np.sqrt(budget_mb * 1024 * 1024 / (itemsize * copies))))
+
+
+def triangular_tiles(n, side):
+    """
+    Upper-triangular (row block, column block) tiles covering every unordered
+    pair once. Tiles are ordered so that dealing them round-robin gives every
+    process a near-equal share of work.
+    """
+    starts = list(range(0, n, side))
+    tiles = [(i, j) for i in starts for j in starts if j >= i]
+    # Full tiles first, then the half-used diagonal ones
+    tiles.sort(key=lambda tile: tile[0] == tile[1])
+    return [(np.arange(i, min(i + side, n)), np.arange(j, min(j + side, n))) for i, j in tiles]
+
+
+# Compact result records exchanged between processes (place indices, not ids)
+SIMILARITY_TYPES = ['structural', 'image_same_city', 'image_diff_city']
+RESULT_DTYPE = np.dtype([
+    ('main', np.int64),
+    ('other', np.int64),
+    ('score', np.float64),
+    ('type', np.uint8),
+])
+
+
+def make_records(main, other, scores, similarity_type):
+    records = np.empty(len(main), dtype=RESULT_DTYPE)
+    records['main'] = main
+    records['other'] = other
+    records['score'] = scores
+    records['type'] = SIMILARITY_TYPES.index(similarity_type)
+    return records
+
+
+def tile_records(similarity_type, scores, keep, rows, cols, top_k=None, diagonal=False, mirror=None):
+    """
+    Turn a scored tile into result records.
+
+    With `diagonal` the tile is a symmetric (rows == cols) block and only its
+    upper triangle is used. Off-diagonal triangular tiles pass `mirror=True`
+    so each pair yields both directions; incremental row tiles pass a column
+    mask instead. With `top_k` only the best candidates of every row (and of
+    every mirrored column) are kept; they are merged later by `reduce_top_k`.
+    """
+    parts = []
+
+    if top_k:
+        r, c = top_k_per_row(scores, keep, top_k)
+        parts.append(make_records(rows[r], cols[c], scores[r, c], similarity_type))
+        if mirror is True and not diagonal:
+            c, r = top_k_per_row(scores.T, keep.T, top_k)
+            parts.append(make_records(cols[c], rows[r], scores[r, c], similarity_type))
+        return np.concatenate(parts)
+
+    if diagonal:
+        keep = np.triu(keep, 1)
+    r, c = np.nonzero(keep)
+    parts.append(make_records(rows[r], cols[c], scores[r, c], similarity_type))
+
+    if diagonal or mirror is True:
+        parts.append(make_records(cols[c], rows[r], scores[r, c], similarity_type))
+    elif mirror is not None:
+        flipped = mirror[cols[c]]
+        parts.append(make_records(cols[c][flipped], rows[r][flipped], scores[r, c][flipped], similarity_type))
+
+    return np.concatenate(parts)
+
+
+def make_families(catalog, structural=True, image=True):
+    """
+    Group the similarity types by the inputs they are computed from. Each
+    family has its own tile scoring function and per-place fingerprints.
+    """
+    place_ids = catalog['place_ids']
+    city_ids = catalog['city_ids']
+    families = []
+
+    if structural:
+        incidence = catalog_incidence(catalog)
+        sizes = category_sizes(incidence)
+
+        def score_structural_tile(rows, cols=None):
+            scores, keep = structural_block(incidence, city_ids, rows, cols, sizes=sizes)
+            return [('structural', scores, keep)]
+
+        families.append({
+            'job': 'structural',
+            'types': ['structural'],
+            'score_tile': score_structural_tile,
+            'fingerprints': lambda: structural_fingerprints(place_ids.tolist(), city_ids),
+        })
+
+    if image:
+        colors = catalog['colors']
+        has_colors = catalog['has_colors']
+
+        def score_image_tile(rows, cols=None):
+            scores, same_city, diff_city = image_block(colors, has_colors, city_ids, rows, cols)
+            return [('image_same_city', scores, same_city), ('image_diff_city', scores, diff_city)]
+
+        families.append({
+            'job': 'image',
+            'types': ['image_same_city', 'image_diff_city'],
+            'score_tile': score_image_tile,
+            'fingerprints': lambda: image_fingerprints(place_ids.tolist(), city_ids, colors, has_colors),
+        })
+
+    return families
+
+
+def plan_tiles(n, tile_side, tile_rows, rows=None):
+    """
+    Work units of a run as (rows, cols, diagonal) tuples. A full run covers the
+    upper triangle in square tiles; an incremental run scans full rows (cols
+    is None) for the given `rows` only.
+    """
+    if rows is None:
+        return [(r, c, bool(r[0] == c[0])) for r, c in triangular_tiles(n, tile_side)]
+    return [(rows[i:i + tile_rows], None, False) for i in range(0, len(rows), tile_rows)]
+
+
+def score_tile(family, n, rows, cols, diagonal, top_k=None, mirror=True):
+    """Score one tile of a family and return its result records"""
+    all_cols = np.arange(n) if cols is None else cols
+    parts = [
+        tile_records(similarity_type, scores, keep, rows, all_cols,
+                     top_k=top_k, diagonal=diagonal, mirror=mirror)
+        for similarity_type, scores, keep in family['score_tile'](rows, cols)
+    ]
+    return np.concatenate(parts) if parts else np.empty(0, dtype=RESULT_DTYPE)
+
+
+def reduce_top_k(records, top_k):
+    """Keep the best `top_k` records per (type, main place)"""
+    if not len(records):
+        return records
+    order = np.lexsort((-records['score'], records['main'], records['type']))
+    records = records[order]
+
+    group = np.ones(len(records), dtype=bool)
+    group[1:] = (records['main'][1:] != records['main'][:-1]) | (records['type'][1:] != records['type'][:-1])
+    starts = np.flatnonzero(group)
+    rank_in_group = np.arange(len(records)) - np.repeat(starts, np.diff(np.append(starts, len(records))))
+    return records[rank_in_group < top_k]
+
+
+def fingerprint(*parts):
+    """Stable content hash of the inputs that determine a place's similarities"""
+    digest = hashlib.blake2b(digest_size=16)
+    for part in parts:
+        digest.update(part if isinstance(part, bytes) else repr(part).encode())
+        digest.update(b'|')
+    return digest.hexdigest()
+
+
+def structural_fingerprints(place_ids, city_ids):
+    """Per-place hash of the city and the category set"""
+    categories = {}
+    for place_id, category_id in PlaceCategory.objects.values_list('place_id', 'category_id'):
+        categories.setdefault(place_id, []).append(category_id)
+    return {
+        place_id: fingerprint(int(city_id), sorted(categories.get(place_id, [])))
+        for place_id, city_id in zip(place_ids, city_ids)
+    }
+
+
+def image_fingerprints(place_ids, city_ids, colors, has_colors):
+    """Per-place hash of the city and the (normalized) color vector"""
+    return {
+        place_id: fingerprint(int(city_id), colors[i].tobytes() if has_colors[i] else b'')
+        for i, (place_id, city_id) in enumerate(zip(place_ids, city_ids))
+    }
+
+
+def changed_places(job, digests):
+    """Place ids whose fingerprint differs from the one stored for `job` (new places included)"""
+    stored = dict(PlaceFingerprint.objects.filter(job=job).values_list('place_id', 'digest'))
+    return [place_id for place_id, digest in digests.items() if stored.get(place_id) != digest]
+
+
+def save_fingerprints(job, digests, place_ids=None, list_lengths=None):
+    """
+    Upsert the fingerprints of `place_ids` (default: all) for `job`, with the
+    number of stored rows each place's lists hold (`list_lengths`, place id ->
+    count; 0 when not given).
+    """
+    if place_ids is None:
+        place_ids = list(digests)
+    list_lengths = list_lengths or {}
+    PlaceFingerprint.objects.bulk_create(
+        [PlaceFingerprint(place_id=place_id, job=job, digest=digests[place_id],
+                          list_length=list_lengths.get(place_id, 0)) for place_id in place_ids],
+        batch_size=1000,
+        update_conflicts=True,
+        unique_fields=['place', 'job'],
+        update_fields=['digest', 'list_length'],
+    )
+
+
+def shortened_lists(job, lengths, place_index):
+    """
+    Rows whose stored lists for `job` hold fewer entries (`lengths`, per row)
+    than when their fingerprint was saved, i.e. lost neighbours to a deleted place.
+    """
+    rows = []
+    for place_id, list_length in PlaceFingerprint.objects.filter(job=job).values_list('place_id', 'list_length'):
+        row = place_index.get(place_id)
+        if row is not None and lengths[row] < list_length:
+            rows.append(row)
+    return np.array(rows, dtype=np.int64)
+
+
+def delete_similarities(similarity_types, place_ids, both_directions=True, batch_size=500):
+    """Delete the rows of the given types that start (or also end) at any of `place_ids`"""
+    deleted = 0
+    place_ids = list(place_ids)
+    for i in range(0, len(place_ids), batch_size):
+        batch = place_ids[i:i + batch_size]
+        rows = SimilarPlace.objects.filter(similarity_type__in=similarity_types, main_place_id__in=batch)
+        deleted += rows.delete()[0]
+        if both_directions:
+            rows = SimilarPlace.objects.filter(similarity_type__in=similarity_types, similar_place_id__in=batch)
+            deleted += rows.delete()[0]
+    return deleted
+
+
+def stored_top_k_thresholds(similarity_types, place_index, top_k):
+    """
+    For the stored top-K lists of the given types, return per type the score a
+    new neighbour must beat to enter each place's list (-inf for lists that are
+    not full yet), the per-type list lengths, and a row -> set of neighbour
+    rows map of the current lists.
+    """
+    n = len(place_index)
+    thresholds = {t: np.full(n, -np.inf) for t in similarity_types}
+    counts = {t: np.zeros(n, dtype=np.int64) for t in similarity_types}
+    neighbours = {}
+
+    rows = SimilarPlace.objects.filter(similarity_type__in=similarity_types).values_list(
+        'main_place_id', 'similar_place_id', 'similarity_score', 'similarity_type'
+    ).order_by('similarity_type', 'main_place_id', '-similarity_score')
+    for main_id, similar_id, score, similarity_type in rows:
+        row = place_index.get(main_id)
+        column = place_index.get(similar_id)
+        if row is None or column is None:
+            continue
+        neighbours.setdefault(row, set()).add(column)
+        counts[similarity_type][row] += 1
+        if counts[similarity_type][row] == top_k:
+            thresholds[similarity_type][row] = score
+
+    return thresholds, counts, neighbours
+
@@ -1,3 +1,1178 @@
-from django.test import TestCase
+import gzip
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+import threading
+import time
+import warnings
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from io import BytesIO, StringIO
+from unittest import mock
 
-# Create your tests here.
+import numpy as np
+from scipy import sparse
+from django.core.management import call_command
+from django.db import connection, transaction
+from django.test import SimpleTestCase, TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from PIL import Image
+
+from myapp import color_index, colorbars, imaging, importer, pagerank, palettes, score_matrix
+from myapp.downloader import Downloader, DownloadError
+from myapp.models import Category, City, Place, PlaceCategory, PlaceImage, SimilarPlace
+from myapp.similarity import (
+    catalog_incidence, image_block, load_catalog, load_color_matrix, structural_block, top_k_per_row,
+)
+from myapp.writers import SimilarPlaceWriter, pragma_sql
+
+
+def add_colored_image(place, colors):
+    image = PlaceImage(place=place, image_url='https://img.example/a.jpg')
+    image.set_colors(colors)
+    image.save()
+    return image
+
+
+class DataDirTestCase(TestCase):
+    """Points SIMILARITY_DATA_DIR and MEDIA_ROOT at a fresh temporary directory"""
+
+    def setUp(self):
+        self.data_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.data_dir, ignore_errors=True)
+        settings_override = override_settings(SIMILARITY_DATA_DIR=self.data_dir, MEDIA_ROOT=self.data_dir)
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+
+
+class ColorMatrixTests(TestCase):
+    def setUp(self):
+        city = City.objects.create(name='City')
+        self.short = Place.objects.create(name='Short', city=city)
+        self.long = Place.objects.create(name='Long', city=city)
+        self.plain = Place.objects.create(name='Plain', city=city)
+
+    def test_vectors_are_normalized_after_cropping_to_the_shared_length(self):
+        add_colored_image(self.short, [3, 4, 0])
+        add_colored_image(self.long, [0, 4, 3, 200, 200, 200])
+
+        matrix, has_colors = load_color_matrix([self.short.id, self.long.id, self.plain.id])
+
+        self.assertEqual(matrix.shape, (3, 3))
+        self.assertEqual(has_colors.tolist(), [True, True, False])
+        np.testing.assert_allclose(matrix[0], [0.6, 0.8, 0.0], rtol=1e-6)
+        np.testing.assert_allclose(matrix[1], [0.0, 0.8, 0.6], rtol=1e-6)
+        # Cosine of the cropped vectors, not of the full-length ones
+        self.assertAlmostEqual(float(matrix[0] @ matrix[1]), 0.64, places=5)
+
+    def test_last_image_of_a_place_wins(self):
+        add_colored_image(self.short, [255, 0, 0])
+        add_colored_image(self.short, [0, 0, 255])
+
+        matrix, _ = load_color_matrix([self.short.id])
+
+        np.testing.assert_allclose(matrix[0], [0, 0, 1])
+
+
+class ColorIndexTests(DataDirTestCase):
+    def setUp(self):
+        super().setUp()
+        color_index._cached_index = None
+        self.addCleanup(setattr, color_index, '_cached_index', None)
+        self.city = City.objects.create(name='City')
+        other_city = City.objects.create(name='Other')
+        rng = np.random.default_rng(0)
+        for i in range(20):
+            place = Place.objects.create(name=f'Place {i}', city=self.city if i % 2 else other_city)
+            add_colored_image(place, rng.integers(0, 256, 30).tolist())
+        call_command('build_color_index', stdout=StringIO())
+
+    def test_add_missing_inserts_only_new_places(self):
+        new = Place.objects.create(name='New', city=self.city)
+        add_colored_image(new, [10] * 30)
+
+        call_command('build_color_index', '--add-missing', stdout=StringIO())
+
+        index = color_index.ColorIndex.load()
+        self.assertEqual(len(index), 21)
+        self.assertIsNotNone(index.vector_for(new.id))
+
+    def test_unindexed_place_is_read_with_one_query(self):
+        new = Place.objects.create(name='New', city=self.city)
+        add_colored_image(new, [10] * 30)
+
+        with self.assertNumQueries(1):
+            same_city = color_index.similar_by_color(new, same_city=True)
+            other_cities = color_index.similar_by_color(new, same_city=False)
+
+        self.assertEqual(len(same_city), 3)
+        self.assertEqual(len(other_cities), 3)
+
+    def test_add_merges_into_the_lists_a_rebuild_would_give(self):
+        index = color_index.ColorIndex.load()
+        rng = np.random.default_rng(1)
+        replaced = index.place_ids[:3]
+        place_ids = np.concatenate([replaced, [1000, 1001, 1002]])
+
+        index.add(place_ids, [self.city.id] * 6, rng.integers(0, 256, (6, 30)))
+
+        rebuilt = color_index.ColorIndex(index.centroids, index.place_ids, index.city_ids, index.vectors)
+        self.assertEqual(len(index), 23)
+        np.testing.assert_array_equal(index.offsets, rebuilt.offsets)
+        np.testing.assert_array_equal(index.lists, rebuilt.lists)
+        for j in range(len(index.centroids)):
+            rows = slice(index.offsets[j], index.offsets[j + 1])
+            self.assertEqual(set(index.place_ids[rows].tolist()), set(rebuilt.place_ids[rows].tolist()))
+        for place_id in place_ids.tolist():
+            position = index.positions[place_id]
+            np.testing.assert_array_equal(index.vector_for(place_id), rebuilt.vector_for(place_id))
+            self.assertEqual(index.lists[position], rebuilt.lists[rebuilt.positions[place_id]])
+
+
+class EmptyColorIndexTests(DataDirTestCase):
+    def setUp(self):
+        super().setUp()
+        color_index._cached_index = None
+        self.addCleanup(setattr, color_index, '_cached_index', None)
+
+    def test_index_of_a_catalog_without_colors_is_empty_until_places_are_added(self):
+        city = City.objects.create(name='City')
+        place = Place.objects.create(name='Place', city=city)
+
+        call_command('build_color_index', stdout=StringIO())
+        self.assertEqual(len(color_index.ColorIndex.load()), 0)
+        self.assertEqual(color_index.similar_by_color(place), [])
+
+        add_colored_image(place, [10] * 30)
+        call_command('build_color_index', '--add-missing', stdout=StringIO())
+        index = color_index.ColorIndex.load()
+        self.assertEqual(len(index), 1)
+        self.assertEqual(len(index.centroids), 1)
+
+
+
+def pairwise_scores(places, place_categories, place_colors):
+    """
+    The per-pair loops the block functions replaced: {(main, other, type): score}
+    for every pair they would store
+    """
+    scores = {}
+    for place_id, city_id in places:
+        for other_id, other_city_id in places:
+            if place_id == other_id:
+                continue
+            place_cats = place_categories.get(place_id, set())
+            other_cats = place_categories.get(other_id, set())
+            if place_cats and other_cats:
+                similarity = len(place_cats & other_cats) / len(place_cats | other_cats)
+                if city_id == other_city_id:
+                    similarity = similarity * 0.7 + 0.3
+                if similarity > 0.1:
+                    scores[(place_id, other_id, 'structural')] = round(similarity, 3)
+
+            if place_id in place_colors and other_id in place_colors:
+                v1, v2 = place_colors[place_id], place_colors[other_id]
+                norm1, norm2 = np.linalg.norm(v1), np.linalg.norm(v2)
+                if norm1 == 0 or norm2 == 0:
+                    continue
+                similarity = (np.dot(v1, v2) / (norm1 * norm2) + 1) / 2
+                kind = 'image_same_city' if city_id == other_city_id else 'image_diff_city'
+                scores[(place_id, other_id, kind)] = round(similarity, 3)
+    return scores
+
+
+class BlockScoreTests(TestCase):
+    """The vectorized blocks against the original per-pair loops on a small catalog"""
+
+    def setUp(self):
+        rng = np.random.default_rng(3)
+        cities = [City.objects.create(name=f'City {i}') for i in range(3)]
+        categories = [Category.objects.create(name=f'Category {i}') for i in range(6)]
+        self.place_categories = {}
+        self.place_colors = {}
+        for i in range(24):
+            place = Place.objects.create(name=f'Place {i}', city=cities[i % 3])
+            # Some places without categories, some without colors
+            chosen = rng.choice(6, i % 4, replace=False)
+            for j in chosen:
+                PlaceCategory.objects.create(place=place, category=categories[j])
+            if len(chosen):
+                self.place_categories[place.id] = {categories[j].id for j in chosen}
+            if i % 5:
+                # Equal lengths: with mixed lengths the blocks normalize the cropped vectors on purpose
+                colors = rng.integers(0, 256, 30)
+                add_colored_image(place, colors.tolist())
+                self.place_colors[place.id] = colors.astype(np.float64)
+        self.catalog = load_catalog()
+        self.expected = pairwise_scores(list(zip(self.catalog['place_ids'].tolist(),
+                                                 self.catalog['city_ids'].tolist())),
+                                        self.place_categories, self.place_colors)
+
+    def vectorized_scores(self):
+        place_ids = self.catalog['place_ids']
+        rows = np.arange(len(place_ids))
+        structural, keep = structural_block(catalog_incidence(self.catalog), self.catalog['city_ids'], rows)
+        image, same_city, other_cities = image_block(self.catalog['colors'], self.catalog['has_colors'],
+                                                     self.catalog['city_ids'], rows)
+        blocks = [('structural', structural, keep), ('image_same_city', image, same_city),
+                  ('image_diff_city', image, other_cities)]
+        return {
+            (place_ids[i], place_ids[j], kind): scores[i, j]
+            for kind, scores, mask in blocks for i, j in zip(*np.nonzero(mask))
+        }, blocks
+
+    def assertMatchesLoop(self, kinds):
+        scores, _ = self.vectorized_scores()
+        scores = {pair: score for pair, score in scores.items() if pair[2] in kinds}
+        expected = {pair: score for pair, score in self.expected.items() if pair[2] in kinds}
+
+        self.assertEqual(set(scores), set(expected))
+        for pair, score in scores.items():
+            self.assertAlmostEqual(score, expected[pair], delta=1e-3, msg=pair)
+
+    def test_structural_block_matches_the_pairwise_loop(self):
+        self.assertMatchesLoop({'structural'})
+
+    def test_image_block_matches_the_pairwise_loop(self):
+        self.assertMatchesLoop({'image_same_city', 'image_diff_city'})
+
+    def test_top_k_per_row_keeps_the_best_pairs(self):
+        place_ids = self.catalog['place_ids'].tolist()
+        _, blocks = self.vectorized_scores()
+        k = 3
+        untied = 0
+        for kind, scores, mask in blocks:
+            rows, cols = top_k_per_row(scores, mask, k)
+            for i, place_id in enumerate(place_ids):
+                selected = {place_ids[j] for j in cols[rows == i]}
+                ranked = sorted((-score, other) for (main, other, t), score in self.expected.items()
+                                if main == place_id and t == kind)
+                self.assertEqual(len(selected), min(k, len(ranked)))
+                if len(ranked) <= k or ranked[k - 1][0] != ranked[k][0]:
+                    self.assertEqual(selected, {other for _, other in ranked[:k]}, (kind, place_id))
+                    untied += 1
+                else:
+                    # Tied at the cut-off: any of the tied places may fill the last slots
+                    cutoff = -ranked[k - 1][0]
+                    self.assertTrue(all(self.expected[(place_id, other, kind)] >= cutoff for other in selected))
+        self.assertGreater(untied, len(place_ids))
+
+
+class SimilarPlaceWriterTests(TestCase):
+    def setUp(self):
+        city = City.objects.create(name='City')
+        self.a, self.b, self.c = (Place.objects.create(name=name, city=city) for name in 'abc')
+
+    def indexes(self):
+        with connection.cursor() as cursor:
+            cursor.execute("PRAGMA index_list(myapp_similarplace)")
+            return {row[1]: bool(row[2]) for row in cursor.fetchall()}
+
+    def test_index_rebuild_keeps_the_unique_index_and_ignores_duplicates(self):
+        SimilarPlace.objects.create(main_place=self.a, similar_place=self.b, similarity_score=0.9,
+                                    similarity_type='structural')
+        before = self.indexes()
+        rows = [
+            (self.a.id, self.b.id, 0.1, 'structural'),  # already stored
+            (self.a.id, self.c.id, 0.5, 'structural'),
+            (self.a.id, self.c.id, 0.6, 'structural'),  # repeated within the batch
+            (self.c.id, self.a.id, 0.7, 'structural'),
+            (self.c.id, self.a.id, 0.8, 'structural'),  # repeated in the next batch
+        ]
+
+        with transaction.atomic():
+            with SimilarPlaceWriter(batch_size=4, rebuild_indexes=True) as writer:
+                during = self.indexes()
+                writer.write(rows)
+
+        self.assertEqual(writer.rows_written, 2)
+        self.assertEqual(sorted(name for name, unique in during.items() if unique),
+                         sorted(name for name, unique in before.items() if unique))
+        self.assertFalse(any(not unique for unique in during.values()))
+        self.assertEqual(self.indexes(), before)
+        self.assertEqual(
+            sorted(SimilarPlace.objects.values_list('main_place_id', 'similar_place_id', 'similarity_score')),
+            sorted([(self.a.id, self.b.id, 0.9), (self.a.id, self.c.id, 0.5), (self.c.id, self.a.id, 0.7)]),
+        )
+
+    def test_pragma_values_are_whitelisted(self):
+        self.assertEqual(pragma_sql('cache_size', -2000), "PRAGMA cache_size = -2000")
+        self.assertEqual(pragma_sql('temp_store', 'memory'), "PRAGMA temp_store = memory")
+        for pragma, value in [('cache_size', '1; DROP TABLE x'), ('cache_size', True),
+                              ('temp_store', 'DISK'), ('journal_mode', 'OFF')]:
+            with self.assertRaises(ValueError):
+                pragma_sql(pragma, value)
+
+
+class IncrementalSimilarityTests(DataDirTestCase):
+    def setUp(self):
+        super().setUp()
+        rng = np.random.default_rng(1)
+        cities = [City.objects.create(name=f'City {i}') for i in range(3)]
+        categories = [Category.objects.create(name=f'Category {i}') for i in range(8)]
+        self.places = []
+        for i in range(30):
+            place = Place.objects.create(name=f'Place {i}', city=cities[i % 3])
+            for j in rng.choice(8, 3, replace=False):
+                PlaceCategory.objects.create(place=place, category=categories[j])
+            add_colored_image(place, rng.integers(0, 256, 30).tolist())
+            self.places.append(place)
+        self.categories = categories
+
+    def run_command(self, *args, top_k=40):
+        out = StringIO()
+        # By default lists never fill up, so ties at the cut-off cannot differ between runs
+        call_command('calculate_similarities', '--top-k', str(top_k), *args, stdout=out)
+        return out.getvalue()
+
+    def stored(self):
+        return sorted(SimilarPlace.objects.values_list(
+            'main_place_id', 'similar_place_id', 'similarity_type', 'similarity_score'))
+
+    def test_no_changes_recompute_nothing(self):
+        self.run_command('--clear')
+        before = self.stored()
+
+        output = self.run_command('--incremental')
+
+        self.assertIn('structural: 0 changed places, recomputing 0 rows', output)
+        self.assertIn('image: 0 changed places, recomputing 0 rows', output)
+        self.assertEqual(self.stored(), before)
+
+    def test_incremental_run_matches_a_full_run(self):
+        self.run_command('--clear')
+        PlaceCategory.objects.filter(place=self.places[0]).delete()
+        PlaceCategory.objects.create(place=self.places[0], category=self.categories[0])
+
+        self.run_command('--incremental')
+        incremental = self.stored()
+        self.run_command('--clear')
+
+        self.assertEqual(incremental, self.stored())
+
+    def test_incremental_run_after_a_deletion_matches_a_full_run(self):
+        # Full top-3 lists; scores are rounded, so neighbours tied at the cut-off may differ
+        self.run_command('--clear', '--image-only', top_k=3)
+        most_listed = max(self.places, key=lambda place: place.similar_to_others.count())
+        self.assertGreater(most_listed.similar_to_others.count(), 3)
+        most_listed.delete()
+
+        output = self.run_command('--incremental', '--image-only', top_k=3)
+        incremental = sorted((main, kind, score) for main, _, kind, score in self.stored())
+        self.run_command('--clear', '--image-only', top_k=3)
+
+        self.assertIn('image: 0 changed places', output)
+        self.assertNotIn('recomputing 0 rows', output)
+        self.assertEqual(incremental, sorted((main, kind, score) for main, _, kind, score in self.stored()))
+
+    def test_matrix_storage_lists_the_stored_rows(self):
+        score_matrix._cached_matrix = None
+        self.addCleanup(setattr, score_matrix, '_cached_matrix', None)
+        self.run_command('--clear', '--image-only')
+        self.run_command('--image-only', '--storage', 'matrix')
+
+        with mock.patch.object(score_matrix, 'read_manifest', wraps=score_matrix.read_manifest) as read:
+            matrix = score_matrix.get_matrix()
+            self.assertIs(score_matrix.get_matrix(), matrix)
+        self.assertEqual(read.call_count, 1)
+
+        for place in self.places:
+            for same_city, kind in ((True, 'image_same_city'), (False, 'image_diff_city')):
+                stored = list(SimilarPlace.objects.filter(main_place=place, similarity_type=kind)
+                              .order_by('-similarity_score').values_list('similarity_score', flat=True)[:3])
+                top = matrix.top_k(place.id, k=3, same_city=same_city)
+                # Ties at the cut-off may pick different places, so the scores are compared
+                self.assertEqual([score for _, score in top], stored)
+                for similar_id, score in top:
+                    self.assertTrue(SimilarPlace.objects.filter(
+                        main_place=place, similar_place_id=similar_id, similarity_type=kind,
+                        similarity_score=score,
+                    ).exists())
+
+    def test_process_pool_matches_a_single_process_run(self):
+        from myapp.management.commands import calculate_similarities
+
+        # Small tiles and row blocks, so the two workers share several of each
+        with mock.patch.object(calculate_similarities, 'tile_side_for', return_value=8), \
+                mock.patch.object(calculate_similarities, 'block_size_for', return_value=8):
+            self.run_command('--clear')
+            single = self.stored()
+            self.run_command('--image-only', '--storage', 'matrix')
+            single_matrix = np.array(score_matrix.ScoreMatrix(score_matrix.read_manifest()).scores)
+
+            output = self.run_command('--clear', '--backend', 'processes', '--workers', '2')
+            self.run_command('--image-only', '--storage', 'matrix', '--backend', 'processes', '--workers', '2')
+
+        self.assertIn('with 2 processes (processes backend)', output)
+        self.assertEqual(self.stored(), single)
+        pooled = score_matrix.ScoreMatrix(score_matrix.read_manifest())
+        np.testing.assert_array_equal(pooled.scores, single_matrix)
+
+
+class GatherRecordsTests(TestCase):
+    def test_records_are_gathered_in_bounded_rounds(self):
+        from mpi4py import MPI
+        from myapp.management.commands import calculate_similarities
+        from myapp.similarity import make_records
+
+        records = make_records(np.arange(10), np.arange(10, 20), np.linspace(0, 1, 10), 'structural')
+        with mock.patch.object(calculate_similarities, 'GATHER_ROUND_RECORDS', 3):
+            gathered = calculate_similarities.gather_records(MPI.COMM_WORLD, records)
+
+        self.assertEqual(gathered.tolist(), records.tolist())
+
+
+class PageRankCatalogTestCase(DataDirTestCase):
+    """Forty places in three cities with random categories and popularity"""
+
+    def setUp(self):
+        super().setUp()
+        pagerank._ranker = None
+        self.addCleanup(setattr, pagerank, '_ranker', None)
+        rng = np.random.default_rng(2)
+        self.cities = [City.objects.create(name=f'City {i}') for i in range(3)]
+        categories = [Category.objects.create(name=f'Category {i}') for i in range(6)]
+        for i in range(40):
+            place = Place.objects.create(name=f'Place {i}', city=self.cities[i % 3],
+                                         page_views=int(rng.integers(0, 1000)),
+                                         number_of_languages=int(rng.integers(0, 50)))
+            for j in rng.choice(6, 2, replace=False):
+                PlaceCategory.objects.create(place=place, category=categories[j])
+
+
+class PersonalizedRankerTests(PageRankCatalogTestCase):
+    def test_requests_load_the_ranker_the_command_saved(self):
+        self.assertIsNone(pagerank.get_ranker())
+        call_command('calculate_pagerank', stdout=StringIO())
+
+        with self.assertNumQueries(0):
+            ranker = pagerank.get_ranker()
+            self.assertIs(pagerank.get_ranker(), ranker)
+
+        places = list(Place.objects.order_by('id'))
+        fresh = pagerank.PersonalizedPageRank.from_places(places)
+        city = self.cities[0]
+        np.testing.assert_allclose(ranker.scores(city_id=city.id), fresh.scores(city_id=city.id), atol=1e-6)
+
+    def test_places_added_after_the_ranker_are_listed_last(self):
+        call_command('calculate_pagerank', stdout=StringIO())
+        city = self.cities[0]
+        new = Place.objects.create(name='New', city=city, relevance_score=100)
+
+        response = self.client.get(reverse('myapp:city_view', args=[city.id]), {'sort': 'personalized'})
+
+        places = list(response.context['places'])
+        self.assertEqual(len(places), Place.objects.filter(city=city).count())
+        self.assertEqual(places[-1], new)
+
+    def test_cache_is_shared_safely_between_threads(self):
+        call_command('calculate_pagerank', stdout=StringIO())
+        ranker = pagerank.get_ranker()
+        ranker.cache_size = 4
+        liked = list(ranker.index)
+
+        def query(i):
+            return ranker.scores(city_id=self.cities[i % 3].id, liked=liked[i % 10:i % 10 + 1])
+
+        with ThreadPoolExecutor(max_workers=8) as pool:
+            results = list(pool.map(query, range(200)))
+
+        self.assertTrue(all(result is not None for result in results))
+        self.assertLessEqual(len(ranker.cache), 4)
+
+
+class LocalUpdateTests(SimpleTestCase):
+    """A thousand places in 20 cities with 500 categories; catalogs are dicts of parallel arrays"""
+    tolerance = 1e-4
+
+    def catalog(self, n=1000, seed=0):
+        rng = np.random.default_rng(seed)
+        return {
+            'place_ids': np.arange(n),
+            'city_ids': rng.integers(0, 20, n),
+            'rows': np.repeat(np.arange(n), 2),
+            'categories': rng.integers(0, 500, 2 * n),
+            'page_views': rng.integers(0, 1000, n).astype(np.float64),
+            'languages': rng.integers(0, 50, n).astype(np.float64),
+        }
+
+    def add_place(self, catalog, city_id, categories, page_views=500.0, languages=10.0):
+        row = len(catalog['place_ids'])
+        return {
+            'place_ids': np.append(catalog['place_ids'], catalog['place_ids'].max() + 1),
+            'city_ids': np.append(catalog['city_ids'], city_id),
+            'rows': np.append(catalog['rows'], [row] * len(categories)).astype(np.int64),
+            'categories': np.append(catalog['categories'], categories).astype(np.int64),
+            'page_views': np.append(catalog['page_views'], page_views),
+            'languages': np.append(catalog['languages'], languages),
+        }
+
+    def graph(self, catalog):
+        n = len(catalog['place_ids'])
+        incidence = sparse.csr_matrix((np.ones(len(catalog['rows'])), (catalog['rows'], catalog['categories'])),
+                                      shape=(n, 500))
+        incidence.data[:] = 1
+        graph = pagerank.PlaceGraph(catalog['place_ids'], catalog['city_ids'], incidence)
+        return graph, pagerank.hash_categories(catalog['rows'], catalog['categories'], n)
+
+    def reference(self, catalog):
+        graph, _ = self.graph(catalog)
+        bias = (pagerank.PAGEVIEW_WEIGHT * catalog['page_views'] / catalog['page_views'].sum()
+                + pagerank.LANGUAGE_WEIGHT * catalog['languages'] / catalog['languages'].sum())
+        vector, *_ = pagerank.power_iteration(
+            graph, bias, connection_weight=1 - pagerank.PAGEVIEW_WEIGHT - pagerank.LANGUAGE_WEIGHT,
+            tolerance=1e-14, max_iterations=5000
+        )
+        return vector
+
+    def state(self, catalog):
+        graph, signatures = self.graph(catalog)
+        _, state = pagerank.solution_state(graph, catalog['page_views'], catalog['languages'], signatures,
+                                           self.reference(catalog), tolerance=self.tolerance)
+        return dict(state, place_ids=graph.place_ids)
+
+    def update(self, catalog, state, **options):
+        graph, signatures = self.graph(catalog)
+        options.setdefault('tolerance', self.tolerance)
+        return pagerank.local_update(graph, catalog['page_views'], catalog['languages'], signatures, state,
+                                     **options)
+
+    def assertMatchesReference(self, catalog, vector, stats):
+        self.assertTrue(stats['converged'])
+        self.assertLessEqual(stats['error_bound'], self.tolerance)
+        self.assertLessEqual(np.abs(vector - self.reference(catalog)).sum(), stats['error_bound'])
+
+    def test_unchanged_catalog_touches_nothing(self):
+        catalog = self.catalog()
+
+        vector, _, stats = self.update(catalog, self.state(catalog))
+
+        self.assertEqual((stats['rows'], stats['pushes'], stats['touched']), (0, 0, 0))
+        self.assertMatchesReference(catalog, vector, stats)
+
+    def test_new_place_only_touches_its_neighbourhood(self):
+        catalog = self.catalog()
+        grown = self.add_place(catalog, city_id=0, categories=[3, 7])
+
+        vector, new_state, stats = self.update(grown, self.state(catalog))
+
+        # The 1/n and popularity totals moved for everyone, but that is a rescale, not a push
+        self.assertLess(stats['touched'], len(catalog['place_ids']) // 2)
+        self.assertMatchesReference(grown, vector, stats)
+
+        # The updated state is the starting point of the next update
+        _, _, again = self.update(grown, dict(new_state, place_ids=grown['place_ids']))
+        self.assertEqual(again['touched'], 0)
+
+    def test_removed_place_and_changed_categories_match_a_full_recompute(self):
+        catalog = self.catalog()
+        state = self.state(catalog)
+        keep = catalog['place_ids'] != 5
+        categories = catalog['categories'].copy()
+        categories[catalog['rows'] == 9] = [11, 12]
+        links = keep[catalog['rows']]
+        shrunk = {
+            'place_ids': catalog['place_ids'][keep],
+            'city_ids': catalog['city_ids'][keep],
+            'rows': (np.cumsum(keep) - 1)[catalog['rows'][links]],
+            'categories': categories[links],
+            'page_views': catalog['page_views'][keep],
+            'languages': catalog['languages'][keep],
+        }
+
+        vector, _, stats = self.update(shrunk, state)
+
+        self.assertMatchesReference(shrunk, vector, stats)
+
+    def test_new_dangling_place_matches_a_full_recompute(self):
+        catalog = self.catalog()
+        grown = self.add_place(catalog, city_id=99, categories=[])
+
+        vector, _, stats = self.update(grown, self.state(catalog))
+
+        self.assertMatchesReference(grown, vector, stats)
+
+    def test_round_limit_is_reported(self):
+        catalog = self.catalog()
+        grown = self.add_place(catalog, city_id=0, categories=[3, 7])
+
+        _, _, stats = self.update(grown, self.state(catalog), tolerance=1e-9, max_rounds=1)
+
+        self.assertEqual(stats['rounds'], 1)
+        self.assertFalse(stats['converged'])
+
+
+class IncrementalPageRankTests(PageRankCatalogTestCase):
+    def summary(self, *args):
+        out = StringIO()
+        call_command('calculate_pagerank', '--tolerance', '1e-6', *args, stdout=out)
+        return json.loads(next(line for line in out.getvalue().splitlines() if line.startswith('{')))
+
+    def test_verify_sets_converged_from_the_real_error(self):
+        self.summary()
+        place = Place.objects.create(name='New', city=self.cities[0], page_views=10)
+        PlaceCategory.objects.create(place=place, category=Category.objects.first())
+
+        summary = self.summary('--incremental', '--verify')
+
+        self.assertTrue(summary['incremental'])
+        self.assertTrue(summary['converged'])
+        self.assertLessEqual(summary['verified_error'], 1e-6)
+
+    def test_unchanged_catalog_is_not_pushed_or_rewritten(self):
+        self.summary()
+
+        summary = self.summary('--incremental')
+
+        self.assertTrue(summary['incremental'])
+        self.assertEqual(summary['touched'], 0)
+        self.assertEqual(summary['rows_written'], 0)
+
+
+def jpeg_bytes(color, size=(400, 300)):
+    buffer = BytesIO()
+    Image.new('RGB', size, color).save(buffer, 'JPEG')
+    return buffer.getvalue()
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    """Answers from the server's routes; a matching If-None-Match gets a 304"""
+
+    def do_GET(self):
+        server = self.server
+        with server.lock:
+            responses = server.routes.get(self.path, [(404, {}, b'')])
+            status, headers, body = responses.pop(0) if len(responses) > 1 else responses[0]
+            if headers.get('ETag') and self.headers.get('If-None-Match') == headers['ETag']:
+                status, body = 304, b''
+            server.requests.append((self.path, dict(self.headers), status))
+            server.active += 1
+            server.max_active = max(server.max_active, server.active)
+        try:
+            time.sleep(server.delay)
+            self.send_response(status)
+            for name, value in headers.items():
+                self.send_header(name, value)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+        finally:
+            with server.lock:
+                server.active -= 1
+
+    def log_message(self, format, *args):
+        pass
+
+
+class StubServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self):
+        super().__init__(('127.0.0.1', 0), StubHandler)
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        self.routes = {}
+        self.requests = []
+        self.active = self.max_active = 0
+        self.delay = 0.0
+
+
+class StubServerMixin:
+    """Runs a local HTTP server for the test class; each path returns its responses in turn, repeating the last"""
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.server = StubServer()
+        threading.Thread(target=cls.server.serve_forever, daemon=True).start()
+        cls.addClassCleanup(cls.server.server_close)
+        cls.addClassCleanup(cls.server.shutdown)
+
+    def setUp(self):
+        super().setUp()
+        self.server.reset()
+
+    def serve(self, path, *responses):
+        self.server.routes[path] = list(responses)
+        return f'http://127.0.0.1:{self.server.server_port}{path}'
+
+    def statuses(self, path):
+        return [status for requested, _, status in self.server.requests if requested == path]
+
+
+class DownloaderTests(StubServerMixin, SimpleTestCase):
+    def downloader(self, **options):
+        return Downloader(backoff=0.01, timeout=5, **options)
+
+    def test_server_errors_are_retried_with_exponential_backoff(self):
+        url = self.serve('/flaky', (503, {}, b''), (503, {}, b''), (200, {}, b'ok'))
+
+        with mock.patch('myapp.downloader.random.uniform', return_value=0) as uniform:
+            self.assertEqual(self.downloader().fetch(url), b'ok')
+
+        self.assertEqual(self.statuses('/flaky'), [503, 503, 200])
+        self.assertEqual(uniform.call_args_list, [mock.call(0, 0.01), mock.call(0, 0.02)])
+
+    def test_retry_after_delays_the_next_request(self):
+        url = self.serve('/busy', (429, {'Retry-After': '1'}, b''), (200, {}, b'ok'))
+
+        started = time.monotonic()
+        self.assertEqual(self.downloader().fetch(url), b'ok')
+
+        self.assertGreaterEqual(time.monotonic() - started, 0.9)
+        self.assertEqual(self.statuses('/busy'), [429, 200])
+
+    def test_concurrent_requests_to_a_host_are_capped(self):
+        url = self.serve('/slow', (200, {}, b'ok'))
+        self.server.delay = 0.05
+        downloader = self.downloader(workers=8, per_host=2)
+
+        results = list(downloader.run([url] * 12, downloader.fetch))
+
+        self.assertEqual([(result, error) for _, result, error in results], [(b'ok', None)] * 12)
+        self.assertEqual(self.server.max_active, 2)
+
+    def test_client_errors_are_not_retried(self):
+        url = self.serve('/missing', (404, {}, b''))
+
+        with self.assertRaises(DownloadError):
+            self.downloader().fetch(url)
+
+        self.assertEqual(self.statuses('/missing'), [404])
+
+
+class FixImagesTests(StubServerMixin, DataDirTestCase):
+    def setUp(self):
+        super().setUp()
+        self.place = Place.objects.create(name='Place', city=City.objects.create(name='City'))
+
+    def run_command(self, *args):
+        out = StringIO()
+        call_command('fix_images', *args, '--workers', '4', stdout=out, stderr=StringIO())
+        return out.getvalue()
+
+    def test_unchanged_images_are_revalidated_with_their_etag(self):
+        url = self.serve('/a.jpg', (200, {'ETag': '"v1"'}, jpeg_bytes((255, 0, 0))))
+        image = PlaceImage.objects.create(place=self.place, image_url=url)
+
+        self.run_command('--download-missing-only')
+        image.refresh_from_db()
+        stored_path = image.local_path
+        self.assertTrue(os.path.exists(os.path.join(self.data_dir, stored_path)))
+        self.assertEqual(image.etag, '"v1"')
+
+        output = self.run_command('--force-download')
+        image.refresh_from_db()
+
+        self.assertIn('Unchanged upstream: 1', output)
+        self.assertEqual(self.statuses('/a.jpg'), [200, 304])
+        self.assertEqual(self.server.requests[-1][1].get('If-None-Match'), '"v1"')
+        self.assertEqual(image.local_path, stored_path)
+
+    def test_paths_are_saved_in_batches(self):
+        for i in range(5):
+            url = self.serve(f'/{i}.jpg', (200, {}, jpeg_bytes((50 * i, 0, 0))))
+            PlaceImage.objects.create(place=self.place, image_url=url)
+
+        with CaptureQueriesContext(connection) as queries:
+            self.run_command('--download-missing-only', '--batch-size', '2')
+
+        updates = [q['sql'] for q in queries.captured_queries if q['sql'].startswith('UPDATE "myapp_placeimage"')]
+        self.assertEqual(len(updates), 3)
+        self.assertFalse(PlaceImage.objects.filter(local_path='').exists())
+
+    def test_leftover_display_jpeg_without_derivatives_is_rebuilt(self):
+        content = jpeg_bytes((0, 0, 255))
+        url = self.serve('/b.jpg', (200, {}, content))
+        image = PlaceImage.objects.create(place=self.place, image_url=url)
+        # An interrupted run of the old pipeline: display JPEG only
+        content_hash = hashlib.sha256(content).hexdigest()
+        rel_path = os.path.join('images', content_hash[:2], content_hash + '.jpg')
+        os.makedirs(os.path.dirname(os.path.join(self.data_dir, rel_path)))
+        with open(os.path.join(self.data_dir, rel_path), 'wb') as f:
+            f.write(content)
+
+        output = self.run_command('--download-missing-only')
+
+        self.assertIn('New files stored: 1', output)
+        image.refresh_from_db()
+        self.assertEqual(image.local_path, rel_path)
+        self.assertTrue(all(os.path.exists(path) for path in imaging.derivative_paths(os.path.join(self.data_dir, rel_path))))
+
+
+class ImagingTests(DataDirTestCase):
+    def test_display_jpeg_is_written_last(self):
+        base_path = os.path.join(self.data_dir, 'photo')
+        original = imaging.atomic_save
+
+        def fail_on_analysis(image, path, format, **params):
+            if path.endswith(imaging.ANALYSIS_SUFFIX):
+                raise OSError('disk full')
+            return original(image, path, format, **params)
+
+        with mock.patch('myapp.imaging.atomic_save', side_effect=fail_on_analysis):
+            with self.assertRaises(OSError):
+                imaging.save_derivatives(jpeg_bytes((0, 255, 0)), base_path)
+        self.assertFalse(os.path.exists(base_path + '.jpg'))
+
+        jpeg_path, analysis = imaging.save_derivatives(jpeg_bytes((0, 255, 0)), base_path)
+
+        self.assertEqual(jpeg_path, base_path + '.jpg')
+        self.assertEqual(analysis.shape, (100, 100, 3))
+        self.assertTrue(all(os.path.exists(path) for path in imaging.derivative_paths(jpeg_path)))
+
+    def test_non_jpeg_sources_are_reduced_to_no_less_than_the_size(self):
+        buffer = BytesIO()
+        Image.new('RGB', (1200, 950), (10, 20, 30)).save(buffer, 'PNG')
+
+        image = imaging.open_reduced(buffer.getvalue(), (300, 300))
+
+        self.assertEqual(image.size, (400, 317))
+        self.assertEqual(image.mode, 'RGB')
+
+def per_row_import(rows):
+    """The per-row get_or_create import that Importer replaced, kept as a reference"""
+    for row in rows:
+        if not row.get('City') or not row.get('Title'):
+            continue
+        city, _ = City.objects.get_or_create(name=row['City'])
+        place, _ = Place.objects.get_or_create(
+            name=row['Title'], city=city,
+            defaults=dict(importer.place_fields(row, row['Title']), relevance_score=importer.initial_score(row)),
+        )
+        if row.get('Image link') and not PlaceImage.objects.filter(place=place, image_url=row['Image link']).exists():
+            PlaceImage.objects.create(place=place, image_url=row['Image link'], is_primary=True)
+        for category_name in (row.get('categories') or '').split(','):
+            category_name = category_name.strip()
+            if not category_name:
+                continue
+            category, _ = Category.objects.get_or_create(name=category_name)
+            if not PlaceCategory.objects.filter(place=place, category=category).exists():
+                PlaceCategory.objects.create(place=place, category=category)
+
+
+class ChunkedImportTests(TestCase):
+    columns = ['City', 'Title', 'Link', 'Page Views', 'pagerank_score', 'Image link', 'categories']
+    rows = [
+        ['Vilnius', 'Cathedral', 'https://w/cathedral', '100', '0.3', 'https://img/cathedral.jpg', 'Church,Landmark'],
+        ['', 'Nowhere', 'https://w/nowhere', '1', '0', '', 'Landmark'],
+        ['Vilnius', 'Tower', 'https://w/tower', '50', 'x', 'https://img/tower.jpg', 'Landmark, View,Landmark'],
+        ['Kaunas', 'Castle', 'https://w/castle', '', '0.1', '', 'Castle'],
+        # The same place again: its first row keeps the fields, the new image and category are added
+        ['Vilnius', 'Tower', 'https://w/tower-2', '60', '0.5', 'https://img/tower-2.jpg', 'Church'],
+        ['Kaunas', 'Cathedral', 'https://w/kaunas', '30', '0.2', 'https://img/cathedral.jpg', 'Church'],
+    ]
+
+    def snapshot(self):
+        fields = [field.name for field in Place._meta.concrete_fields if field.name not in ('id', 'city', 'source_hash')]
+        return {
+            'cities': sorted(City.objects.values_list('name', flat=True)),
+            'categories': sorted(Category.objects.values_list('name', flat=True)),
+            'places': sorted(Place.objects.values_list('city__name', *fields)),
+            'images': sorted(PlaceImage.objects.values_list('place__city__name', 'place__name', 'image_url',
+                                                            'is_primary', 'local_path')),
+            'links': sorted(PlaceCategory.objects.values_list('place__city__name', 'place__name', 'category__name')),
+        }
+
+    def import_both_ways(self):
+        rows = [dict(zip(self.columns, row)) for row in self.rows]
+        per_row_import(rows)
+        expected = self.snapshot()
+        for model in (PlaceCategory, PlaceImage, Place, Category, City):
+            model.objects.all().delete()
+        self.add_existing_rows()
+
+        counts = importer.Importer(chunk_size=2).run(rows)
+        return expected, self.snapshot(), counts
+
+    def add_existing_rows(self):
+        # Existing rows are reused rather than duplicated
+        City.objects.create(name='Kaunas')
+        Category.objects.create(name='Castle')
+
+    def test_chunked_import_creates_the_same_rows_as_the_per_row_import(self):
+        self.add_existing_rows()
+
+        expected, imported, counts = self.import_both_ways()
+
+        self.assertEqual(imported, expected)
+        self.assertEqual(len(expected['places']), 4)
+        self.assertEqual(len(expected['links']), 7)
+        self.assertEqual((counts['cities'], counts['categories'], counts['places'], counts['skipped']), (1, 3, 4, 1))
+
+
+class RecordingImporter(importer.Importer):
+    """Remembers the places of every committed chunk and can fail once `fail_after` rows are in"""
+
+    def __init__(self, fail_after=None, **kwargs):
+        super().__init__(**kwargs)
+        self.fail_after = fail_after
+        self.names = []
+
+    def import_chunk(self, records):
+        if self.fail_after is not None and len(self.names) >= self.fail_after:
+            raise RuntimeError("Interrupted")
+        super().import_chunk(records)
+        self.names += [r['name'] for r in records]
+
+
+class StreamImportTests(DataDirTestCase):
+    # Multi-byte names, so resuming at a character offset instead of a byte offset would show
+    names = [f'Vieta {i} ąžuolas' for i in range(20)]
+
+    def write_csv(self, compress):
+        lines = ['City;Title;Page Views;categories'] + [
+            f'Miestas {i % 3};{name};{i};Kategorija {i % 4}' for i, name in enumerate(self.names)
+        ]
+        data = ('\n'.join(lines) + '\n').encode('utf-8')
+        path = os.path.join(self.data_dir, 'places.csv.gz' if compress else 'places.csv')
+        with (gzip.open if compress else open)(path, 'wb') as f:
+            f.write(data)
+        return path
+
+    def test_gzip_file_streams_the_same_rows(self):
+        with importer.CsvStream(self.write_csv(compress=False)) as plain, \
+                importer.CsvStream(self.write_csv(compress=True)) as compressed:
+            self.assertTrue(compressed.compressed)
+            self.assertEqual(list(compressed), list(plain))
+            self.assertEqual(compressed.offset, plain.offset)
+
+    def test_resume_continues_after_the_last_committed_chunk(self):
+        for compress in (False, True):
+            with self.subTest(compress=compress):
+                Place.objects.all().delete()
+                path = self.write_csv(compress)
+                checkpoint = os.path.join(self.data_dir, 'import.checkpoint.json')
+
+                interrupted = RecordingImporter(fail_after=6, chunk_size=3)
+                with self.assertRaises(RuntimeError):
+                    importer.stream_import(interrupted, path, checkpoint)
+                self.assertEqual(importer.read_checkpoint(checkpoint)['rows'], 6)
+
+                resumed = RecordingImporter(chunk_size=3)
+                counts = importer.stream_import(resumed, path, checkpoint, resume=True)
+
+                # Every row is imported exactly once across the two runs
+                self.assertEqual(interrupted.names + resumed.names, self.names)
+                self.assertEqual(sorted(Place.objects.values_list('name', flat=True)), sorted(self.names))
+                self.assertEqual(counts['places'], 20)
+                self.assertFalse(os.path.exists(checkpoint))
+
+    def test_checkpoint_of_another_file_is_refused(self):
+        path = self.write_csv(compress=False)
+        checkpoint = os.path.join(self.data_dir, 'import.checkpoint.json')
+        with self.assertRaises(RuntimeError):
+            importer.stream_import(RecordingImporter(fail_after=3, chunk_size=3), path, checkpoint)
+
+        with open(path, 'a') as f:
+            f.write('Miestas 0;Nauja vieta;1;Kategorija 0\n')
+
+        with self.assertRaises(importer.CheckpointError):
+            importer.stream_import(RecordingImporter(chunk_size=3), path, checkpoint, resume=True)
+
+
+class UpsertImportTests(DataDirTestCase):
+    columns = ['City', 'Title', 'Link', 'Page Views', 'pagerank_score', 'Image link', 'categories']
+
+    def rows(self):
+        return [
+            ['Vilnius', 'Cathedral', 'https://w/cathedral', '100', '0.3', 'https://img/cathedral.jpg', 'Church,Landmark'],
+            ['Vilnius', 'Tower', 'https://w/tower', '50', '0.2', 'https://img/tower.jpg', 'Landmark'],
+            ['Kaunas', 'Castle', 'https://w/castle', '80', '0.1', '', 'Castle'],
+        ]
+
+    def upsert(self, rows):
+        path = os.path.join(self.data_dir, 'places.csv')
+        with open(path, 'w') as f:
+            for row in [self.columns] + rows:
+                f.write(';'.join(row) + '\n')
+        out = StringIO()
+        call_command('import_data', '--csv-file', path, '--upsert', '--chunk-size', '2', stdout=out)
+        with open(os.path.join(self.data_dir, 'changed_places.json')) as f:
+            return json.load(f), out.getvalue()
+
+    def place(self, name):
+        return Place.objects.get(name=name)
+
+    def test_unchanged_rows_are_skipped(self):
+        changed, _ = self.upsert(self.rows())
+        self.assertEqual(len(changed['created']), 3)
+
+        changed, output = self.upsert(self.rows())
+
+        self.assertEqual(changed, {'created': [], 'updated': [], 'deleted': []})
+        self.assertIn('Places unchanged: 3', output)
+
+    def test_changed_rows_are_updated_and_missing_rows_deleted(self):
+        self.upsert(self.rows())
+        tower, castle = self.place('Tower'), self.place('Castle')
+        rows = self.rows()
+        rows[1][3:] = ['75', '0.2', 'https://img/tower-new.jpg', 'Landmark,View']
+        del rows[2]
+        rows.append(['Kaunas', 'Museum', 'https://w/museum', '10', '0.05', '', 'Museum'])
+
+        changed, _ = self.upsert(rows)
+
+        self.assertEqual(changed, {'created': [self.place('Museum').pk], 'updated': [tower.pk], 'deleted': [castle.pk]})
+        tower.refresh_from_db()
+        self.assertEqual(tower.page_views, 75)
+        self.assertEqual(list(tower.images.values_list('image_url', flat=True)), ['https://img/tower-new.jpg'])
+        self.assertEqual(sorted(tower.placecategory_set.values_list('category__name', flat=True)), ['Landmark', 'View'])
+        self.assertFalse(Place.objects.filter(pk=castle.pk).exists())
+
+    def test_updates_keep_the_computed_relevance_score(self):
+        self.upsert(self.rows())
+        self.assertEqual(self.place('Tower').relevance_score, 0.2)
+        Place.objects.update(relevance_score=0.9)  # as calculate_pagerank would
+        rows = self.rows()
+        rows[1][3:5] = ['75', '0.4']
+
+        changed, _ = self.upsert(rows)
+
+        self.assertEqual(changed['updated'], [self.place('Tower').pk])
+        self.assertEqual(self.place('Tower').page_views, 75)
+        self.assertEqual(set(Place.objects.values_list('relevance_score', flat=True)), {0.9})
+
+
+class PaletteTests(SimpleTestCase):
+    def batch(self, seed=0, images=3, pixels=4096):
+        rng = np.random.default_rng(seed)
+        # Noisy clusters around a few base colors per image
+        batch = []
+        for _ in range(images):
+            bases = rng.integers(0, 256, (4, 3))
+            batch.append(np.clip(bases[rng.integers(0, 4, pixels)] + rng.normal(0, 8, (pixels, 3)), 0, 255)
+                         .astype(np.uint8))
+        return batch
+
+    def test_every_extractor_is_seeded_and_returns_full_palettes(self):
+        batch = self.batch()
+        for method in palettes.EXTRACTORS:
+            with self.subTest(method=method):
+                vectors = palettes.extract_palettes(batch, method=method)
+                self.assertEqual(vectors, palettes.extract_palettes(batch, method=method))
+                self.assertEqual(len(vectors), len(batch))
+                for vector in vectors:
+                    self.assertEqual(len(vector), 3 * palettes.PALETTE_SIZE)
+                    self.assertTrue(all(isinstance(c, int) and 0 <= c <= 255 for c in vector))
+
+    def test_palettes_do_not_depend_on_the_batch(self):
+        batch = self.batch()
+        for method in palettes.EXTRACTORS:
+            with self.subTest(method=method):
+                together = palettes.extract_palettes(batch, method=method)
+                alone = [palettes.extract_palettes([pixels], method=method)[0] for pixels in batch]
+                self.assertEqual(together, alone)
+
+    def test_few_colors_are_padded_with_the_dominant_one(self):
+        pixels = np.array([[200, 10, 10]] * 300 + [[10, 10, 200]] * 100, dtype=np.uint8)
+        for method in palettes.EXTRACTORS:
+            with self.subTest(method=method):
+                with warnings.catch_warnings():
+                    # kmeans2 warns about the empty clusters this test is about
+                    warnings.simplefilter('ignore', UserWarning)
+                    vector = palettes.extract_palettes([pixels], method=method)[0]
+                colors = [tuple(vector[i:i + 3]) for i in range(0, len(vector), 3)]
+                self.assertEqual(colors[0], (200, 10, 10))
+                self.assertEqual(set(colors), {(200, 10, 10), (10, 10, 200)})
+
+    def test_quantization_error_is_zero_for_the_exact_colors(self):
+        pixels = np.array([[200, 10, 10], [10, 10, 200]], dtype=np.uint8)
+        self.assertEqual(palettes.quantization_error(pixels, [200, 10, 10, 10, 10, 200]), 0.0)
+        self.assertAlmostEqual(palettes.quantization_error(pixels, [200, 10, 10]), np.sqrt(2 * 190 ** 2 / 2))
+
+
+class ColorBarTests(DataDirTestCase):
+    def setUp(self):
+        super().setUp()
+        colorbars._cached_bars.clear()
+        self.addCleanup(colorbars._cached_bars.clear)
+        place = Place.objects.create(name='Place', city=City.objects.create(name='City'))
+        self.image = add_colored_image(place, [255, 0, 0, 0, 0, 255])
+
+    def url(self, image_id, palette_hash):
+        return reverse('myapp:colorbar', kwargs={'image_id': image_id, 'palette_hash': palette_hash})
+
+    def test_only_a_current_palette_is_revalidated(self):
+        palette_hash = self.image.palette_hash
+        url = self.url(self.image.id, palette_hash)
+        self.assertEqual(self.client.get(url).status_code, 200)
+        self.assertEqual(self.client.get(url, HTTP_IF_NONE_MATCH=f'"{palette_hash}"').status_code, 304)
+
+        missing = self.client.get(self.url(self.image.id + 1, palette_hash), HTTP_IF_NONE_MATCH=f'"{palette_hash}"')
+        self.assertEqual(missing.status_code, 404)
+
+        self.image.set_colors([0, 255, 0])
+        self.image.save()
+        stale = self.client.get(url, HTTP_IF_NONE_MATCH=f'"{palette_hash}"')
+        self.assertRedirects(stale, self.url(self.image.id, self.image.palette_hash), fetch_redirect_response=False)
+
+    @override_settings(COLORBAR_CACHE_SIZE=100)
+    def test_cache_directory_is_only_scanned_when_it_may_be_full(self):
+        with mock.patch('myapp.colorbars.evict_color_bars', wraps=colorbars.evict_color_bars) as evict:
+            for i in range(150):
+                colorbars.open_color_bar(f'{i:016x}', [i % 256, 0, 0]).close()
+
+        # The first render, the one that fills the cache, then every 11 renders after trimming to 90
+        self.assertEqual(evict.call_count, 6)
+        self.assertLessEqual(len(os.listdir(colorbars.cache_dir())), 100)
+
+    def test_bars_of_any_width_have_no_black_strip(self):
+        colors = [255, 0, 0, 0, 255, 0, 0, 0, 255]
+        for width in (299, 300, 301, 7):
+            with self.subTest(width=width):
+                # The array as rendered, before JPEG blurs the stripe edges
+                with mock.patch('myapp.colorbars.atomic_save') as save:
+                    colorbars.render_color_bar(colors, 'bar.jpg', size=(width, 20))
+                bar = np.asarray(save.call_args.args[0])
+
+                self.assertEqual(bar.shape, (20, width, 3))
+                self.assertTrue((bar == bar[:1]).all())
+                stripes = bar[0].argmax(axis=1)
+                self.assertTrue((bar[0].max(axis=1) == 255).all())
+                self.assertEqual(stripes.tolist(), sorted(stripes.tolist()))
+                widths = np.bincount(stripes, minlength=3)
+                self.assertLessEqual(widths.max() - widths.min(), 1)
+
+    def test_every_pre_rendered_bar_is_removed(self):
+        os.makedirs(os.path.join(self.data_dir, 'colorbars'))
+        for name in ('old.jpg', 'shared.jpg'):
+            with open(os.path.join(self.data_dir, 'colorbars', name), 'wb') as f:
+                f.write(jpeg_bytes((0, 0, 0)))
+        # This image already has a palette, so a run without --regenerate does not touch it
+        PlaceImage.objects.filter(pk=self.image.pk).update(colorbar_path='colorbars/old.jpg')
+        other = add_colored_image(self.image.place, [0, 255, 0])
+        PlaceImage.objects.filter(pk=other.pk).update(colorbar_path='colorbars/shared.jpg')
+        add_colored_image(self.image.place, [0, 0, 255])
+        PlaceImage.objects.filter(colorbar_path='').update(colorbar_path='colorbars/shared.jpg')
+
+        out = StringIO()
+        call_command('generate_colorbars', '--workers', '1', stdout=out)
+
+        self.assertIn('2 pre-rendered color bars removed', out.getvalue())
+        self.assertEqual(os.listdir(os.path.join(self.data_dir, 'colorbars')), [])
+        self.assertFalse(PlaceImage.objects.exclude(colorbar_path='').exists())
+
+    def test_palettes_are_extracted_from_the_saved_images(self):
+        colors = {'red.jpg': (220, 20, 20), 'blue.jpg': (20, 20, 220)}
+        for name, color in colors.items():
+            with open(os.path.join(self.data_dir, name), 'wb') as f:
+                f.write(jpeg_bytes(color))
+
+        results = {path: (palette, error) for path, palette, error in colorbars.run_palettes(
+            ['red.jpg', 'missing.jpg', 'blue.jpg'], self.data_dir, workers=1, batch_size=2
+        )}
+
+        self.assertEqual(set(results), {'red.jpg', 'blue.jpg', 'missing.jpg'})
+        self.assertEqual(results['missing.jpg'][0], [])
+        self.assertIn('Image not found', results['missing.jpg'][1])
+        for name, color in colors.items():
+            palette, error = results[name]
+            self.assertIsNone(error)
+            self.assertEqual(len(palette), 3 * palettes.PALETTE_SIZE)
+            np.testing.assert_allclose(palette[:3], color, atol=3)
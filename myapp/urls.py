@@ -8,6 +8,7 @@ urlpatterns = [
     path('city/<int:city_id>/', views.city_view, name='city_view'),
     path('place/<int:place_id>/', views.place_detail, name='place_detail'),
     path('search/', views.search, name='search'),
+    path('image/<int:image_id>/colorbar/<str:palette_hash>.jpg', views.colorbar, name='colorbar'),
     #path('about/', views.about, name='about'),
    # path('contact/', views.contact, name='contact'),
    # path('services/', views.services, name='services'),
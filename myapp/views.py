@@ -1,6 +1,13 @@
-from django.shortcuts import render, get_object_or_404
+from django.shortcuts import render, get_object_or_404, redirect
 from django.db.models import Q
+from django.http import FileResponse, Http404
+from django.utils.cache import patch_cache_control
+from django.views.decorators.http import etag
 from .models import City, Place, Category, PlaceImage, PlaceCategory, SimilarPlace
+from .color_index import similar_by_color
+from .score_matrix import get_matrix
+from .pagerank import get_ranker
+from .colorbars import open_color_bar
 
 def index(request):
     """View function for home page"""
@@ -28,6 +35,45 @@ def index(request):
     
     return render(request, 'myapp/index.html', context)
 
+def parse_ids(value):
+    """Comma-separated ids from a query parameter, ignoring anything malformed"""
+    return [int(part) for part in value.split(',') if part.strip().isdigit()]
+
+def personalized_places(request, city):
+    """
+    Places of a city ordered by PageRank personalized to that city, optionally
+    narrowed to a category (?category=<id>) and biased towards liked places
+    (?liked=<id>,<id>). Falls back to the global score order; places added
+    since calculate_pagerank last ran follow the ranked ones in that order.
+    """
+    places = Place.objects.filter(city=city)
+    ranker = get_ranker()
+    if ranker is None:
+        return places.order_by('-relevance_score')
+    
+    category_ids = parse_ids(request.GET.get('category', ''))
+    place_ids = list(places.values_list('id', flat=True))
+    ranked = ranker.rank(
+        place_ids,
+        city_id=city.id,
+        category_id=category_ids[0] if category_ids else None,
+        liked=parse_ids(request.GET.get('liked', '')),
+    )
+    if not ranked:
+        return places.order_by('-relevance_score')
+    
+    by_id = places.in_bulk([place_id for place_id, _ in ranked])
+    ordered = []
+    for place_id, score in ranked:
+        place = by_id[place_id]
+        place.personalized_score = score
+        ordered.append(place)
+    
+    unranked = set(place_ids) - by_id.keys()
+    if unranked:
+        ordered.extend(sorted(places.in_bulk(unranked).values(), key=lambda place: -place.relevance_score))
+    return ordered
+
 def city_view(request, city_id):
     """View showing places in a specific city"""
     # Get the selected city
@@ -41,6 +87,8 @@ def city_view(request, city_id):
     
     if sort == 'name':
         places = Place.objects.filter(city=selected_city).order_by('name')
+    elif sort == 'personalized':
+        places = personalized_places(request, selected_city)
     else:  # Default to score sorting
         places = Place.objects.filter(city=selected_city).order_by('-relevance_score')
     
@@ -53,76 +101,26 @@ def city_view(request, city_id):
     
     return render(request, 'myapp/city_view.html', context)
 
-# myapp/views.py
-def place_detail(request, place_id):
-    """View showing details of a specific place"""
-    # Get the selected place
-    place = get_object_or_404(Place, pk=place_id)
-    
-    print(f"Viewing place: {place.name} (ID: {place.id})")
-    
-    # Get the place's city
-    city = place.city
-    
-    # Get primary image
-    primary_image = place.images.filter(is_primary=True).first() or place.images.first()
-    
-    # Get categories for this place
-    categories = Category.objects.filter(placecategory__place=place)
-    
-    # Get similar places with detailed debugging
-    print(f"Looking for similar places for place ID: {place.id}")
-    
-    # Check if this place has any similar places at all
-    total_similar = SimilarPlace.objects.filter(main_place=place).count()
-    print(f"Total similar places found: {total_similar}")
-    
-    # Check exact values used in the filter
-    similarity_types = SimilarPlace.objects.values_list('similarity_type', flat=True).distinct()
-    print(f"Available similarity types in database: {list(similarity_types)}")
-    
-    # Get similar places based on structural info
-    similar_places_structural = SimilarPlace.objects.filter(
-        main_place=place, 
-        similarity_type='structural'
-    ).select_related('similar_place').order_by('-similarity_score')[:3]
-    
-    print(f"Structural similar places: {similar_places_structural.count()}")
-    
-    # Get similar places based on image in same city
-    similar_places_same_city = SimilarPlace.objects.filter(
-        main_place=place, 
-        similarity_type='image_same_city'
-    ).select_related('similar_place').order_by('-similarity_score')[:3]
-    
-    print(f"Image similar places (same city): {similar_places_same_city.count()}")
-    
-    # Get similar places based on image in different cities
-    similar_places_other_cities = SimilarPlace.objects.filter(
-        main_place=place, 
-        similarity_type='image_diff_city'
-    ).select_related('similar_place').order_by('-similarity_score')[:3]
-    
-    print(f"Image similar places (other cities): {similar_places_other_cities.count()}")
-    
-    # Try different filter to see if any similar places exist for this place
-    any_similar = SimilarPlace.objects.filter(main_place=place)
-    print(f"Any similar places with different filter: {any_similar.count()}")
-    if any_similar.exists():
-        for sim in any_similar[:3]:
-            print(f"  - {sim.similarity_type}: {sim.main_place.name} -> {sim.similar_place.name} (score: {sim.similarity_score})")
-    
-    context = {
-        'place': place,
-        'city': city,
-        'primary_image': primary_image,
-        'categories': categories,
-        'similar_places_structural': similar_places_structural,
-        'similar_places_same_city': similar_places_same_city,
-        'similar_places_other_cities': similar_places_other_cities,
-    }
-    
-    return render(request, 'myapp/place_detail.html', context)
+def unsaved_similar_places(place, matches, same_city):
+    """Unsaved SimilarPlace rows built from (place_id, score) pairs, for the template"""
+    similar_places = Place.objects.in_bulk([place_id for place_id, _ in matches])
+    similarity_type = 'image_same_city' if same_city else 'image_diff_city'
+    return [
+        SimilarPlace(main_place=place, similar_place=similar_places[place_id],
+                     similarity_score=score, similarity_type=similarity_type)
+        for place_id, score in matches if place_id in similar_places
+    ]
+
+def color_index_similar(place, same_city, k=3):
+    """Image similarities from the approximate color index"""
+    return unsaved_similar_places(place, similar_by_color(place, k=k, same_city=same_city), same_city)
+
+def score_matrix_similar(place, same_city, k=3):
+    """Image similarities read from the memory-mapped score matrix, if one was built"""
+    matrix = get_matrix()
+    if matrix is None or place.id not in matrix:
+        return []
+    return unsaved_similar_places(place, matrix.top_k(place.id, k=k, same_city=same_city), same_city)
 
 # myapp/views.py
 def place_detail(request, place_id):
@@ -130,8 +128,6 @@ def place_detail(request, place_id):
     # Get the selected place
     place = get_object_or_404(Place, pk=place_id)
     
-    print(f"Viewing place: {place.name} (ID: {place.id})")
-    
     # Get the place's city
     city = place.city
     
@@ -141,32 +137,24 @@ def place_detail(request, place_id):
     # Get categories for this place
     categories = Category.objects.filter(placecategory__place=place)
     
-    # Get similar places with detailed debugging
-    print(f"Looking for similar places for place ID: {place.id}")
-    
-    # Check if this place has any similar places at all
-    total_similar = SimilarPlace.objects.filter(main_place=place).count()
-    print(f"Total similar places found: {total_similar}")
-    
-    # Check exact values used in the filter
-    similarity_types = SimilarPlace.objects.values_list('similarity_type', flat=True).distinct()
-    print(f"Available similarity types in database: {list(similarity_types)}")
-    
     # Get similar places based on structural info
     similar_places_structural = SimilarPlace.objects.filter(
         main_place=place, 
         similarity_type='structural'
     ).select_related('similar_place').order_by('-similarity_score')[:3]
     
-    print(f"Structural similar places: {similar_places_structural.count()}")
-    
     # Get similar places based on image in same city
     similar_places_same_city = SimilarPlace.objects.filter(
         main_place=place, 
         similarity_type='image_same_city'
     ).select_related('similar_place').order_by('-similarity_score')[:3]
     
-    print(f"Image similar places (same city): {similar_places_same_city.count()}")
+    # Prefer the score matrix, then stored rows, then the color index for new places
+    similar_places_same_city = (
+        score_matrix_similar(place, same_city=True)
+        or list(similar_places_same_city)
+        or color_index_similar(place, same_city=True)
+    )
     
     # Get similar places based on image in different cities
     similar_places_other_cities = SimilarPlace.objects.filter(
@@ -174,14 +162,11 @@ def place_detail(request, place_id):
         similarity_type='image_diff_city'
     ).select_related('similar_place').order_by('-similarity_score')[:3]
     
-    print(f"Image similar places (other cities): {similar_places_other_cities.count()}")
-    
-    # Try different filter to see if any similar places exist for this place
-    any_similar = SimilarPlace.objects.filter(main_place=place)
-    print(f"Any similar places with different filter: {any_similar.count()}")
-    if any_similar.exists():
-        for sim in any_similar[:3]:
-            print(f"  - {sim.similarity_type}: {sim.main_place.name} -> {sim.similar_place.name} (score: {sim.similarity_score})")
+    similar_places_other_cities = (
+        score_matrix_similar(place, same_city=False)
+        or list(similar_places_other_cities)
+        or color_index_similar(place, same_city=False)
+    )
     
     context = {
         'place': place,
@@ -195,6 +180,37 @@ def place_detail(request, place_id):
     
     return render(request, 'myapp/place_detail.html', context)
 
+def colorbar_image(request, image_id):
+    """The image a colorbar request is for, None if it has no palette; queried once per request"""
+    if not hasattr(request, '_colorbar_image'):
+        request._colorbar_image = (PlaceImage.objects.only('id', 'color_vector', 'color_dim')
+                                   .filter(pk=image_id, color_dim__gt=0).first())
+    return request._colorbar_image
+
+def colorbar_etag(request, image_id, palette_hash):
+    """The palette hash while it is still the image's current one; None lets the view 404 or redirect"""
+    image = colorbar_image(request, image_id)
+    if image is None or image.palette_hash != palette_hash:
+        return None
+    return palette_hash
+
+@etag(colorbar_etag)
+def colorbar(request, image_id, palette_hash):
+    """
+    Color bar of an image, rendered from its stored palette on first request.
+    The URL carries the palette hash, so the response never changes and can
+    be cached forever; a stale hash redirects to the current one.
+    """
+    image = colorbar_image(request, image_id)
+    if image is None:
+        raise Http404("No palette for this image")
+    if image.palette_hash != palette_hash:
+        return redirect('myapp:colorbar', image_id=image.id, palette_hash=image.palette_hash)
+
+    response = FileResponse(open_color_bar(palette_hash, image.colors), content_type='image/jpeg')
+    patch_cache_control(response, public=True, max_age=365 * 24 * 3600, immutable=True)
+    return response
+
 def search(request):
     """Simple search view"""
     query = request.GET.get('q', '')
@@ -0,0 +1,153 @@
+# myapp/writers.py
+import time
+from itertools import islice
+
+from django.db import connection
+
+from myapp.models import SimilarPlace
+
+# Loads at least this large drop the non-unique indexes and rebuild them afterwards
+INDEX_REBUILD_THRESHOLD = 200000
+
+# Pragmas the writer may change and the values each accepts. PRAGMA takes no
+# bound parameters, so values are validated here before they are interpolated.
+PRAGMA_VALUES = {
+    'cache_size': int,
+    'temp_store': ('DEFAULT', 'FILE', 'MEMORY', 0, 1, 2),
+}
+
+
+def pragma_sql(pragma, value=None):
+    """`PRAGMA name` or `PRAGMA name = value` for a whitelisted pragma and value"""
+    if pragma not in PRAGMA_VALUES:
+        raise ValueError(f"Unsupported pragma: {pragma!r}")
+    if value is None:
+        return f"PRAGMA {pragma}"
+
+    allowed = PRAGMA_VALUES[pragma]
+    if allowed is int:
+        if isinstance(value, bool) or not isinstance(value, int):
+            raise ValueError(f"PRAGMA {pragma} needs an integer, not {value!r}")
+    elif (value.upper() if isinstance(value, str) else value) not in allowed:
+        raise ValueError(f"Unsupported value for PRAGMA {pragma}: {value!r}")
+    return f"PRAGMA {pragma} = {value}"
+
+
+class SimilarPlaceWriter:
+    """
+    Streams (main_place_id, similar_place_id, similarity_score, similarity_type)
+    tuples into the SimilarPlace table with raw executemany, skipping rows that
+    already exist (like bulk_create(ignore_conflicts=True)).
+
+    On SQLite the load runs with a large page cache, and large loads drop the
+    table's non-unique (foreign key) indexes and rebuild them once at the end
+    instead of updating them on every insert. The unique index stays, so
+    duplicates are still ignored as they arrive and readers never see the
+    table without its constraint. Use it as a context manager inside the
+    caller's transaction.
+    """
+
+    # 'synchronous' cannot be changed inside a transaction, nor can 'temp_store'
+    # once the transaction has used temporary storage, so only the cache is tuned
+    SQLITE_PRAGMAS = {
+        'cache_size': -262144,  # 256 MB page cache
+    }
+
+    def __init__(self, batch_size=50000, expected_rows=None, rebuild_indexes=None):
+        self.batch_size = batch_size
+        if rebuild_indexes is None:
+            rebuild_indexes = expected_rows is not None and expected_rows >= INDEX_REBUILD_THRESHOLD
+        self.rebuild_indexes = rebuild_indexes and connection.vendor == 'sqlite'
+
+        self.table = SimilarPlace._meta.db_table
+        self.columns = [
+            SimilarPlace._meta.get_field(name).column
+            for name in ('main_place', 'similar_place', 'similarity_score', 'similarity_type')
+        ]
+        self.sql = self._insert_sql(self.columns)
+
+        self.rows_written = 0
+        self.elapsed = 0.0
+        self._saved_pragmas = {}
+        self._dropped_indexes = []
+
+    def _insert_sql(self, columns):
+        qn = connection.ops.quote_name
+        column_list = ', '.join(qn(c) for c in columns)
+        values = ', '.join(['%s'] * len(columns))
+        table = qn(self.table)
+        if connection.vendor == 'sqlite':
+            return f"INSERT OR IGNORE INTO {table} ({column_list}) VALUES ({values})"
+        if connection.vendor == 'mysql':
+            return f"INSERT IGNORE INTO {table} ({column_list}) VALUES ({values})"
+        return f"INSERT INTO {table} ({column_list}) VALUES ({values}) ON CONFLICT DO NOTHING"
+
+    @property
+    def rows_per_second(self):
+        return self.rows_written / self.elapsed if self.elapsed else 0.0
+
+    def __enter__(self):
+        self._started = time.perf_counter()
+        if connection.vendor == 'sqlite':
+            with connection.cursor() as cursor:
+                for pragma, value in self.SQLITE_PRAGMAS.items():
+                    cursor.execute(pragma_sql(pragma))
+                    self._saved_pragmas[pragma] = cursor.fetchone()[0]
+                    cursor.execute(pragma_sql(pragma, value))
+
+                if self.rebuild_indexes:
+                    self._dropped_indexes = self._secondary_indexes(cursor)
+                    for name, _ in self._dropped_indexes:
+                        cursor.execute(f"DROP INDEX {connection.ops.quote_name(name)}")
+        return self
+
+    def _secondary_indexes(self, cursor):
+        """(name, sql) of the table's non-unique indexes"""
+        cursor.execute(f"PRAGMA index_list({connection.ops.quote_name(self.table)})")
+        names = [row[1] for row in cursor.fetchall() if not row[2]]
+        if not names:
+            return []
+        cursor.execute(
+            "SELECT name, sql FROM sqlite_master WHERE type = 'index' AND sql IS NOT NULL "
+            f"AND name IN ({', '.join(['%s'] * len(names))})",
+            names
+        )
+        return cursor.fetchall()
+
+    @staticmethod
+    def _unique(batch):
+        """Drop repeated (main, similar, type) keys within a batch, keeping the first like INSERT OR IGNORE"""
+        seen = set()
+        unique = []
+        for row in batch:
+            key = (row[0], row[1], row[3])
+            if key not in seen:
+                seen.add(key)
+                unique.append(row)
+        return unique
+
+    def write(self, rows):
+        """Insert an iterable of row tuples in large executemany batches; returns the rows inserted"""
+        rows = iter(rows)
+        written = 0
+        with connection.cursor() as cursor:
+            while True:
+                batch = list(islice(rows, self.batch_size))
+                if not batch:
+                    break
+                cursor.executemany(self.sql, self._unique(batch))
+                # Not every backend reports a row count for executemany
+                written += cursor.rowcount if cursor.rowcount >= 0 else len(batch)
+        self.rows_written += written
+        return written
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        with connection.cursor() as cursor:
+            for _, sql in self._dropped_indexes:
+                cursor.execute(sql)
+
+            for pragma, value in self._saved_pragmas.items():
+                cursor.execute(pragma_sql(pragma, value))
+
+        self.elapsed = time.perf_counter() - self._started
+        return False
@@ -128,4 +128,7 @@ STATIC_URL = 'static/'
 DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
 
 MEDIA_URL = '/media/'
-MEDIA_ROOT = os.path.join(BASE_DIR, 'media')
\ No newline at end of file
+MEDIA_ROOT = os.path.join(BASE_DIR, 'media')
+
+# Precomputed similarity data (color index, score matrices, PageRank vectors)
+SIMILARITY_DATA_DIR = os.path.join(BASE_DIR, 'data')